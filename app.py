@@ -3,17 +3,39 @@ from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from config import Config
 from models import db
+from sqlite_profile import sqlite_profile
 from utils import mail
+from smtp_pool import smtp_pool
+from transport import transports
+from envelope import envelopes
+from mta import mta
+from project_cache import project_cache
+from governor import governor
+from circuit import breakers
+from metrics import smtp_metrics
+from jobs import outbox_worker
+from smtp_ingress import smtp_ingress
 from routes import app as api_blueprint
 
-def create_app():
+def create_app(config_object=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_object)
     
     jwt = JWTManager(app)
     CORS(app, resources=app.config['CORS_RESOURCES'])
+    sqlite_profile.init_app(app)   # antes do db: define as opções do engine
     db.init_app(app)
     mail.init_app(app)
+    smtp_pool.init_app(app)
+    transports.init_app(app)
+    envelopes.init_app(app)
+    mta.init_app(app)
+    project_cache.init_app(app)
+    governor.init_app(app)
+    breakers.init_app(app)
+    smtp_metrics.init_app(app)
+    outbox_worker.init_app(app)
+    smtp_ingress.init_app(app)
     
     app.register_blueprint(api_blueprint, url_prefix='/api')
     
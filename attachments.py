@@ -0,0 +1,157 @@
+"""
+Attachments that never have to fit in memory.
+
+Uploads are spooled to ``SPOOL_DIR`` and referenced by path. When the
+message is sent, ``StreamingMessage`` serializes the (small) MIME skeleton
+with flask_mail and splices in the attachment content, base64-encoded a
+block at a time, so peak memory per message does not grow with attachment
+size.
+
+Text parts are built with ``mime_text``: raw 8-bit only when the message is
+rendered for a relay that advertised 8BITMIME, quoted-printable or base64
+(whichever is shorter) otherwise.
+"""
+
+import base64
+import copy
+import os
+import shutil
+import tempfile
+import uuid
+from email.charset import Charset, QP, BASE64
+from email.mime.text import MIMEText
+from flask_mail import Attachment, Message
+
+# 57 bytes de entrada = uma linha base64 de 76 caracteres
+READ_BLOCK = 57 * 1024
+# Limite de linha do SMTP (RFC 5321 4.5.3.1.6), sem o CRLF
+MAX_LINE_OCTETS = 998
+ASCII = bytes(range(128))
+
+
+class FileAttachment(object):
+    """Attachment content stored in a spool file."""
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size if size is not None else os.path.getsize(path)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'FileAttachment(%r, size=%d)' % (self.path, self.size)
+
+
+def spool_upload(file_storage, spool_dir):
+    """Copy an uploaded file to the spool directory in fixed-size blocks."""
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix='att-', dir=spool_dir)
+    with os.fdopen(fd, 'wb') as target:
+        shutil.copyfileobj(file_storage.stream, target, READ_BLOCK)
+    return FileAttachment(path)
+
+
+def discard_attachments(attachments):
+    """Remove spool files once a message will not be sent again."""
+    if not isinstance(attachments, (tuple, list)):
+        # Ausente ou inválido (recusado na validação): não há arquivos no spool
+        return
+    for attachment in attachments:
+        if isinstance(attachment, (tuple, list)):
+            data = attachment[2] if len(attachment) == 3 else None
+        else:
+            data = getattr(attachment, 'data', None)
+        if isinstance(data, FileAttachment):
+            data.discard()
+
+
+def mime_text(text, subtype='plain', charset='utf-8', eightbit=False):
+    """MIMEText sent as-is when it can be, encoded otherwise.
+
+    ASCII text with short lines is 7bit. Other text is 8bit only when
+    ``eightbit`` is set; without it the part gets quoted-printable or base64,
+    whichever comes out smaller.
+    """
+    charset = Charset(charset)
+    encoded = text.encode(charset.output_charset or charset.input_charset)
+    short_lines = all(len(line) <= MAX_LINE_OCTETS for line in encoded.splitlines())
+    high = len(encoded.translate(None, ASCII))
+    if short_lines and (eightbit or not high):
+        charset.body_encoding = None
+    elif 2 * high < len(encoded) / 3:
+        # QP acrescenta 2 bytes por byte não ASCII; base64 aumenta tudo em 1/3
+        charset.body_encoding = QP
+    else:
+        charset.body_encoding = BASE64
+    return MIMEText(text, _subtype=subtype, _charset=charset)
+
+
+def iter_blocks(data):
+    """Yield raw content blocks from bytes or a FileAttachment."""
+    if isinstance(data, FileAttachment):
+        with data.open() as f:
+            while True:
+                block = f.read(READ_BLOCK)
+                if not block:
+                    return
+                yield block
+    else:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        for start in range(0, len(data), READ_BLOCK):
+            yield data[start:start + READ_BLOCK]
+
+
+def iter_base64(data):
+    """Base64-encode content in CRLF-separated 76-char lines, block by block.
+
+    The final line has no trailing CRLF, matching what the email package
+    writes before the next boundary.
+    """
+    previous = None
+    for block in iter_blocks(data):
+        if previous is not None:
+            yield previous
+        previous = base64.encodebytes(block).replace(b'\n', b'\r\n')
+    if previous is not None:
+        yield previous[:-2]
+
+
+class StreamingMessage(Message):
+    """flask_mail Message whose attachments are encoded while streaming."""
+
+    eightbit = False
+
+    def _mimetext(self, text, subtype='plain'):
+        if text is None:
+            return Message._mimetext(self, text, subtype)
+        return mime_text(text, subtype, self.charset or 'utf-8', self.eightbit)
+
+    def iter_bytes(self, eightbit=False):
+        """Yield the serialized message in chunks."""
+        attachments = self.attachments
+        markers = [uuid.uuid4().hex.encode('ascii') for _ in attachments]
+        # Serializa o esqueleto com marcadores no lugar do conteúdo dos anexos. Usa
+        # uma cópia: outros envelopes da mesma mensagem podem estar sendo serializados
+        skeleton = copy.copy(self)
+        skeleton.attachments = [Attachment(a.filename, a.content_type, marker, a.disposition, a.headers)
+                                for a, marker in zip(attachments, markers)]
+        skeleton.eightbit = eightbit
+        skeleton = skeleton.as_bytes()
+
+        for attachment, marker in zip(attachments, markers):
+            head, skeleton = skeleton.split(base64.b64encode(marker), 1)
+            yield head
+            for chunk in iter_base64(attachment.data):
+                yield chunk
+        yield skeleton
@@ -0,0 +1,165 @@
+"""
+Lookup cost of the hot queries as the tables grow.
+
+Builds SQLite databases with the schema from models.py at increasing sizes
+and times the lookups done by register/verify/check-verification: a user by
+email and a verification status by (user_id, project_id). With the indexes
+the cost should stay flat; ``--compare-scan`` repeats the lookups with the
+indexes dropped to show the full-scan cost they replace.
+
+    python -m benchmarks.bench_lookups --sizes 10000,100000,1000000
+    python -m benchmarks.bench_lookups --sizes 10000,10000000 --compare-scan --output lookups.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine  # noqa: E402
+from models import db  # noqa: E402
+
+QUERIES = {
+    'user_by_email': ('SELECT id, verified FROM user WHERE email = ?',
+                      lambda i, projects: ('user%d@example.com' % i,)),
+    'verification_by_user_project': ('SELECT verified FROM verification_status '
+                                     'WHERE user_id = ? AND project_id = ?',
+                                     lambda i, projects: (i, i % projects + 1)),
+}
+BATCH = 50000
+
+
+def build_database(path, size, projects):
+    """Create the schema from the models and load ``size`` users."""
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                           "AND sql IS NOT NULL").fetchall()
+    # Carregar sem índices e criá-los no fim é bem mais rápido
+    for name, _ in indexes:
+        conn.execute('DROP INDEX %s' % name)
+
+    started = time.perf_counter()
+    conn.executemany('INSERT INTO project (id, api_key, name) VALUES (?, ?, ?)',
+                     [(p, 'key%d' % p, 'project %d' % p) for p in range(1, projects + 1)])
+    for start in range(1, size + 1, BATCH):
+        ids = range(start, min(start + BATCH, size + 1))
+        conn.executemany('INSERT INTO user (id, email, verified) VALUES (?, ?, 0)',
+                         ((i, 'user%d@example.com' % i) for i in ids))
+        conn.executemany('INSERT INTO user_projects (user_id, project_id) VALUES (?, ?)',
+                         ((i, i % projects + 1) for i in ids))
+        conn.executemany('INSERT INTO verification_status (user_id, project_id, verified) '
+                         'VALUES (?, ?, 0)', ((i, i % projects + 1) for i in ids))
+    conn.commit()
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _, sql in indexes:
+        conn.execute(sql)
+    conn.commit()
+    index_seconds = time.perf_counter() - started
+    conn.execute('ANALYZE')
+    return conn, indexes, load_seconds, index_seconds
+
+
+def time_lookups(conn, size, projects, count, seed):
+    rng = random.Random(seed)
+    keys = [rng.randint(1, size) for _ in range(count)]
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        plan = ' | '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql,
+                                                           params(1, projects)))
+        timings = []
+        for key in keys:
+            args = params(key, projects)
+            started = time.perf_counter()
+            row = conn.execute(sql, args).fetchone()
+            timings.append(time.perf_counter() - started)
+            assert row is not None, (name, args)
+        timings.sort()
+        results[name] = {
+            'lookups': count,
+            'mean_us': round(statistics.mean(timings) * 1e6, 2),
+            'p50_us': round(timings[len(timings) // 2] * 1e6, 2),
+            'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 2),
+            'plan': plan,
+        }
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='quantidades de usuários, separadas por vírgula')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--compare-scan', action='store_true',
+                        help='repete as consultas sem índices (varredura completa)')
+    parser.add_argument('--scan-lookups', type=int, default=50,
+                        help='consultas sem índice por tamanho (são lentas)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='diretório dos bancos (padrão: temporário, removido no fim)')
+    parser.add_argument('--output', help='grava o resultado em JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench-lookups-')
+    os.makedirs(workdir, exist_ok=True)
+
+    report = {'config': vars(args), 'sizes': []}
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'lookups-%d.db' % size)
+            if os.path.exists(path):
+                os.remove(path)
+            conn, indexes, load_seconds, index_seconds = build_database(path, size, args.projects)
+            entry = {
+                'rows': size,
+                'load_seconds': round(load_seconds, 2),
+                'index_seconds': round(index_seconds, 2),
+                'file_mb': round(os.path.getsize(path) / 2 ** 20, 1),
+                'indexed': time_lookups(conn, size, args.projects, args.lookups, args.seed),
+            }
+            if args.compare_scan:
+                for name, _ in indexes:
+                    conn.execute('DROP INDEX %s' % name)
+                entry['scan'] = time_lookups(conn, size, args.projects, args.scan_lookups, args.seed)
+            conn.close()
+            os.remove(path)
+            report['sizes'].append(entry)
+
+            line = '%10d linhas  carga %.1fs  índices %.1fs' % (size, load_seconds, index_seconds)
+            for name, result in entry['indexed'].items():
+                line += '  %s %.1fus' % (name, result['mean_us'])
+                if args.compare_scan:
+                    line += ' (sem índice %.0fus)' % entry['scan'][name]['mean_us']
+            print(line, file=sys.stderr)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Direct-to-MX delivery benchmark.
+
+Starts one ``SMTPSink`` per recipient domain as its stand-in MX (wired
+through ``MTA_STATIC_MX``), puts the sender domain in direct mode and sends
+messages whose recipients are spread over those domains, straight through
+``send_custom_email``. Reports messages/s, the peak number of sessions each
+stand-in saw (bounded by ``--domain-concurrency``), connections opened and
+the DNS cache counters. ``--dead-primary`` gives every domain an
+unreachable first MX to measure failover.
+
+    python -m benchmarks.bench_mta --domains 8 --messages 200 --recipients 40
+    python -m benchmarks.bench_mta --latency 0.02 --domain-concurrency 1
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.smtp_sink import SMTPSink  # noqa: E402
+
+
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def build_config(static_mx, args, workdir):
+    from config import Config
+
+    class MTAConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        SMTP_CONFIGS = {'default': {'direct': True, 'max_recipients': args.max_recipients}}
+        SPOOL_DIR = os.path.join(workdir, 'spool')
+        OUTBOX_WORKER_ENABLED = False
+        MTA_STATIC_MX = static_mx
+        MTA_DOMAIN_CONCURRENCY = args.domain_concurrency
+        MTA_WORKERS = args.workers
+
+    return MTAConfig
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--domains', type=int, default=8, help='domínios de destino (um MX local cada)')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--recipients', type=int, default=40, help='destinatários por mensagem')
+    parser.add_argument('--concurrency', type=int, default=4, help='mensagens enviadas em paralelo')
+    parser.add_argument('--domain-concurrency', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--max-recipients', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.005, help='atraso por round trip dos MX (s)')
+    parser.add_argument('--dead-primary', action='store_true', help='primeiro MX de cada domínio fora do ar')
+    parser.add_argument('--output', help='grava o resultado em JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('JWT_SECRET_KEY', 'bench-jwt-secret-key-with-32-bytes!')
+    workdir = tempfile.mkdtemp(prefix='bench-mta-')
+
+    sinks = {}
+    static_mx = {}
+    for index in range(args.domains):
+        domain = 'destino%d.test' % index
+        sinks[domain] = SMTPSink(latency=args.latency)
+        hosts = ['127.0.0.1:%d' % sinks[domain].start()]
+        if args.dead_primary:
+            hosts.insert(0, '127.0.0.1:%d' % unused_port())
+        static_mx[domain] = hosts
+
+    from app import create_app
+    from models import db, Project
+    from mta import mta
+    from utils import send_custom_email
+
+    app = create_app(build_config(static_mx, args, workdir))
+    with app.app_context():
+        db.create_all()
+        db.session.add(Project(name='bench', mail_username='envio@direto.test', mail_password='x'))
+        db.session.commit()
+    domains = sorted(sinks)
+
+    def send(index):
+        recipients = ['r%d.%d@%s' % (index, n, domains[n % len(domains)])
+                      for n in range(args.recipients)]
+        with app.app_context():
+            project = db.session.get(Project, 1)
+            report = send_custom_email(recipients, 'Mensagem %d' % index, 'corpo',
+                                       sender='envio@direto.test', project=project)
+            db.session.commit()
+            return len(report.sent), len(report.failed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.messages)))
+    elapsed = time.perf_counter() - started
+
+    per_domain = {domain: sink.stats() for domain, sink in sinks.items()}
+    for sink in sinks.values():
+        sink.stop()
+    report = {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(args.messages / elapsed, 1),
+        'recipients_per_s': round(args.messages * args.recipients / elapsed, 1),
+        'sent': sum(sent for sent, _ in results),
+        'failed': sum(failed for _, failed in results),
+        'peak_sessions': max(stats.get('peak_sessions', 0) for stats in per_domain.values()),
+        'connections': sum(stats.get('connections', 0) for stats in per_domain.values()),
+        'transactions': sum(stats.get('messages', 0) for stats in per_domain.values()),
+        'dns': mta.stats()['dns'],
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
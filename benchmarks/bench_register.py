@@ -0,0 +1,167 @@
+"""
+Registrations per second at high concurrency, upsert vs. the old read-then-write flow.
+
+Calls the registration path directly from worker threads (each with its own
+app context and session), so the numbers isolate the database work from
+HTTP and SMTP. ``--duplicates`` makes a fraction of the registrations reuse
+emails already in flight, which exercises the conflict paths and exposes the
+duplicate rows the old flow could create.
+
+    python -m benchmarks.bench_register --registrations 5000 --concurrency 32
+    python -m benchmarks.bench_register --mode legacy --duplicates 0.3
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+
+
+def legacy_register(email, project_id):
+    """The registration flow before the upsert: read each row, then write."""
+    from models import db, User, Project, VerificationStatus
+
+    user = User.query.filter_by(email=email).first()
+    if user:
+        verification = VerificationStatus.query.filter_by(user_id=user.id, project_id=project_id).first()
+        if verification and verification.verified:
+            return
+    if not user:
+        user = User(email=email)
+        user.projects.append(db.session.get(Project, project_id))
+        db.session.add(user)
+    elif project_id not in [p.id for p in user.projects]:
+        user.projects.append(db.session.get(Project, project_id))
+    verification = VerificationStatus.query.filter_by(user_id=user.id, project_id=project_id).first()
+    if not verification:
+        db.session.add(VerificationStatus(user_id=user.id, project_id=project_id))
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def build_app(database_uri):
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        OUTBOX_WORKER_ENABLED = False
+
+    from app import create_app
+    return create_app(BenchConfig)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--registrations', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--projects', type=int, default=4)
+    parser.add_argument('--duplicates', type=float, default=0.2,
+                        help='fração de registros que repetem um email já usado')
+    parser.add_argument('--mode', choices=('upsert', 'legacy'), default='upsert')
+    parser.add_argument('--database-uri', help='padrão: SQLite temporário')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='grava o resultado em JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('JWT_SECRET_KEY', 'bench-jwt-secret-key-with-32-bytes!')
+    database_uri = args.database_uri or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(prefix='bench-register-'), 'bench.db')
+
+    app = build_app(database_uri)
+    from models import db, Project, User, VerificationStatus, user_projects
+    from registration import register_email
+
+    with app.app_context():
+        db.create_all()
+        projects = [Project(name='bench %d' % i) for i in range(args.projects)]
+        db.session.add_all(projects)
+        db.session.commit()
+        project_ids = [project.id for project in projects]
+
+    rng = random.Random(args.seed)
+    work = []
+    for i in range(args.registrations):
+        if work and rng.random() < args.duplicates:
+            email = rng.choice(work)[0]
+        else:
+            email = 'user%d@example.com' % i
+        work.append((email, rng.choice(project_ids)))
+
+    register = register_email if args.mode == 'upsert' else legacy_register
+    errors = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def run(item):
+        started = time.perf_counter()
+        with app.app_context():
+            try:
+                register(*item)
+                error = None
+            except Exception as e:
+                error = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(run, work))
+    seconds = time.perf_counter() - started
+
+    with app.app_context():
+        session = db.session
+        users = session.scalar(select(func.count()).select_from(User))
+        emails = session.scalar(select(func.count(func.distinct(User.email))))
+        links = session.scalar(select(func.count()).select_from(user_projects))
+        statuses = session.scalar(select(func.count()).select_from(VerificationStatus))
+    expected_pairs = len(set(work))
+
+    latencies.sort()
+    report = {
+        'config': dict(vars(args), database_uri=database_uri.split('@')[-1]),
+        'registrations': len(work),
+        'errors': sum(errors.values()),
+        'error_detail': errors,
+        'seconds': round(seconds, 3),
+        'per_sec': round(len(work) / seconds, 1),
+        'latency_ms': {
+            'p50': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p99': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+            'max': round(latencies[-1] * 1000, 2),
+        },
+        'rows': {
+            'users': users,
+            'distinct_emails': emails,
+            'duplicate_users': users - emails,
+            'user_projects': links,
+            'verification_status': statuses,
+            'expected_pairs': expected_pairs,
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+End-to-end throughput benchmark: register -> verify -> send-custom-email.
+
+Runs the real app behind a threaded werkzeug server and points every SMTP
+provider at an in-process ``SMTPSink``, so the numbers cover HTTP, the
+database and the SMTP send path without leaving the machine.
+
+    python -m benchmarks.bench_send --messages 500 --concurrency 16
+    python -m benchmarks.bench_send --mode async --latency 0.01 --output out.json
+    python -m benchmarks.bench_send --latency 0.02 --extensions ''   # relay sem ESMTP
+"""
+
+import argparse
+import base64
+import email
+import http.client
+import json
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.smtp_sink import SMTPSink  # noqa: E402
+
+VERIFY_LINK = re.compile(r'/api/verify/([A-Za-z0-9_.\-]+)')
+
+
+class TokenCollector(object):
+    """Extracts verification tokens from the messages the sink receives."""
+
+    def __init__(self):
+        self.tokens = {}
+        self.delivered = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, mail_from, rcpt_to, data):
+        token = None
+        message = email.message_from_bytes(data)
+        for part in message.walk():
+            payload = part.get_payload(decode=True)
+            if payload:
+                match = VERIFY_LINK.search(payload.decode('utf-8', 'replace'))
+                if match:
+                    token = match.group(1)
+                    break
+        with self._lock:
+            self.delivered += 1
+            if token is not None:
+                for rcpt in rcpt_to:
+                    self.tokens[rcpt.strip('<>').split(':', 1)[-1].strip('<>')] = token
+
+
+def build_config(sink_port, starttls, workdir):
+    from config import Config
+
+    sink = {'server': '127.0.0.1', 'port': sink_port, 'use_tls': starttls}
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        SMTP_CONFIGS = {'gmail.com': dict(sink), 'default': dict(sink)}
+        SPOOL_DIR = os.path.join(workdir, 'spool')
+        OUTBOX_POLL_INTERVAL = 0.05
+
+    return BenchConfig
+
+
+def start_server(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-http', daemon=True).start()
+    return server
+
+
+class Client(object):
+    """One keep-alive HTTP connection per worker thread."""
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, payload=None):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self.local.conn = None
+            raise
+        return response.status, data
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_phase(name, items, call, concurrency):
+    """Run ``call(item)`` for every item; returns timing and error counts."""
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+
+    def timed(item):
+        started = time.perf_counter()
+        try:
+            ok, detail = call(item)
+        except Exception as e:
+            ok, detail = False, type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[detail] = errors.get(detail, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, items))
+    seconds = time.perf_counter() - started
+
+    count = len(latencies)
+    return {
+        'phase': name,
+        'count': count,
+        'errors': sum(errors.values()),
+        'error_detail': errors,
+        'seconds': round(seconds, 3),
+        'per_sec': round(count / seconds, 1) if seconds else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 2),
+            'p90': round(percentile(latencies, 0.90) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round(max(latencies) * 1000, 2) if latencies else 0.0,
+            'mean': round(statistics.mean(latencies) * 1000, 2) if latencies else 0.0,
+        },
+    }
+
+
+def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+def max_rss_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def smtp_totals(snapshot):
+    """Bytes written and round trips per message, summed over every project."""
+    totals = {'sent': 0, 'failed': 0, 'wire_bytes': 0, 'round_trips': 0, 'rtt_saved': 0}
+    for projects in snapshot.values():
+        for counters in projects.values():
+            for name in totals:
+                totals[name] += counters[name]
+    messages = totals['sent'] + totals['failed']
+    for name in ('wire_bytes', 'round_trips', 'rtt_saved'):
+        totals[name + '_per_message'] = round(totals[name] / messages, 1) if messages else 0.0
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200,
+                        help='emails enviados na fase send')
+    parser.add_argument('--registrations', type=int, default=None,
+                        help='usuários registrados/verificados (padrão: --messages)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='atraso por round trip SMTP do sink, em segundos')
+    parser.add_argument('--extensions', default='PIPELINING,CHUNKING,8BITMIME,SMTPUTF8',
+                        help='extensões ESMTP anunciadas pelo sink, separadas por vírgula')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fração de RCPT respondidos com 451')
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        help='fração de RCPT respondidos com 550')
+    parser.add_argument('--starttls', action='store_true',
+                        help='sink exige STARTTLS com certificado autoassinado')
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--attachment-size', type=int, default=0,
+                        help='tamanho em bytes de um anexo por email')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='espera máxima pela entrega no modo async')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='mede o pico de memória Python (mais lento)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', help='grava o resultado em JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    registrations = args.messages if args.registrations is None else args.registrations
+    os.environ.setdefault('JWT_SECRET_KEY', 'bench-jwt-secret-key-with-32-bytes!')
+    os.environ.setdefault('SECRET_KEY', 'bench-secret')
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    collector = TokenCollector()
+    sink = SMTPSink(latency=args.latency, error_rate=args.error_rate,
+                    reject_rate=args.reject_rate, starttls=args.starttls,
+                    seed=args.seed, on_message=collector,
+                    extensions=[name for name in args.extensions.split(',') if name.strip()])
+    sink_port = sink.start()
+
+    workdir = tempfile.mkdtemp(prefix='bench-send-')
+    from app import create_app
+    from models import db
+    from jobs import outbox_worker
+    from metrics import smtp_metrics
+
+    app = create_app(build_config(sink_port, args.starttls, workdir))
+    with app.app_context():
+        db.create_all()
+    server = start_server(app)
+    client = Client(server.server_port)
+
+    status, data = client.request('POST', '/api/projects', {
+        'name': 'bench', 'mail_username': 'bench@gmail.com', 'mail_password': 'secret'})
+    if status != 201:
+        raise SystemExit('Falha ao criar projeto: %s %s' % (status, data[:200]))
+    api_key = json.loads(data)['project']['api_key']
+
+    results = []
+    addresses = ['user%d@example.com' % i for i in range(registrations)]
+
+    def register(address):
+        status, data = client.request('POST', '/api/register', {'email': address, 'api_key': api_key})
+        return status == 201, status
+
+    def verify(address):
+        token = collector.tokens.get(address)
+        if token is None:
+            return False, 'no-token'
+        status, data = client.request('GET', '/api/verify/' + token)
+        return status == 200, status
+
+    attachments = []
+    if args.attachment_size:
+        content = os.urandom(args.attachment_size)
+        attachments = [['bench.bin', 'application/octet-stream',
+                        base64.b64encode(content).decode('ascii')]]
+
+    def send(index):
+        payload = {
+            'api_key': api_key,
+            'sender': 'bench@gmail.com',
+            'subject': 'Benchmark %d' % index,
+            'recipients': ['rcpt%d@example.com' % index],
+            'body': 'Mensagem de benchmark %d' % index,
+            'attachments': attachments,
+        }
+        if args.mode == 'async':
+            payload['async'] = True
+        status, data = client.request('POST', '/api/send-custom-email', payload)
+        return status in (200, 202), status
+
+    if registrations:
+        results.append(run_phase('register', addresses, register, args.concurrency))
+        wait_for(lambda: len(collector.tokens) >= registrations, 10)
+        results.append(run_phase('verify', addresses, verify, args.concurrency))
+
+    delivered_before = collector.delivered
+    phase = run_phase('send', range(args.messages), send, args.concurrency)
+    if args.mode == 'async':
+        expected = delivered_before + args.messages - phase['errors']
+
+        def drained():
+            # Recusas do sink não chegam a ser entregues (451 volta para a fila com backoff)
+            stats = sink.stats()
+            refused = stats.get('deferred', 0) + stats.get('rejected', 0)
+            return collector.delivered + refused >= expected
+        started = time.perf_counter()
+        wait_for(drained, args.timeout)
+        phase['drain_seconds'] = round(time.perf_counter() - started, 3)
+        total = phase['seconds'] + phase['drain_seconds']
+        phase['delivered'] = collector.delivered - delivered_before
+        phase['delivered_per_sec'] = round(phase['delivered'] / total, 1) if total else 0.0
+    results.append(phase)
+
+    report = {
+        'config': vars(args),
+        'phases': results,
+        'sink': sink.stats(),
+        'smtp': smtp_totals(smtp_metrics.snapshot()),
+        'memory': {'max_rss_mb': max_rss_mb()},
+    }
+    if args.tracemalloc:
+        report['memory']['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+
+    outbox_worker.stop()
+    server.shutdown()
+    sink.stop()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
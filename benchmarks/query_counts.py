@@ -0,0 +1,193 @@
+"""
+SQL statements issued per endpoint, checked against a fixed budget.
+
+Runs each endpoint through the Flask test client against a temporary SQLite
+database and an in-process ``SMTPSink``, counting the statements the engine
+executes. The seeded user is linked to ``--projects`` projects, so a lazy
+load of a relationship shows up as a count that grows with that option.
+Exits with status 1 when any endpoint goes over its entry in ``BUDGETS``.
+
+    python -m benchmarks.query_counts
+    python -m benchmarks.query_counts --projects 200 --show-sql
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from benchmarks.smtp_sink import SMTPSink  # noqa: E402
+
+# Statements esperados com o cache de api_key já aquecido
+BUDGETS = {
+    'register (novo)': 5,               # 3 upserts + contador de registro + contador de envio
+    'register (existente)': 5,
+    'register/batch (10)': 5,           # 3 upserts multi-linha + contador + INSERT multi-linha na outbox
+    'verify': 3,                        # consulta + UPDATE condicional + contador
+    'verify (já verificado)': 1,
+    'check-verification': 1,
+    'check-verification/batch (100)': 1,
+    'users': 1,
+    'projects': 1,
+    'users/export': 1,
+    'stats': 1,
+    'send-custom-email': 1,             # contador de envio
+    'jobs/<id>': 1,
+    'outbox deliver': 3,                # linha com o projeto, contador de envio, estado
+}
+
+
+class StatementCounter(object):
+    def __init__(self, engine):
+        self.statements = []
+        self._active = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._active, 'on', False):
+            self.statements.append(' '.join(statement.split()))
+
+    @contextmanager
+    def count(self):
+        self.statements = []
+        self._active.on = True
+        try:
+            yield self
+        finally:
+            self._active.on = False
+
+
+def build_app(workdir, sink_port):
+    from config import Config
+
+    sink = {'server': '127.0.0.1', 'port': sink_port, 'use_tls': False}
+
+    class CountConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'counts.db')
+        SMTP_CONFIGS = {'gmail.com': dict(sink), 'default': dict(sink)}
+        SPOOL_DIR = os.path.join(workdir, 'spool')
+        OUTBOX_WORKER_ENABLED = False
+
+    from app import create_app
+    return create_app(CountConfig)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--projects', type=int, default=50,
+                        help='projetos ligados ao usuário já existente')
+    parser.add_argument('--show-sql', action='store_true', help='mostra os statements de cada endpoint')
+    parser.add_argument('--output', help='grava o resultado em JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('JWT_SECRET_KEY', 'bench-jwt-secret-key-with-32-bytes!')
+    workdir = tempfile.mkdtemp(prefix='query-counts-')
+    sink = SMTPSink()
+    sink_port = sink.start()
+
+    app = build_app(workdir, sink_port)
+    from flask_jwt_extended import create_access_token
+    from models import db, Project, Outbox
+    from registration import register_email
+    from jobs import outbox_worker
+    from utils import serializer
+
+    with app.app_context():
+        db.create_all()
+        projects = [Project(name='projeto %d' % i, mail_username='envio@gmail.com', mail_password='x')
+                    for i in range(args.projects)]
+        db.session.add_all(projects)
+        db.session.commit()
+        project_id, api_key = projects[0].id, projects[0].api_key
+        for project in projects:
+            register_email('antigo@example.com', project.id)
+        counter = StatementCounter(db.engine)
+        admin = {'Authorization': 'Bearer ' + create_access_token(identity='admin')}
+
+    client = app.test_client()
+    token = serializer.dumps({'email': 'antigo@example.com', 'api_key': api_key},
+                             salt='email-verification')
+    message = {'api_key': api_key, 'recipients': ['destino@example.com'],
+               'sender': 'envio@gmail.com', 'subject': 'Contagem', 'body': 'corpo'}
+
+    requests = [
+        ('register (novo)', 'post', '/api/register',
+         {'json': {'email': 'novo@example.com', 'api_key': api_key}}),
+        ('register (existente)', 'post', '/api/register',
+         {'json': {'email': 'antigo@example.com', 'api_key': api_key}}),
+        ('register/batch (10)', 'post', '/api/register/batch',
+         {'json': {'api_key': api_key, 'emails': ['lote%d@example.com' % i for i in range(10)]}}),
+        ('verify', 'get', '/api/verify/' + token, {}),
+        ('verify (já verificado)', 'get', '/api/verify/' + token, {}),
+        ('check-verification', 'post',
+         '/api/check-verification?email=antigo@example.com&api_key=' + api_key, {'headers': admin}),
+        ('check-verification/batch (100)', 'post', '/api/check-verification/batch',
+         {'headers': admin, 'json': {'api_key': api_key,
+                                     'emails': ['lote%d@example.com' % i for i in range(100)]}}),
+        ('users', 'get', '/api/users', {'headers': admin}),
+        ('projects', 'get', '/api/projects', {'headers': admin}),
+        ('users/export', 'get', '/api/users/export?api_key=' + api_key, {'headers': admin}),
+        ('stats', 'get', '/api/stats', {'headers': admin}),
+        ('send-custom-email', 'post', '/api/send-custom-email', {'json': message}),
+    ]
+
+    # Aquece o cache de api_key para medir o caminho estável
+    client.post('/api/login', json={'api_key': api_key})
+
+    results = {}
+    for name, method, url, kwargs in requests:
+        with counter.count():
+            response = getattr(client, method)(url, **kwargs)
+            response.get_data()
+        if response.status_code >= 400:
+            raise SystemExit('%s: HTTP %d %s' % (name, response.status_code, response.get_data(as_text=True)))
+        results[name] = list(counter.statements)
+
+    with app.app_context():
+        outbox_message = dict(message)
+        del outbox_message['api_key']
+        job_id = outbox_worker.enqueue_many(project_id, [outbox_message])[0]
+        row = db.session.get(Outbox, job_id)
+        row.state, row.lease_token = 'sending', 'contagem'
+        db.session.commit()
+    with counter.count():
+        response = client.get('/api/jobs/%d?api_key=%s' % (job_id, api_key))
+    results['jobs/<id>'] = list(counter.statements)
+    with app.app_context(), counter.count():
+        outbox_worker.deliver(job_id, 'contagem')
+    results['outbox deliver'] = list(counter.statements)
+
+    sink.stop()
+    over = []
+    report = {'config': vars(args), 'endpoints': {}}
+    for name, statements in results.items():
+        budget = BUDGETS[name]
+        report['endpoints'][name] = {'statements': len(statements), 'budget': budget}
+        status = 'ok' if len(statements) <= budget else 'ACIMA DO LIMITE'
+        if len(statements) > budget:
+            over.append(name)
+        print('%-32s %3d / %-3d %s' % (name, len(statements), budget, status), file=sys.stderr)
+        if args.show_sql:
+            for statement in statements:
+                print('    ' + statement[:160], file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if over:
+        raise SystemExit(1)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+In-process SMTP sink for benchmarks.
+
+Accepts any AUTH, swallows messages and answers with configurable latency
+and error rates, optionally offering STARTTLS. Like Gmail it advertises
+PIPELINING, CHUNKING (BDAT), 8BITMIME and SMTPUTF8 unless told otherwise
+(``extensions=``). Replies are buffered and flushed only when the client
+has nothing more queued, so ``latency`` is paid once per round trip and
+pipelining shows up in the numbers. It lets the send path be measured
+without touching Gmail or Zoho.
+
+    sink = SMTPSink(latency=0.005, error_rate=0.01)
+    port = sink.start()
+    ...
+    sink.stop()
+"""
+
+import base64
+import os
+import random
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+MAX_LINE = 1000 * 1000
+RECV_SIZE = 64 * 1024
+EXTENSIONS = ('PIPELINING', 'CHUNKING', '8BITMIME', 'SMTPUTF8')
+
+
+def make_self_signed_cert(directory=None):
+    """Create a throwaway certificate with the openssl CLI."""
+    directory = directory or tempfile.mkdtemp(prefix='sink-cert-')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', keyfile, '-out', certfile, '-days', '1',
+                    '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """One SMTP session."""
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.buffer = b''
+        self.replies = []
+        self.server.sink.session_started()
+
+    def reply(self, *lines):
+        *first, last = lines
+        data = ''.join('%s-%s\r\n' % (line[:3], line[4:]) for line in first) + last + '\r\n'
+        self.replies.append(data.encode('utf-8'))
+
+    def flush(self):
+        """Send the buffered replies; each flush is one round trip."""
+        if not self.replies:
+            return
+        sink = self.server.sink
+        if sink.latency:
+            time.sleep(sink.latency)
+        sink.count('round_trips')
+        data, self.replies = b''.join(self.replies), []
+        self.connection.sendall(data)
+
+    def fill(self):
+        # Só responde quando o cliente não tem mais nada na fila (RFC 2920 3.2)
+        self.flush()
+        data = self.connection.recv(RECV_SIZE)
+        self.server.sink.count('bytes_in', len(data))
+        self.buffer += data
+        return bool(data)
+
+    def readline(self):
+        while b'\n' not in self.buffer and len(self.buffer) < MAX_LINE:
+            if not self.fill():
+                break
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            if not self.fill():
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count('connections')
+        self.tls = False
+        self.mail_from = None
+        self.rcpt_to = []
+        self.bdat = None
+        self.reply('220 %s ESMTP sink' % sink.hostname)
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            command, _, arg = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            sink.count('commands')
+            handler = getattr(self, 'smtp_' + command, None)
+            if handler is None:
+                self.reply('502 5.5.2 Command not recognized')
+            elif handler(arg) is False:
+                return
+
+    def finish(self):
+        try:
+            self.flush()
+        except OSError:
+            pass
+        socketserver.StreamRequestHandler.finish(self)
+        if self.tls:
+            # O socket original foi desacoplado pelo wrap_socket
+            self.connection.close()
+        self.server.sink.session_ended()
+
+    def extensions(self):
+        sink = self.server.sink
+        extensions = ['AUTH PLAIN LOGIN', 'SIZE %d' % sink.max_size] + list(sink.extensions)
+        if sink.ssl_context is not None and not self.tls:
+            extensions.append('STARTTLS')
+        return extensions
+
+    def smtp_EHLO(self, arg):
+        lines = ['250 %s' % self.server.sink.hostname] + ['250 %s' % ext for ext in self.extensions()]
+        self.reply(*lines)
+
+    def smtp_HELO(self, arg):
+        self.reply('250 %s' % self.server.sink.hostname)
+
+    def smtp_STARTTLS(self, arg):
+        context = self.server.sink.ssl_context
+        if context is None or self.tls:
+            self.reply('502 5.5.1 STARTTLS not available')
+            return
+        self.reply('220 2.0.0 Ready to start TLS')
+        self.flush()
+        self.connection = context.wrap_socket(self.connection, server_side=True)
+        self.buffer = b''
+        self.tls = True
+        self.server.sink.count('starttls')
+
+    def smtp_AUTH(self, arg):
+        mechanism, _, initial = arg.partition(' ')
+        mechanism = mechanism.upper()
+        if mechanism == 'PLAIN' and not initial:
+            self.reply('334 ')
+            initial = self.readline().strip()
+        elif mechanism == 'LOGIN':
+            self.reply('334 ' + base64.b64encode(b'Username:').decode())
+            self.readline()
+            self.reply('334 ' + base64.b64encode(b'Password:').decode())
+            self.readline()
+        elif mechanism != 'PLAIN':
+            self.reply('504 5.5.4 Unrecognized authentication type')
+            return
+        self.server.sink.count('auth')
+        self.reply('235 2.7.0 Authentication successful')
+
+    def smtp_MAIL(self, arg):
+        self.mail_from = arg
+        self.rcpt_to = []
+        self.bdat = None
+        self.reply('250 2.1.0 OK')
+
+    def smtp_RCPT(self, arg):
+        sink = self.server.sink
+        roll = sink.random.random()
+        if roll < sink.reject_rate:
+            sink.count('rejected')
+            self.reply('550 5.1.1 Mailbox unavailable')
+        elif roll < sink.reject_rate + sink.error_rate:
+            sink.count('deferred')
+            self.reply('451 4.3.0 Try again later')
+        else:
+            self.rcpt_to.append(arg)
+            self.reply('250 2.1.5 OK')
+
+    def smtp_DATA(self, arg):
+        if not self.rcpt_to:
+            self.reply('503 5.5.1 No valid recipients')
+            return
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        size = 0
+        chunks = [] if self.server.sink.keep_messages else None
+        while True:
+            line = self.readline()
+            if not line:
+                return False
+            if line == b'.\r\n':
+                break
+            size += len(line)
+            if chunks is not None:
+                chunks.append(line[1:] if line.startswith(b'.') else line)
+        self.deliver(size, b''.join(chunks) if chunks is not None else None)
+        self.reply('250 2.0.0 Queued')
+
+    def smtp_BDAT(self, arg):
+        sink = self.server.sink
+        size, _, last = arg.partition(' ')
+        try:
+            size = int(size)
+        except ValueError:
+            self.reply('501 5.5.4 Syntax: BDAT <size> [LAST]')
+            return
+        # O segmento é consumido mesmo quando vai ser recusado
+        data = self.read(size)
+        if len(data) < size:
+            return False
+        sink.count('bdat_chunks')
+        if 'CHUNKING' not in sink.extensions or not self.rcpt_to:
+            self.bdat = None
+            self.reply('503 5.5.1 No valid recipients')
+            return
+        if self.bdat is None:
+            self.bdat = [0, [] if sink.keep_messages else None]
+        self.bdat[0] += size
+        if self.bdat[1] is not None:
+            self.bdat[1].append(data)
+        if last.strip().upper() != 'LAST':
+            self.reply('250 2.0.0 %d octets received' % size)
+            return
+        size, chunks = self.bdat
+        self.bdat = None
+        self.deliver(size, b''.join(chunks) if chunks is not None else None)
+        self.reply('250 2.0.0 Queued')
+
+    def deliver(self, size, data):
+        sink = self.server.sink
+        sink.count('messages')
+        sink.count('message_bytes', size)
+        sink.count('recipients', len(self.rcpt_to))
+        if data is not None:
+            sink.store(self.mail_from, list(self.rcpt_to), data)
+        self.mail_from = None
+        self.rcpt_to = []
+
+    def smtp_RSET(self, arg):
+        self.mail_from = None
+        self.rcpt_to = []
+        self.bdat = None
+        self.reply('250 2.0.0 OK')
+
+    def smtp_NOOP(self, arg):
+        self.reply('250 2.0.0 OK')
+
+    def smtp_QUIT(self, arg):
+        self.reply('221 2.0.0 Bye')
+        return False
+
+
+class SinkServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SMTPSink(object):
+    """Threaded SMTP server that accepts and discards (or keeps) messages."""
+
+    handler_class = SinkHandler
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 reject_rate=0.0, starttls=False, certfile=None, keyfile=None,
+                 keep_messages=False, max_size=100 * 1024 * 1024, seed=None,
+                 hostname='sink.local', on_message=None, extensions=EXTENSIONS):
+        self.address = (host, port)
+        self.extensions = tuple(name.upper() for name in extensions)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.keep_messages = keep_messages or on_message is not None
+        self.max_size = max_size
+        self.hostname = hostname
+        self.on_message = on_message
+        self.random = random.Random(seed)
+        self.messages = []
+        self.ssl_context = None
+        if starttls:
+            if certfile is None:
+                certfile, keyfile = make_self_signed_cert()
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self._counters = {}
+        self._sessions = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def session_started(self):
+        # peak_sessions: maior número de conexões abertas ao mesmo tempo
+        with self._lock:
+            self._sessions += 1
+            self._counters['peak_sessions'] = max(self._counters.get('peak_sessions', 0),
+                                                  self._sessions)
+
+    def session_ended(self):
+        with self._lock:
+            self._sessions -= 1
+
+    def store(self, mail_from, rcpt_to, data):
+        if self.on_message is not None:
+            self.on_message(mail_from, rcpt_to, data)
+        else:
+            with self._lock:
+                self.messages.append((mail_from, rcpt_to, data))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def start(self):
+        self._server = SinkServer(self.address, self.handler_class)
+        self._server.sink = self
+        threading.Thread(target=self._server.serve_forever, name='smtp-sink',
+                         daemon=True).start()
+        return self._server.server_address[1]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
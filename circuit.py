@@ -0,0 +1,245 @@
+"""
+Circuit breakers for SMTP relays.
+
+Every relay (server and port, which also covers the MX hosts of direct
+delivery) has a breaker fed with the outcome and latency of each send over
+a rolling window of ``window`` seconds. It opens after
+``failure_threshold`` consecutive failures, or when the failures or slow
+sends (over ``slow_call`` seconds) reach their rate among at least
+``min_calls`` sends. While open, sends are rerouted to the ``failover``
+relay of the SMTP_CONFIGS entry, or refused at once with ``CircuitOpen``
+instead of waiting for the socket timeout. After ``open_timeout`` seconds
+one probe send is let through (half-open): success closes the circuit,
+failure opens it again for twice as long, up to ``max_open_timeout``.
+
+Only signs of an unhealthy relay count as failures: network errors,
+dropped connections and 421 replies. Any other reply means the relay is
+up; sends that never reached it (rate limit, pool timeout) are ignored.
+"""
+
+import smtplib
+import threading
+import time
+from collections import deque
+from transport import transports
+
+
+class CircuitOpen(Exception):
+    """A send refused without connecting because the relay's circuit is open."""
+
+    def __init__(self, relay, retry_in):
+        Exception.__init__(self, 'Circuito aberto para %s; nova tentativa em %.0fs' % (relay, retry_in))
+        self.relay = relay
+        self.retry_in = retry_in
+
+
+def relay_name(transport):
+    return '%s:%s' % (transport.server, transport.port)
+
+
+def send_verdict(error):
+    """'failure', 'success' or None (the send did not reach the relay)."""
+    if error is None:
+        return 'success'
+    # SMTPException herda de OSError: as respostas do relay são tratadas antes
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return 'failure'
+    if isinstance(error, smtplib.SMTPResponseException):
+        # Só o 421 indica relay indisponível; outras respostas (550, 535, 554...)
+        # provam que ele está de pé
+        return 'failure' if error.smtp_code == 421 else 'success'
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = set(code for code, _ in error.recipients.values())
+        return 'failure' if codes == {421} else 'success'
+    if isinstance(error, smtplib.SMTPException):
+        # O relay respondeu de alguma forma: está de pé
+        return 'success'
+    if isinstance(error, OSError):
+        # Erros de rede, socket.timeout incluído
+        return 'failure'
+    return None
+
+
+class CircuitBreaker(object):
+    """Closed / open / half-open state of one relay."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, window=60, min_calls=20, error_rate=0.5,
+                 slow_call=10.0, slow_rate=0.5, open_timeout=30, max_open_timeout=600, probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.probes = probes
+        self.state = self.CLOSED
+        # (instante, falhou, lento) dos envios dentro da janela
+        self.calls = deque()
+        self.consecutive_failures = 0
+        self.current_timeout = open_timeout
+        self.opened_at = None
+        self.probing = 0
+        self.trips = 0
+        self.rejected = 0
+        self.reason = None
+
+    def retry_in(self, now):
+        return max(0.0, self.opened_at + self.current_timeout - now) if self.opened_at else 0.0
+
+    def allow(self, now):
+        """Whether a send may go to the relay; takes a probe slot when half-open."""
+        if self.state == self.OPEN:
+            if now < self.opened_at + self.current_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probing = 0
+        if self.state == self.HALF_OPEN:
+            if self.probing >= self.probes:
+                return False
+            self.probing += 1
+        return True
+
+    def record(self, now, verdict, elapsed):
+        if self.state == self.HALF_OPEN:
+            self.probing = max(0, self.probing - 1)
+            if verdict == 'failure':
+                self._open(now, 'falha na sondagem', self.current_timeout * 2)
+            elif verdict == 'success':
+                self._close()
+            return
+        if self.state == self.OPEN or verdict is None:
+            # Envio iniciado antes de o circuito abrir, ou que nem chegou ao relay
+            return
+        failed = verdict == 'failure'
+        self.calls.append((now, failed, elapsed >= self.slow_call))
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+        self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+        if self.consecutive_failures >= self.failure_threshold:
+            self._open(now, '%d falhas seguidas' % self.consecutive_failures, self.open_timeout)
+            return
+        if len(self.calls) >= self.min_calls:
+            failures = sum(1 for call in self.calls if call[1]) / len(self.calls)
+            slow = sum(1 for call in self.calls if call[2]) / len(self.calls)
+            if failures >= self.error_rate:
+                self._open(now, 'taxa de falhas %.0f%%' % (failures * 100), self.open_timeout)
+            elif slow >= self.slow_rate:
+                self._open(now, 'taxa de envios lentos %.0f%%' % (slow * 100), self.open_timeout)
+
+    def _open(self, now, reason, timeout):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.current_timeout = min(timeout, self.max_open_timeout)
+        self.reason = reason
+        self.trips += 1
+        self.calls.clear()
+        self.consecutive_failures = 0
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.current_timeout = self.open_timeout
+        self.reason = None
+
+    def snapshot(self, now):
+        calls = len(self.calls)
+        return {
+            'state': self.state,
+            'reason': self.reason,
+            'retry_in': round(self.retry_in(now), 1) if self.state == self.OPEN else None,
+            'calls': calls,
+            'failure_rate': round(sum(1 for call in self.calls if call[1]) / calls, 3) if calls else 0.0,
+            'slow_rate': round(sum(1 for call in self.calls if call[2]) / calls, 3) if calls else 0.0,
+            'consecutive_failures': self.consecutive_failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+class CircuitBreakers(object):
+    """Process-wide breakers, one per relay, plus the failover routing."""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.settings = {}
+        self.rerouted = 0
+        self._breakers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CIRCUIT_BREAKER_ENABLED', self.enabled)
+        self.settings = {
+            'failure_threshold': app.config.get('CIRCUIT_FAILURE_THRESHOLD', 5),
+            'window': app.config.get('CIRCUIT_WINDOW', 60),
+            'min_calls': app.config.get('CIRCUIT_MIN_CALLS', 20),
+            'error_rate': app.config.get('CIRCUIT_ERROR_RATE', 0.5),
+            'slow_call': app.config.get('CIRCUIT_SLOW_CALL', 10.0),
+            'slow_rate': app.config.get('CIRCUIT_SLOW_RATE', 0.5),
+            'open_timeout': app.config.get('CIRCUIT_OPEN_TIMEOUT', 30),
+            'max_open_timeout': app.config.get('CIRCUIT_MAX_OPEN_TIMEOUT', 600),
+        }
+        self.reset()
+        app.extensions['circuit_breakers'] = self
+
+    def _breaker(self, transport):
+        name = relay_name(transport)
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, **self.settings)
+        return breaker
+
+    def route(self, transport):
+        """The transport to send through: ``transport``, its failover or CircuitOpen.
+
+        Direct-delivery transports are not rerouted: the next MX of the
+        domain is their failover (see mta.py).
+        """
+        if not self.enabled:
+            return transport
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breaker(transport)
+            if breaker.allow(now):
+                return transport
+            breaker.rejected += 1
+            retry_in = breaker.retry_in(now)
+        failover = None if transport.direct else transports.failover(transport)
+        if failover is not None:
+            with self._lock:
+                if self._breaker(failover).allow(now):
+                    self.rerouted += 1
+                    return failover
+        raise CircuitOpen(relay_name(transport), retry_in)
+
+    def record(self, transport, timing, error=None):
+        """Feed the outcome of a send that went through ``route``."""
+        if not self.enabled:
+            return
+        # Latência do relay, sem a espera pelo governor e pelo pool
+        elapsed = timing.total - timing.phases.get('governor', 0.0) - timing.phases.get('pool_wait', 0.0)
+        with self._lock:
+            self._breaker(transport).record(time.monotonic(), send_verdict(error), elapsed)
+
+    def reset(self):
+        with self._lock:
+            self._breakers = {}
+            self.rerouted = 0
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'rerouted': self.rerouted,
+                'relays': {name: breaker.snapshot(now) for name, breaker in self._breakers.items()},
+            }
+
+
+breakers = CircuitBreakers()
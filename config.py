@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 import dotenv
 
@@ -12,21 +13,132 @@ class Config:
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
     
     SQLALCHEMY_DATABASE_URI = 'sqlite:///users.db'
+    # 'production': WAL, pragmas ajustados e pool para várias threads; 'default': padrão do SQLite
+    SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'production')
     SMTP_CONFIGS = {
         'gmail.com': {
             'server': 'smtp.gmail.com',
             'port': 587,
-            'use_tls': True
+            'use_tls': True,
+            'max_recipients': 100,   # RCPT por transação; listas maiores são divididas
+            # mensagens/segundo; reduzido automaticamente em respostas 421/454
+            'rate_limits': {
+                'provider': {'rate': 10, 'burst': 20},
+                'mailbox': {'rate': 1, 'burst': 5}
+            }
         },
         'default': {
             'server': 'smtp.zoho.com',
             'port': 587,
-            'use_tls': True
+            'use_tls': True,
+            # 'failover': 'contingencia',   # entrada usada enquanto o circuito deste relay estiver aberto
+            'rate_limits': {
+                'provider': {'rate': 10, 'burst': 20},
+                'mailbox': {'rate': 1, 'burst': 5}
+            }
         }
     }
     MAIL_SERVER = SMTP_CONFIGS['default']['server']
     MAIL_PORT = SMTP_CONFIGS['default']['port']
     MAIL_USE_TLS = SMTP_CONFIGS['default']['use_tls']
+
+    # Pool de conexões SMTP autenticadas, por (servidor, porta, usuário)
+    SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 4))
+    SMTP_POOL_IDLE_TIMEOUT = int(os.getenv('SMTP_POOL_IDLE_TIMEOUT', 60))
+    SMTP_POOL_HEALTHCHECK_INTERVAL = 5
+    SMTP_TIMEOUT = 30
+    SMTP_GOVERNOR_MAX_WAIT = 10   # acima disso a mensagem volta para a outbox
+    SMTP_SLOW_SEND_THRESHOLD = float(os.getenv('SMTP_SLOW_SEND_THRESHOLD', 5))  # segundos; envios mais lentos são logados
+    # PIPELINING, CHUNKING (BDAT), 8BITMIME e SMTPUTF8 são usados quando o relay os anuncia;
+    # extensões listadas aqui são ignoradas (ex.: SMTP_DISABLED_EXTENSIONS=chunking,pipelining)
+    SMTP_DISABLED_EXTENSIONS = tuple(name.strip().lower()
+                                     for name in os.getenv('SMTP_DISABLED_EXTENSIONS', '').split(',')
+                                     if name.strip())
+    SMTP_BDAT_CHUNK_SIZE = 128 * 1024
+    # Destinatários por transação quando SMTP_CONFIGS não define max_recipients;
+    # as transações de uma mesma mensagem são enviadas em paralelo
+    SMTP_MAX_RECIPIENTS = int(os.getenv('SMTP_MAX_RECIPIENTS', 100))
+    SMTP_ENVELOPE_WORKERS = 8
+    SMTP_HELO_HOSTNAME = os.getenv('SMTP_HELO_HOSTNAME')   # nome no EHLO; padrão: FQDN da máquina
+
+    # Circuit breaker por relay (circuit.py); com o circuito aberto o envio vai para o relay
+    # 'failover' da entrada em SMTP_CONFIGS, ou falha na hora e volta para a outbox
+    CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))   # falhas seguidas
+    CIRCUIT_WINDOW = 60           # segundos da janela de taxas
+    CIRCUIT_MIN_CALLS = 20        # envios na janela antes de avaliar as taxas
+    CIRCUIT_ERROR_RATE = 0.5
+    CIRCUIT_SLOW_CALL = 10.0      # segundos; envios mais lentos contam na taxa de lentidão
+    CIRCUIT_SLOW_RATE = 0.5
+    CIRCUIT_OPEN_TIMEOUT = int(os.getenv('CIRCUIT_OPEN_TIMEOUT', 30))   # segundos até a sondagem
+    CIRCUIT_MAX_OPEN_TIMEOUT = 600   # dobra a cada sondagem que falha, até este limite
+
+    # Entrega direta nos MX (mta.py): ativada por domínio remetente com 'direct': True em
+    # SMTP_CONFIGS, ex. 'meudominio.com.br': {'direct': True, 'rate_limits': {...}}
+    MTA_MX_PORT = int(os.getenv('MTA_MX_PORT', 25))
+    MTA_DOMAIN_CONCURRENCY = int(os.getenv('MTA_DOMAIN_CONCURRENCY', 4))   # transações simultâneas por domínio
+    MTA_WORKERS = int(os.getenv('MTA_WORKERS', 16))
+    MTA_NAMESERVERS = [ns.strip() for ns in os.getenv('MTA_NAMESERVERS', '').split(',')
+                       if ns.strip()] or None    # padrão: /etc/resolv.conf
+    MTA_DNS_TIMEOUT = 5.0
+    MTA_DNS_MIN_TTL = 30          # segundos; limites aplicados ao TTL dos registros MX
+    MTA_DNS_MAX_TTL = 3600
+    MTA_DNS_ERROR_TTL = 30        # falhas temporárias de DNS
+    # Tabela fixa domínio -> ['host:porta', ...] no lugar do DNS (testes com servidores locais)
+    MTA_STATIC_MX = None
+
+    # Cache api_key -> projeto (segundos; entradas negativas = api_key inexistente)
+    PROJECT_CACHE_SIZE = int(os.getenv('PROJECT_CACHE_SIZE', 1024))
+    PROJECT_CACHE_TTL = int(os.getenv('PROJECT_CACHE_TTL', 60))
+    PROJECT_CACHE_NEGATIVE_TTL = int(os.getenv('PROJECT_CACHE_NEGATIVE_TTL', 10))
+
+    # Paginação de /api/users e /api/projects (?limit= acima do máximo é reduzido)
+    PAGE_SIZE_DEFAULT = 100
+    PAGE_SIZE_MAX = 1000
+
+    # Consulta de verificação em lote (/api/check-verification/batch)
+    VERIFICATION_BATCH_MAX = 5000
+
+    # Exportação em streaming (/api/users/export): linhas lidas do cursor por lote
+    EXPORT_BATCH_SIZE = 1000
+
+    # Envio assíncrono via outbox (/api/send-custom-email?async=1)
+    SENDER_POOL_SIZE = int(os.getenv('SENDER_POOL_SIZE', 8))
+    JOB_RETENTION = 3600
+    OUTBOX_WORKER_ENABLED = os.getenv('OUTBOX_WORKER_ENABLED', 'true').lower() == 'true'
+    OUTBOX_BATCH_SIZE = 50
+    OUTBOX_POLL_INTERVAL = 1.0
+    OUTBOX_MAX_ATTEMPTS = 8
+    OUTBOX_BACKOFF_BASE = 30      # segundos, dobra a cada tentativa
+    OUTBOX_BACKOFF_MAX = 3600
+    OUTBOX_LEASE = 300            # segundos até uma entrega travada voltar à fila
+
+    # Envio em massa (/api/send-bulk, NDJSON)
+    BULK_COMMIT_SIZE = 500
+    BULK_MAX_LINE_BYTES = 10 * 1024 * 1024
+
+    # Registro em lote (/api/register/batch): endereços por INSERT multi-linha e commit
+    REGISTER_BATCH_CHUNK_SIZE = 500
+
+    # Anexos enviados por upload são gravados aqui até a entrega
+    SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'smtp_spool'))
+
+    # SMTP ingress (smtp_ingress.py): AUTH PLAIN com a api_key do projeto como usuário
+    SMTP_INGRESS_ENABLED = os.getenv('SMTP_INGRESS_ENABLED', 'false').lower() == 'true'
+    SMTP_INGRESS_HOST = os.getenv('SMTP_INGRESS_HOST', '127.0.0.1')
+    SMTP_INGRESS_PORT = int(os.getenv('SMTP_INGRESS_PORT', 2525))
+    SMTP_INGRESS_HOSTNAME = os.getenv('SMTP_INGRESS_HOSTNAME')
+    SMTP_INGRESS_TLS_CERT = os.getenv('SMTP_INGRESS_TLS_CERT')   # habilita STARTTLS e o exige para AUTH
+    SMTP_INGRESS_TLS_KEY = os.getenv('SMTP_INGRESS_TLS_KEY')
+    SMTP_INGRESS_MAX_CONNECTIONS = int(os.getenv('SMTP_INGRESS_MAX_CONNECTIONS', 10000))
+    SMTP_INGRESS_MAX_MESSAGE_SIZE = 25 * 1024 * 1024
+    SMTP_INGRESS_MAX_RECIPIENTS = 100
+    SMTP_INGRESS_IDLE_TIMEOUT = 300     # segundos sem comando até fechar a conexão
+    SMTP_INGRESS_DATA_TIMEOUT = 600
+    SMTP_INGRESS_WORKERS = 4            # threads para consultas ao banco
+
+    # Mala direta (/api/send-merge): destinatários por linha da outbox
+    MERGE_CHUNK_SIZE = 100
     CORS_RESOURCES = {
         r"/api/*": {
             "origins": ["*"],
@@ -0,0 +1,198 @@
+"""
+Envelope planning for messages with many recipients.
+
+``plan_envelopes`` merges to/cc/bcc into one list of distinct addresses
+(compared case-insensitively, first spelling kept) and splits it into
+envelopes no larger than the relay's RCPT limit (``max_recipients`` of the
+transport). ``EnvelopeSender.send`` delivers the same message body once per
+envelope, in parallel over pooled sessions, and returns a
+``DeliveryReport`` with the outcome of every recipient, so one refused
+address or envelope does not fail the others.
+"""
+
+import math
+import smtplib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+from flask import current_app
+from models import db
+from smtp_pool import smtp_pool, smtp_error_code, is_transient_error
+
+RecipientResult = namedtuple('RecipientResult', ['status', 'code', 'message'])
+
+
+def plan_envelopes(addresses, max_recipients=None):
+    """Return the distinct addresses split into balanced envelopes.
+
+    250 addresses with a limit of 100 become three envelopes of 84/83/83,
+    so parallel transactions finish together.
+    """
+    seen = set()
+    unique = []
+    for address in addresses:
+        plain = parseaddr(address)[1] or address
+        if plain.lower() not in seen:
+            seen.add(plain.lower())
+            unique.append(plain)
+    if not unique:
+        return []
+    if not max_recipients or len(unique) <= max_recipients:
+        return [unique]
+    count = math.ceil(len(unique) / max_recipients)
+    size, extra = divmod(len(unique), count)
+    envelopes = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        envelopes.append(unique[start:end])
+        start = end
+    return envelopes
+
+
+def commit_counters():
+    """Commit the current session, which writes the pending send counters (stats.record_send)."""
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Erro ao gravar contadores de envio: {str(e)}")
+
+
+def call_in_app_context(app, fn, *args):
+    """Run ``fn`` on a worker thread inside an app context, then commit_counters."""
+    with app.app_context():
+        result = fn(*args)
+        commit_counters()
+        return result
+
+
+def _reply_text(reply):
+    return reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else str(reply)
+
+
+class DeliveryReport(object):
+    """Per-recipient outcome of a message sent over one or more envelopes.
+
+    Each recipient ends up ``sent``, ``deferred`` (4xx or network failure,
+    worth retrying) or ``refused`` (permanent).
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = []
+
+    def record(self, envelope, refused=None, error=None):
+        """Record one envelope: its refused recipients or the error that ended it."""
+        refused = dict(refused or {})
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            # Cada destinatário recusado tem o seu próprio código
+            refused.update(error.recipients)
+        if error is not None:
+            self.errors.append(error)
+        for address in envelope:
+            if address in refused:
+                code, reply = refused[address]
+                status = 'deferred' if 400 <= code < 500 else 'refused'
+                self.results[address] = RecipientResult(status, code, _reply_text(reply))
+            elif error is not None:
+                # Sem resposta própria: vale o erro do envelope (ex.: 421 no meio dos RCPT)
+                status = 'deferred' if is_transient_error(error) else 'refused'
+                self.results[address] = RecipientResult(status, smtp_error_code(error), str(error))
+            else:
+                self.results[address] = RecipientResult('sent', 250, None)
+
+    def _with_status(self, status):
+        return [address for address, result in self.results.items() if result.status == status]
+
+    @property
+    def sent(self):
+        return self._with_status('sent')
+
+    @property
+    def deferred(self):
+        return self._with_status('deferred')
+
+    @property
+    def failed(self):
+        return {address: result for address, result in self.results.items()
+                if result.status != 'sent'}
+
+    @property
+    def error(self):
+        """The error to raise when nothing was sent (a transient one if any)."""
+        for error in self.errors:
+            if is_transient_error(error):
+                return error
+        return self.errors[0] if self.errors else None
+
+    def raise_if_nothing_sent(self):
+        if self.results and not self.sent:
+            raise self.error
+
+    def summary(self, limit=1000):
+        return '; '.join('%s: %s %s' % (address, result.code, result.message)
+                         for address, result in self.failed.items())[:limit]
+
+    def as_dict(self):
+        return {
+            'sent': len(self.sent),
+            'failed': {address: result._asdict() for address, result in self.failed.items()},
+        }
+
+
+class EnvelopeSender(object):
+    """Sends the envelopes of a message concurrently over the SMTP pool."""
+
+    def __init__(self, app=None):
+        self.max_workers = 8
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_workers = app.config.get('SMTP_ENVELOPE_WORKERS', self.max_workers)
+        app.extensions['envelopes'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='envelope')
+            return self._executor
+
+    def send(self, transport, from_addr, addresses, body, mail_options=(), rcpt_options=()):
+        """Send ``body`` to ``addresses`` and return the DeliveryReport.
+
+        ``body`` is anything ``smtp_pool.sendmail`` accepts and must be
+        reusable: it is sent once per envelope. A single envelope is sent
+        on the calling thread; more are spread over the executor (see
+        ``call_in_app_context``).
+        """
+        report = DeliveryReport()
+        envelopes = plan_envelopes(addresses, transport.max_recipients)
+        if len(envelopes) == 1:
+            report.record(envelopes[0], *self._sendmail(transport, from_addr, envelopes[0], body,
+                                                        mail_options, rcpt_options))
+            return report
+
+        app = current_app._get_current_object()
+        futures = [self._get_executor().submit(call_in_app_context, app, self._sendmail, transport,
+                                               from_addr, envelope, body, mail_options,
+                                               rcpt_options)
+                   for envelope in envelopes]
+        for envelope, future in zip(envelopes, futures):
+            report.record(envelope, *future.result())
+        return report
+
+    def _sendmail(self, transport, from_addr, envelope, body, mail_options, rcpt_options):
+        try:
+            return smtp_pool.sendmail(transport, from_addr, envelope, body,
+                                      mail_options, rcpt_options), None
+        except Exception as e:
+            return None, e
+
+
+envelopes = EnvelopeSender()
@@ -0,0 +1,86 @@
+"""
+Streaming export of users and their verification status.
+
+``export_rows`` joins ``User``, ``user_projects`` and ``VerificationStatus``
+and reads the result with ``yield_per``: rows come from the cursor in fixed
+size batches as plain tuples, never entering the session's identity map.
+``iter_ndjson`` and ``iter_csv`` turn each batch into one chunk of the
+response, so memory stays flat however many users the project has.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import select, and_, func
+from models import db, User, VerificationStatus, user_projects
+
+EXPORT_COLUMNS = ('user_id', 'email', 'project_id', 'verified', 'verified_at', 'created_at')
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_statement(project_id=None, verified=None):
+    """SELECT of one row per (user, project), optionally filtered."""
+    link = user_projects.c
+    is_verified = func.coalesce(VerificationStatus.verified, False)
+    stmt = (
+        select(User.id.label('user_id'), User.email, link.project_id,
+               is_verified.label('verified'), VerificationStatus.verified_at,
+               User.created_at)
+        .join(user_projects, link.user_id == User.id)
+        # outer join: usuário vinculado sem status conta como não verificado
+        .outerjoin(VerificationStatus, and_(VerificationStatus.user_id == link.user_id,
+                                            VerificationStatus.project_id == link.project_id))
+        .order_by(link.project_id, link.user_id)
+    )
+    if project_id is not None:
+        stmt = stmt.where(link.project_id == project_id)
+    if verified is not None:
+        stmt = stmt.where(is_verified == verified)
+    return stmt
+
+
+def export_rows(project_id=None, verified=None, batch_size=1000):
+    """Yield lists of at most ``batch_size`` rows from a streaming cursor."""
+    result = db.session.execute(export_statement(project_id, verified),
+                                execution_options={'yield_per': batch_size})
+    try:
+        for partition in result.partitions():
+            yield partition
+    finally:
+        result.close()
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def iter_ndjson(batches):
+    for rows in batches:
+        yield ''.join(json.dumps({name: _value(value) for name, value in zip(EXPORT_COLUMNS, row)})
+                      + '\n' for row in rows)
+
+
+def iter_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows([_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        # Reaproveita o buffer: cada lote sai e é descartado
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+SERIALIZERS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+}
@@ -0,0 +1,145 @@
+"""
+Send-rate governor for SMTP relays.
+
+Every send takes a token from two buckets: one per provider (the
+``SMTP_CONFIGS`` entry) and one per project mailbox. Rates come from the
+entry's ``rate_limits`` and adapt: when the relay answers with a throttling
+reply the bucket rate is halved, and each successful send gives back a
+small fraction of the configured rate (AIMD).
+"""
+
+import threading
+import time
+
+# Respostas usadas por Gmail/Zoho para limitar a taxa de envio
+THROTTLE_CODES = (421, 454)
+
+
+class RateLimited(Exception):
+    """The send would have to wait longer than the governor allows."""
+
+    def __init__(self, key, wait):
+        Exception.__init__(self, 'Limite de envio atingido para %s, aguarde %.1fs' % (key, wait))
+        self.key = key
+        self.wait = wait
+
+
+def is_throttle_reply(code, message=b''):
+    if code in THROTTLE_CODES:
+        return True
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    # Códigos estendidos 4.7.x indicam política/limite de taxa
+    return code is not None and 400 <= code < 500 and '4.7.' in (message or '')
+
+
+class TokenBucket(object):
+    """Token bucket whose refill rate can be lowered and restored."""
+
+    def __init__(self, rate, burst, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate if min_rate is not None else self.max_rate / 20
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until one token is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        # Pode ficar negativo: o chamador já dorme o tempo de espera calculado
+        self.tokens -= 1
+
+    def throttle(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateGovernor(object):
+    """Paces sends per provider and per mailbox using token buckets."""
+
+    def __init__(self, app=None):
+        self.smtp_configs = {}
+        self.max_wait = 10
+        self._buckets = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.smtp_configs = app.config['SMTP_CONFIGS']
+        self.max_wait = app.config.get('SMTP_GOVERNOR_MAX_WAIT', self.max_wait)
+        self._buckets = {}
+        app.extensions['rate_governor'] = self
+
+    def _bucket(self, key, limits):
+        bucket = self._buckets.get(key)
+        if bucket is None and limits:
+            bucket = self._buckets[key] = TokenBucket(limits['rate'], limits.get('burst', 1))
+        return bucket
+
+    def buckets_for(self, transport):
+        """Provider and mailbox buckets that apply to a transport."""
+        limits = self.smtp_configs.get(transport.provider, {}).get('rate_limits') or {}
+        buckets = [self._bucket(('provider', transport.provider), limits.get('provider')),
+                   self._bucket(('mailbox', transport.provider, transport.username),
+                                limits.get('mailbox'))]
+        return [bucket for bucket in buckets if bucket is not None]
+
+    def acquire(self, transport):
+        """Block until the transport may send one message.
+
+        Raises RateLimited instead of waiting longer than ``max_wait``, so
+        the caller can put the message back in the outbox.
+        """
+        with self._lock:
+            buckets = self.buckets_for(transport)
+            if not buckets:
+                return 0.0
+            now = time.monotonic()
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait > self.max_wait:
+                raise RateLimited('%s/%s' % (transport.provider, transport.username), wait)
+            for bucket in buckets:
+                bucket.take()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def report(self, transport, code=None, message=b''):
+        """Adapt the rates after a send: halve on throttling, else recover."""
+        with self._lock:
+            buckets = self.buckets_for(transport)
+            throttled = is_throttle_reply(code, message)
+            for bucket in buckets:
+                if throttled:
+                    bucket.throttle()
+                else:
+                    bucket.recover()
+        return throttled
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                '/'.join(str(part or '') for part in key): {
+                    'rate': round(bucket.rate, 3),
+                    'max_rate': bucket.max_rate,
+                    'tokens': round(bucket.tokens, 2),
+                }
+                for key, bucket in self._buckets.items()
+            }
+
+
+governor = RateGovernor()
@@ -0,0 +1,373 @@
+"""
+Background delivery of custom emails through the durable outbox.
+
+Messages are serialized into ``Outbox`` rows. A dispatcher thread claims
+due rows in batches and hands them to a pool of sender threads; transient
+failures are retried with jittered exponential backoff and permanent ones
+are dead-lettered.
+"""
+
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload
+from models import db, Outbox, MailTemplate
+from mailmerge import MessageTemplate, send_merge, template_cache
+from smtp_pool import is_transient_error
+from governor import RateLimited
+from circuit import CircuitOpen
+from attachments import FileAttachment, discard_attachments
+from utils import send_custom_email, send_raw_message, send_verification_email, serializer
+
+
+def serialize_message(message):
+    """Encode send_custom_email kwargs as JSON (attachments as base64)."""
+    data = dict(message)
+    if 'attachments' in data:
+        attachments = []
+        for filename, content_type, content in data['attachments'] or []:
+            if isinstance(content, FileAttachment):
+                # Anexos em disco são referenciados, nunca copiados para o banco
+                content = {'spool': content.path, 'size': content.size}
+            elif isinstance(content, bytes):
+                content = base64.b64encode(content).decode('ascii')
+            attachments.append([filename, content_type, content])
+        data['attachments'] = attachments
+    return json.dumps(data)
+
+
+def deserialize_message(payload):
+    data = json.loads(payload)
+    if 'attachments' in data:
+        data['attachments'] = [
+            (filename, content_type,
+             FileAttachment(content['spool'], content['size']) if isinstance(content, dict) else content)
+            for filename, content_type, content in data['attachments'] or []
+        ]
+    return data
+
+
+def postponement(errors):
+    """Seconds to wait when every error is a send that never reached the relay.
+
+    RateLimited (governor) and CircuitOpen (relay down) only say when to try
+    again; they must not use up the message's attempts. Returns None when
+    any other error is among ``errors``.
+    """
+    errors = list(errors)
+    if not errors or not all(isinstance(e, (RateLimited, CircuitOpen)) for e in errors):
+        return None
+    return max(e.wait if isinstance(e, RateLimited) else e.retry_in for e in errors)
+
+
+def load_template(template_id):
+    """Build the encoded MessageTemplate stored in a MailTemplate row."""
+    row = db.session.get(MailTemplate, template_id)
+    data = deserialize_message(row.payload)
+    data['attachments'] = [(filename, content_type, base64.b64decode(content))
+                           for filename, content_type, content in data.get('attachments', [])]
+    return MessageTemplate(**data)
+
+
+class OutboxWorker(object):
+    """Claims due outbox rows in batches and delivers them on sender threads."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.max_workers = 8
+        self.batch_size = 50
+        self.poll_interval = 1.0
+        self.max_attempts = 8
+        self.backoff_base = 30
+        self.backoff_max = 3600
+        self.lease = 300
+        self.retention = 3600
+        self._executor = None
+        self._thread = None
+        self._in_flight = 0
+        self._last_purge = 0
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config.get('SENDER_POOL_SIZE', self.max_workers)
+        self.batch_size = app.config.get('OUTBOX_BATCH_SIZE', self.batch_size)
+        self.poll_interval = app.config.get('OUTBOX_POLL_INTERVAL', self.poll_interval)
+        self.max_attempts = app.config.get('OUTBOX_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff_base = app.config.get('OUTBOX_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = app.config.get('OUTBOX_BACKOFF_MAX', self.backoff_max)
+        self.lease = app.config.get('OUTBOX_LEASE', self.lease)
+        self.retention = app.config.get('JOB_RETENTION', self.retention)
+        app.extensions['outbox_worker'] = self
+        if app.config.get('OUTBOX_WORKER_ENABLED', True):
+            # Retoma mensagens pendentes de execuções anteriores
+            app.before_request(self.start)
+
+    def backoff(self, attempts):
+        """Delay before the next attempt: exponential, capped, with jitter."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def enqueue(self, project_id, message, error=None):
+        """Persist a message in the outbox and wake the dispatcher.
+
+        ``error`` records a first delivery attempt that already failed
+        transiently, so the row is scheduled with backoff.
+        """
+        row = Outbox(project_id=project_id, payload=serialize_message(message))
+        if error is not None:
+            row.attempts = 1
+            row.last_error = str(error)[:1000]
+            row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff(1))
+        db.session.add(row)
+        db.session.commit()
+        self.wake()
+        return row
+
+    def enqueue_many(self, project_id, messages):
+        """Persist several messages with one multi-row INSERT and return their ids.
+
+        Commits the session even when ``messages`` is empty.
+        """
+        ids = []
+        if messages:
+            table = Outbox.__table__
+            ids = db.session.execute(
+                insert(table).values([{'project_id': project_id, 'payload': serialize_message(message)}
+                                      for message in messages])
+                .returning(table.c.id)
+            ).scalars().all()
+            # O RETURNING não garante a ordem, mas um único INSERT numera as
+            # linhas na ordem dos VALUES
+            ids.sort()
+        db.session.commit()
+        if ids:
+            self.wake()
+        return ids
+
+    def wake(self):
+        if self.app is not None and self.app.config.get('OUTBOX_WORKER_ENABLED', True):
+            self.start()
+            self._wakeup.set()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='sender')
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._loop, name='outbox-dispatcher',
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and wait:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            claimed = 0
+            try:
+                with self.app.app_context():
+                    claimed = self.dispatch()
+                    self._purge()
+            except Exception as e:
+                self.app.logger.error(f"Erro no processamento da outbox: {str(e)}")
+            if claimed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def dispatch(self):
+        """Claim a batch of due rows and submit them to the sender threads."""
+        with self._lock:
+            capacity = self.max_workers * 2 - self._in_flight
+        if capacity <= 0:
+            return 0
+        claimed = self.claim_due(min(self.batch_size, capacity))
+        for outbox_id, token in claimed:
+            with self._lock:
+                self._in_flight += 1
+            try:
+                self._executor.submit(self._run, outbox_id, token)
+            except RuntimeError:
+                # Interpretador encerrando: as linhas voltam à fila quando o lease expirar
+                self._stopping.set()
+                break
+        return len(claimed)
+
+    def claim_due(self, limit):
+        """Atomically lease up to ``limit`` due rows.
+
+        Rows left in ``sending`` whose lease expired (e.g. the process died
+        mid-delivery) become due again.
+        """
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        due = (db.session.query(Outbox.id)
+               .filter(Outbox.state.in_(('queued', 'sending')),
+                       Outbox.next_attempt_at <= now)
+               .order_by(Outbox.next_attempt_at)
+               .limit(limit))
+        Outbox.query.filter(
+            Outbox.id.in_(due.scalar_subquery()),
+            Outbox.state.in_(('queued', 'sending')),
+            Outbox.next_attempt_at <= now
+        ).update({
+            'state': 'sending',
+            'lease_token': token,
+            'next_attempt_at': now + timedelta(seconds=self.lease),
+            'updated_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+        return [(row.id, token) for row in
+                db.session.query(Outbox.id).filter_by(lease_token=token)]
+
+    def _run(self, outbox_id, token):
+        try:
+            with self.app.app_context():
+                self.deliver(outbox_id, token)
+        except Exception as e:
+            self.app.logger.error(f"Erro ao enviar email (outbox {outbox_id}): {str(e)}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._wakeup.set()
+
+    def deliver(self, outbox_id, token):
+        # Projeto carregado no mesmo SELECT da linha da outbox
+        row = db.session.get(Outbox, outbox_id, options=[joinedload(Outbox.project)])
+        if row is None or row.lease_token != token:
+            return
+        row.attempts += 1
+        message = {}
+        try:
+            # Payload corrompido cai no except e a linha vai para 'dead'
+            message = deserialize_message(row.payload)
+            project = row.project
+            if message.get('kind') == 'merge':
+                self._deliver_merge(row, project, message)
+            elif message.get('kind') == 'raw':
+                # Mensagem recebida pelo SMTP ingress, gravada no spool
+                report = send_raw_message(message['sender'], message['recipients'],
+                                          FileAttachment(message['spool'], message['size']),
+                                          project=project,
+                                          mail_options=message.get('mail_options'))
+                self._retry_deferred(row, message, report, 'recipients')
+            elif message.get('kind') == 'verification':
+                # Token gerado na entrega: o prazo de validade conta a partir do envio,
+                # não de quando o lote foi enfileirado
+                verification_token = serializer.dumps(
+                    {'email': message['email'], 'api_key': project.api_key}, salt='email-verification')
+                send_verification_email(message['email'], project.name, verification_token,
+                                        message['host_url'], project=project)
+            else:
+                report = send_custom_email(project=project, **message)
+                self._retry_deferred(row, message, report, 'envelope')
+        except Exception as e:
+            row.last_error = str(e)[:1000]
+            delay = postponement([e])
+            if delay is not None:
+                self._postpone(row, delay)
+            elif is_transient_error(e) and row.attempts < self.max_attempts:
+                row.state = 'queued'
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff(row.attempts))
+            else:
+                row.state = 'dead'
+            self.app.logger.error(f"Erro ao enviar email (outbox {outbox_id}, "
+                                  f"tentativa {row.attempts}, {row.state}): {str(e)}")
+        else:
+            if row.state == 'sending':
+                row.state = 'sent'
+                row.last_error = None
+        row.lease_token = None
+        # Lido antes do commit, que expira a linha
+        finished = row.state in ('sent', 'dead')
+        db.session.commit()
+        if finished:
+            discard_attachments(message.get('attachments'))
+            if message.get('kind') == 'raw':
+                FileAttachment(message['spool'], message['size']).discard()
+
+    def _retry_deferred(self, row, message, report, field):
+        """Requeue only the deferred recipients of a partially delivered message."""
+        if not report.failed:
+            return
+        row.last_error = report.summary()
+        deferred = report.deferred
+        # Adiados só pelo governor/circuito: nenhuma resposta própria do relay
+        delay = postponement(report.errors) if all(
+            report.results[address].code is None for address in deferred) else None
+        if deferred and (delay is not None or row.attempts < self.max_attempts):
+            # Quem já aceitou a mensagem não a recebe de novo
+            row.payload = serialize_message(dict(message, **{field: deferred}))
+            if delay is not None:
+                self._postpone(row, delay)
+            else:
+                row.state = 'queued'
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff(row.attempts))
+        else:
+            row.state = 'sent'
+
+    def _deliver_merge(self, row, project, message):
+        """Send a chunk of a mail merge; only transient failures are retried."""
+        template = template_cache.get(message['template_id'],
+                                      lambda: load_template(message['template_id']))
+        recipients = message['recipients']
+        failures = send_merge(template, recipients, project=project)
+        if not failures:
+            return
+
+        retry = [r for r in recipients
+                 if r['email'] in failures and is_transient_error(failures[r['email']])]
+        row.last_error = '; '.join(f"{email}: {str(error)}"
+                                   for email, error in failures.items())[:1000]
+        delay = postponement(failures[r['email']] for r in retry)
+        if retry and (delay is not None or row.attempts < self.max_attempts):
+            # Reenvia apenas os destinatários com falha temporária
+            row.payload = json.dumps(dict(message, recipients=retry))
+            if delay is not None:
+                self._postpone(row, delay)
+            else:
+                row.state = 'queued'
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff(row.attempts))
+        elif len(failures) == len(recipients):
+            row.state = 'dead'
+        else:
+            row.state = 'sent'
+
+    def _postpone(self, row, delay):
+        """Requeue after ``delay`` seconds, giving back the attempt just taken."""
+        row.attempts -= 1
+        row.state = 'queued'
+        row.next_attempt_at = datetime.utcnow() + timedelta(seconds=max(delay, self.poll_interval))
+
+    def _purge(self):
+        """Delete delivered rows older than the retention window."""
+        if time.monotonic() - self._last_purge < 60:
+            return
+        self._last_purge = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        Outbox.query.filter(Outbox.state == 'sent',
+                            Outbox.updated_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,204 @@
+"""
+Mail merge: one template, many personalized messages.
+
+``MessageTemplate`` encodes everything shared by all recipients (attachments
+and any body part without placeholders) exactly once. Per recipient only the
+headers and the parts that contain ``{{ variable }}`` placeholders are
+rendered and encoded. Text parts are encoded for the relay at hand (raw
+8-bit when it advertises 8BITMIME, see ``attachments.mime_text``), so the
+shared body is kept once per encoding.
+"""
+
+import html
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from functools import partial
+from email import policy
+from email.encoders import encode_base64
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.utils import formatdate, make_msgid
+from flask import current_app
+from flask_mail import BadHeaderError, sanitize_address, sanitize_subject
+from attachments import mime_text
+from smtp_client import EightBitBody
+from mta import sender_for
+from transport import transports
+
+PLACEHOLDER = re.compile(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
+CRLF = b'\r\n'
+
+
+def render(text, variables, escape=False):
+    """Replace {{ name }} placeholders; values are HTML-escaped when asked."""
+    def replace(match):
+        value = variables.get(match.group(1))
+        value = '' if value is None else str(value)
+        return html.escape(value) if escape else value
+    return PLACEHOLDER.sub(replace, text or '')
+
+
+def has_newline(value):
+    """Whether a header value would break into another header line (CR, LF...)."""
+    return bool(value) and value.splitlines() != [value]
+
+
+def _header(name, value):
+    return policy.SMTP.fold(name, value).encode('ascii')
+
+
+class MessageTemplate(object):
+    """Pre-encoded MIME skeleton shared by every recipient of a merge."""
+
+    def __init__(self, subject, sender, body='', html_content=None,
+                 attachments=(), reply_to=None, charset=None):
+        self.subject = subject or ''
+        self.sender = sender
+        self.body = body or ''
+        self.html_content = html_content
+        self.reply_to = reply_to or sender
+        self.charset = charset or 'utf-8'
+        self.boundary = '===============%s==' % uuid.uuid4().hex
+
+        self.envelope_from = sanitize_address(sender, self.charset)
+        self._static_headers = (_header('From', self.envelope_from)
+                                + _header('Reply-To', sanitize_address(self.reply_to, self.charset)))
+        self._static_subject = None
+        if not PLACEHOLDER.search(self.subject):
+            self._static_subject = _header('Subject', sanitize_subject(self.subject, self.charset))
+
+        # Partes sem variáveis são codificadas uma única vez (por codificação, 7 ou 8 bits)
+        self._static_body = None
+        if not PLACEHOLDER.search(self.body) and not PLACEHOLDER.search(self.html_content or ''):
+            self._static_body = {False: self._encode_body(self.body, self.html_content)}
+        self._attachments = [self._encode_attachment(*attachment) for attachment in attachments]
+
+    def _mimetext(self, text, subtype, eightbit=False):
+        return mime_text(text, subtype, self.charset, eightbit)
+
+    def _encode_body(self, body, html_content, eightbit=False):
+        if html_content:
+            part = MIMEMultipart('alternative')
+            part.attach(self._mimetext(body, 'plain', eightbit))
+            part.attach(self._mimetext(html_content, 'html', eightbit))
+        else:
+            part = self._mimetext(body, 'plain', eightbit)
+        return part.as_bytes(policy=policy.SMTP)
+
+    def _encode_attachment(self, filename, content_type, data):
+        maintype, _, subtype = content_type.partition('/')
+        if not maintype or not subtype:
+            maintype, subtype = 'application', 'octet-stream'
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(data)
+        encode_base64(part)
+        try:
+            filename.encode('ascii')
+        except UnicodeEncodeError:
+            filename = ('UTF8', '', filename)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        return part.as_bytes(policy=policy.SMTP)
+
+    def header_values(self, email, variables=None):
+        """The header values of one recipient that come from the request."""
+        variables = dict(variables or {}, email=email)
+        subject = self.subject if self._static_subject is not None else render(self.subject, variables)
+        return [email, subject, self.sender, self.reply_to]
+
+    def has_bad_headers(self, email, variables=None):
+        # Os cabeçalhos são montados à mão, sem o has_bad_headers do flask_mail
+        return any(has_newline(value) for value in self.header_values(email, variables))
+
+    def render(self, email, variables=None, eightbit=False):
+        """Return the complete message bytes for one recipient."""
+        if self.has_bad_headers(email, variables):
+            raise BadHeaderError('Quebra de linha em cabeçalho de %s' % email)
+        variables = dict(variables or {}, email=email)
+
+        headers = [self._static_headers,
+                   _header('To', sanitize_address(email, self.charset)),
+                   _header('Date', formatdate(localtime=True)),
+                   _header('Message-ID', make_msgid())]
+        if self._static_subject is not None:
+            headers.append(self._static_subject)
+        else:
+            headers.append(_header('Subject', sanitize_subject(render(self.subject, variables),
+                                                               self.charset)))
+
+        if self._static_body is not None:
+            body = self._static_body.get(eightbit)
+            if body is None:
+                body = self._static_body[eightbit] = self._encode_body(self.body, self.html_content,
+                                                                       eightbit)
+        else:
+            body = self._encode_body(render(self.body, variables),
+                                     render(self.html_content, variables, escape=True)
+                                     if self.html_content else None, eightbit)
+
+        if not self._attachments:
+            # Mensagem simples: os cabeçalhos da parte viram cabeçalhos da mensagem
+            return b''.join(headers) + body
+
+        delimiter = b'--' + self.boundary.encode('ascii')
+        chunks = headers + [
+            _header('Content-Type', 'multipart/mixed; boundary="%s"' % self.boundary),
+            b'MIME-Version: 1.0' + CRLF,
+            CRLF,
+            delimiter + CRLF, body, CRLF,
+        ]
+        for attachment in self._attachments:
+            chunks += [delimiter + CRLF, attachment, CRLF]
+        chunks.append(delimiter + b'--' + CRLF)
+        return b''.join(chunks)
+
+
+class TemplateCache(object):
+    """Small LRU of encoded templates; templates never change once stored."""
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_id, factory):
+        with self._lock:
+            template = self._items.get(template_id)
+            if template is not None:
+                self._items.move_to_end(template_id)
+                return template
+        template = factory()
+        with self._lock:
+            self._items[template_id] = template
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return template
+
+
+template_cache = TemplateCache()
+
+
+def send_merge(template, recipients, project=None):
+    """Send one personalized message per recipient.
+
+    ``recipients`` is a list of {"email": ..., "vars": {...}}. Returns a dict
+    mapping each failed address to its exception; one bad recipient does
+    not stop the others.
+    """
+    transport = transports.get(project, template.sender)
+    suppress = current_app.extensions['mail'].suppress
+    failures = {}
+    for recipient in recipients:
+        email = recipient['email']
+        try:
+            # Renderizada no envio, já sabendo se o relay aceita 8BITMIME
+            data = EightBitBody(partial(template.render, email, recipient.get('vars')))
+            if not suppress:
+                sender_for(transport).send(transport, template.envelope_from,
+                                           [sanitize_address(email, template.charset)],
+                                           data).raise_if_nothing_sent()
+        except Exception as e:
+            current_app.logger.error(f"Erro ao enviar email para {email}: {str(e)}")
+            failures[email] = e
+    return failures
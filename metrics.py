@@ -0,0 +1,179 @@
+"""
+Latency metrics for the SMTP send path.
+
+Every send carries a ``SendTiming`` through the pool and the SMTP client,
+which records how long each phase took (DNS, connect, EHLO, STARTTLS, AUTH,
+MAIL, RCPT, DATA, plus time spent waiting on the rate governor and the
+pool), the bytes written to the socket and the round trips saved by
+pipelining. When the send finishes the phases are folded into histograms
+labeled by provider and project, and the per-message breakdown is logged;
+slow or failed sends are logged at WARNING.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Limites superiores dos buckets, em segundos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class SendTiming(object):
+    """Per-message breakdown of where the send time went."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.reused = None
+        self.data_bytes = 0
+        # Bytes escritos no socket na transação (comandos + corpo)
+        self.wire_bytes = 0
+        self.round_trips = 0
+        self.rtt_saved = 0
+        self.extensions = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        result = {name: round(seconds * 1000, 2) for name, seconds in self.phases.items()}
+        result['total'] = round(self.total * 1000, 2)
+        return result
+
+    def __str__(self):
+        return ' '.join('%s=%.1fms' % item for item in self.as_dict().items())
+
+
+class Histogram(object):
+    """Fixed-bucket latency histogram (cumulative, Prometheus style)."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket that holds the q-th observation."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        buckets.append(['+Inf', self.count])
+        return {
+            'count': self.count,
+            'sum_ms': round(self.sum * 1000, 2),
+            'mean_ms': round(self.sum / self.count * 1000, 2) if self.count else 0.0,
+            'p50_ms': round(self.quantile(0.50) * 1000, 2),
+            'p90_ms': round(self.quantile(0.90) * 1000, 2),
+            'p99_ms': round(self.quantile(0.99) * 1000, 2),
+            'max_ms': round(self.max * 1000, 2),
+            'buckets': buckets,
+        }
+
+
+def empty_counters():
+    return {'sent': 0, 'failed': 0, 'reused': 0, 'wire_bytes': 0, 'round_trips': 0, 'rtt_saved': 0}
+
+
+class SMTPMetrics(object):
+    """Histograms of SMTP phase latencies by (provider, project, phase)."""
+
+    def __init__(self, app=None):
+        self.buckets = DEFAULT_BUCKETS
+        self.slow_threshold = 5.0
+        self._histograms = {}
+        self._sends = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.buckets = tuple(app.config.get('SMTP_LATENCY_BUCKETS', self.buckets))
+        self.slow_threshold = app.config.get('SMTP_SLOW_SEND_THRESHOLD', self.slow_threshold)
+        self.reset()
+        app.extensions['smtp_metrics'] = self
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._sends = {}
+
+    def record(self, transport, timing, recipients=0, error=None):
+        """Fold a finished send into the histograms and log its breakdown."""
+        total = timing.total
+        labels = (transport.provider, transport.project_id)
+        with self._lock:
+            for name, seconds in list(timing.phases.items()) + [('total', total)]:
+                histogram = self._histograms.get(labels + (name,))
+                if histogram is None:
+                    histogram = self._histograms[labels + (name,)] = Histogram(self.buckets)
+                histogram.observe(seconds)
+            counters = self._sends.setdefault(labels, empty_counters())
+            counters['failed' if error is not None else 'sent'] += 1
+            if timing.reused:
+                counters['reused'] += 1
+            counters['wire_bytes'] += timing.wire_bytes
+            counters['round_trips'] += timing.round_trips
+            counters['rtt_saved'] += timing.rtt_saved
+
+        level = logging.WARNING if error is not None or total >= self.slow_threshold else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(level, 'SMTP %s provider=%s project=%s host=%s:%s rcpt=%d bytes=%d wire=%d '
+                       'rtt=%d rtt_saved=%d ext=%s reused=%s %s%s',
+                       'falhou' if error is not None else 'enviado', transport.provider,
+                       transport.project_id, transport.server, transport.port, recipients,
+                       timing.data_bytes, timing.wire_bytes, timing.round_trips, timing.rtt_saved,
+                       ','.join(timing.extensions) or '-', timing.reused, timing,
+                       ' erro=%s' % error if error is not None else '',
+                       extra={'smtp_timing': timing.as_dict()})
+
+    def snapshot(self):
+        """Nested {provider: {project: {sends..., phases: {phase: histogram}}}}."""
+        with self._lock:
+            result = {}
+            for (provider, project_id), counters in self._sends.items():
+                result.setdefault(provider, {})[str(project_id)] = dict(counters, phases={})
+            for (provider, project_id, name), histogram in self._histograms.items():
+                entry = result.setdefault(provider, {}).setdefault(
+                    str(project_id), dict(empty_counters(), phases={}))
+                entry['phases'][name] = histogram.snapshot()
+            return result
+
+
+smtp_metrics = SMTPMetrics()
@@ -0,0 +1,123 @@
+"""
+In-place upgrade of an existing database (e.g. users.db) to the current schema.
+
+``db.create_all()`` only creates missing tables; it never adds indexes to
+tables that already exist. This script creates the missing tables, merges
+duplicate rows that would violate the new unique indexes, and then creates
+every index declared in models.py. Projects without a counters row
+(stats.py) get one, recounted from the tables. It is idempotent and runs
+in a single transaction.
+
+    python migrate_db.py
+"""
+
+from sqlalchemy import select, func, update, delete, insert, case, inspect
+from models import db, User, Project, ProjectStats, VerificationStatus, user_projects
+from stats import recount
+
+
+def merge_duplicate_users(conn):
+    """Fold users sharing an email into the oldest row; returns rows removed."""
+    users = User.__table__
+    statuses = VerificationStatus.__table__
+    duplicates = conn.execute(
+        select(users.c.email, func.min(users.c.id))
+        .group_by(users.c.email)
+        .having(func.count() > 1)
+    ).all()
+
+    removed = 0
+    for email, keeper in duplicates:
+        rows = conn.execute(select(users.c.id, users.c.verified)
+                            .where(users.c.email == email, users.c.id != keeper)).all()
+        others = [row.id for row in rows]
+        if any(row.verified for row in rows):
+            conn.execute(update(users).where(users.c.id == keeper).values(verified=True))
+
+        # Projetos dos duplicados passam para o usuário mantido, sem repetir pares
+        linked = set(conn.execute(select(user_projects.c.project_id)
+                                  .where(user_projects.c.user_id == keeper)).scalars())
+        moved = set(conn.execute(select(user_projects.c.project_id)
+                                 .where(user_projects.c.user_id.in_(others))).scalars())
+        conn.execute(delete(user_projects).where(user_projects.c.user_id.in_(others)))
+        if moved - linked:
+            conn.execute(insert(user_projects), [{'user_id': keeper, 'project_id': project_id}
+                                                 for project_id in sorted(moved - linked)])
+
+        conn.execute(update(statuses).where(statuses.c.user_id.in_(others)).values(user_id=keeper))
+        conn.execute(delete(users).where(users.c.id.in_(others)))
+        removed += len(others)
+    return removed
+
+
+def merge_duplicate_verifications(conn):
+    """Keep one status per (user, project), preferring verified, oldest first."""
+    statuses = VerificationStatus.__table__
+    duplicates = conn.execute(
+        select(statuses.c.user_id, statuses.c.project_id)
+        .group_by(statuses.c.user_id, statuses.c.project_id)
+        .having(func.count() > 1)
+    ).all()
+
+    removed = 0
+    for user_id, project_id in duplicates:
+        ids = conn.execute(
+            select(statuses.c.id)
+            .where(statuses.c.user_id == user_id, statuses.c.project_id == project_id)
+            .order_by(case((statuses.c.verified == True, 0), else_=1),  # noqa: E712
+                      statuses.c.verified_at, statuses.c.id)
+        ).scalars().all()
+        conn.execute(delete(statuses).where(statuses.c.id.in_(ids[1:])))
+        removed += len(ids) - 1
+    return removed
+
+
+def create_indexes(conn):
+    """Create every index declared in the models that does not exist yet."""
+    created = []
+    existing = {}
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if table.name not in existing:
+                existing[table.name] = {ix['name'] for ix in inspect(conn).get_indexes(table.name)}
+            if index.name not in existing[table.name]:
+                index.create(conn)
+                created.append(index.name)
+    return created
+
+
+def create_project_stats(conn):
+    """Create the counters row of projects that have none; returns rows created."""
+    table = ProjectStats.__table__
+    missing = conn.execute(
+        select(Project.__table__.c.id)
+        .where(~Project.__table__.c.id.in_(select(table.c.project_id)))
+    ).scalars().all()
+    for project_id in missing:
+        conn.execute(insert(table).values(project_id=project_id, **recount(project_id)))
+    return len(missing)
+
+
+def upgrade(engine):
+    """Bring the database behind ``engine`` up to the current schema."""
+    with engine.begin() as conn:
+        db.metadata.create_all(conn)
+        report = {
+            'merged_users': merge_duplicate_users(conn),
+            'merged_verifications': merge_duplicate_verifications(conn),
+        }
+        report['created_indexes'] = create_indexes(conn)
+        report['created_project_stats'] = create_project_stats(conn)
+    return report
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        report = upgrade(db.engine)
+    print(f"Usuários duplicados mesclados: {report['merged_users']}")
+    print(f"Status de verificação duplicados removidos: {report['merged_verifications']}")
+    print(f"Índices criados: {', '.join(report['created_indexes']) or 'nenhum'}")
+    print(f"Contadores de projeto criados: {report['created_project_stats']}")
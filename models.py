@@ -11,12 +11,18 @@ def generate_api_key(length=32):
 
 user_projects = db.Table('user_projects',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('project_id', db.Integer, db.ForeignKey('project.id'), primary_key=True)
+    db.Column('project_id', db.Integer, db.ForeignKey('project.id'), primary_key=True),
+    # Exportação por projeto, já na ordem de user_id
+    db.Index('ix_user_projects_project_user', 'project_id', 'user_id')
 )
 
 class User(db.Model):
+    # Paginação por created_at (desempate por id)
+    __table_args__ = (
+        db.Index('ix_user_created_at_id', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), nullable=False)
+    email = db.Column(db.String(120), nullable=False, unique=True, index=True)
     verified = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     projects = db.relationship('Project', secondary=user_projects, backref='users')
@@ -32,9 +38,47 @@ class Project(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class VerificationStatus(db.Model):
+    # Um status por (usuário, projeto); o índice atende às consultas de register/verify
+    __table_args__ = (
+        db.Index('ix_verification_status_user_project', 'user_id', 'project_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
     verified = db.Column(db.Boolean, default=False)
     verified_at = db.Column(db.DateTime)
     project = db.relationship('Project')
+
+class ProjectStats(db.Model):
+    # Contadores mantidos incrementalmente por stats.py, sem COUNT(*) no dashboard
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), primary_key=True)
+    registered = db.Column(db.Integer, nullable=False, default=0)
+    verified = db.Column(db.Integer, nullable=False, default=0)
+    emails_sent = db.Column(db.Integer, nullable=False, default=0)
+    emails_failed = db.Column(db.Integer, nullable=False, default=0)
+    bytes_sent = db.Column(db.BigInteger, nullable=False, default=0)
+
+class MailTemplate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    # Assunto, corpos e anexos serializados; nunca alterado após a criação
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Outbox(db.Model):
+    # Consultas do worker: linhas vencidas por estado e linhas do lease recém-obtido
+    __table_args__ = (
+        db.Index('ix_outbox_state_next_attempt', 'state', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    # queued -> sending -> sent | dead (tentativas esgotadas ou erro permanente)
+    state = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    lease_token = db.Column(db.String(32), index=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    project = db.relationship('Project')
@@ -0,0 +1,233 @@
+"""
+Direct delivery to the recipients' mail exchangers (MTA mode).
+
+A sender domain whose ``SMTP_CONFIGS`` entry has ``'direct': True`` is not
+relayed through a submission server: ``DirectDelivery.send`` groups the
+recipients by domain, looks up each domain's MX hosts (mx_resolver.py,
+cached for the record TTL) and hands every envelope to the exchangers in
+preference order, moving to the next one only when a host cannot be
+reached or closes the session.
+
+Each MX is an ordinary unauthenticated transport (STARTTLS when
+advertised), so ``smtp_pool`` keeps and reuses sessions per MX host, and
+the governor, metrics and per-project counters apply as for a relay.
+Domains are delivered in parallel; at most ``MTA_DOMAIN_CONCURRENCY``
+transactions run against one domain at a time, across all messages.
+"""
+
+import smtplib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import current_app
+from envelope import (envelopes, plan_envelopes, DeliveryReport, call_in_app_context,
+                      commit_counters)
+from mx_resolver import CachingResolver, DNSResolver, StaticResolver, MXLookupError
+from smtp_pool import smtp_pool, smtp_error_code, PoolTimeout
+from smtp_client import EightBitBody, iter_chunks
+from circuit import CircuitOpen
+from transport import OPPORTUNISTIC_TLS
+
+# Erros em que o MX respondeu à transação: outro MX do domínio diria o mesmo
+TRANSACTION_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                      smtplib.SMTPDataError)
+
+
+def recipient_domain(address):
+    return address.rpartition('@')[2].lower().rstrip('.')
+
+
+def group_by_domain(addresses):
+    """Distinct addresses grouped by domain, in first-seen order."""
+    domains = OrderedDict()
+    for unique in plan_envelopes(addresses):
+        for address in unique:
+            domains.setdefault(recipient_domain(address), []).append(address)
+    return domains
+
+
+def try_next_mx(error):
+    """Whether another exchanger of the same domain may succeed where one failed."""
+    if isinstance(error, TRANSACTION_ERRORS):
+        # 421: o MX encerrou a sessão sem aceitar a mensagem
+        return smtp_error_code(error) == 421
+    if isinstance(error, MXLookupError):
+        return False
+    return isinstance(error, (smtplib.SMTPException, OSError, PoolTimeout, CircuitOpen))
+
+
+def mx_transport(transport, host, port):
+    """The transport for one exchanger of a direct-delivery sender."""
+    # Sem credenciais: a sessão é compartilhada por todos os projetos que entregam neste MX
+    return transport._replace(server=host, port=port, use_tls=OPPORTUNISTIC_TLS,
+                              use_ssl=False, username=None, password=None)
+
+
+def sender_for(transport):
+    """DirectDelivery for direct-delivery senders, the relay EnvelopeSender otherwise."""
+    return mta if transport.direct else envelopes
+
+
+def render_once(body):
+    """Share one rendering of an EightBitBody between the lanes of a message.
+
+    Each variant (8bit or not) is serialized on first use and kept in
+    memory until the send returns; other bodies are returned unchanged.
+    """
+    if not isinstance(body, EightBitBody):
+        return body
+    rendered = {}
+    lock = threading.Lock()
+
+    def render(eightbit):
+        with lock:
+            if eightbit not in rendered:
+                rendered[eightbit] = b''.join(iter_chunks(body, eightbit))
+            return rendered[eightbit]
+    return EightBitBody(render)
+
+
+class DomainLimiter(object):
+    """Caps the concurrent transactions per destination domain."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = {}
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, domain):
+        with self._cond:
+            while self.active.get(domain, 0) >= self.limit:
+                self._cond.wait()
+            self.active[domain] = self.active.get(domain, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active[domain] -= 1
+                if not self.active[domain]:
+                    del self.active[domain]
+                self._cond.notify_all()
+
+
+class DirectDelivery(object):
+    """Delivers messages straight to the MX hosts of each recipient domain."""
+
+    def __init__(self, app=None):
+        self.port = 25
+        self.domain_concurrency = 4
+        self.max_workers = 16
+        self.resolver = None
+        self.limiter = DomainLimiter(self.domain_concurrency)
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.port = app.config.get('MTA_MX_PORT', self.port)
+        self.domain_concurrency = app.config.get('MTA_DOMAIN_CONCURRENCY', self.domain_concurrency)
+        self.max_workers = app.config.get('MTA_WORKERS', self.max_workers)
+        self.limiter = DomainLimiter(self.domain_concurrency)
+        # MTA_RESOLVER substitui o DNS (qualquer objeto com resolve(domain) -> MXAnswer);
+        # MTA_STATIC_MX aponta domínios para servidores locais
+        resolver = app.config.get('MTA_RESOLVER')
+        if resolver is None and app.config.get('MTA_STATIC_MX'):
+            resolver = StaticResolver(app.config['MTA_STATIC_MX'], self.port)
+        if resolver is None:
+            resolver = DNSResolver(app.config.get('MTA_NAMESERVERS'),
+                                   app.config.get('MTA_DNS_TIMEOUT', 5.0), self.port)
+        self.resolver = CachingResolver(resolver,
+                                        min_ttl=app.config.get('MTA_DNS_MIN_TTL', 30),
+                                        max_ttl=app.config.get('MTA_DNS_MAX_TTL', 3600),
+                                        error_ttl=app.config.get('MTA_DNS_ERROR_TTL', 30))
+        app.extensions['mta'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='mta')
+            return self._executor
+
+    def exchangers(self, domain):
+        """[(host, port)] to try for a domain, best preference first."""
+        if domain.startswith('[') and domain.endswith(']'):
+            # Endereço literal (user@[192.0.2.1]): sem consulta MX
+            return [(domain[1:-1], self.port)]
+        return self.resolver.resolve(domain)
+
+    def send(self, transport, from_addr, addresses, body, mail_options=(), rcpt_options=()):
+        """Deliver ``body`` to ``addresses`` and return the DeliveryReport.
+
+        Same contract as ``EnvelopeSender.send``. Each domain's envelopes
+        are split into up to ``domain_concurrency`` lanes delivered
+        sequentially; lanes run on the executor, each in its own app
+        context, unless there is only one, and share a single rendering of
+        the message.
+        """
+        report = DeliveryReport()
+        lanes = []
+        for domain, recipients in group_by_domain(addresses).items():
+            domain_envelopes = plan_envelopes(recipients, transport.max_recipients)
+            count = min(self.domain_concurrency, len(domain_envelopes))
+            lanes += [(domain, domain_envelopes[index::count]) for index in range(count)]
+        if len(lanes) == 1:
+            results = [self._deliver_lane(transport, from_addr, body, mail_options, rcpt_options,
+                                          False, *lanes[0])]
+        else:
+            # Sem isso cada faixa serializaria a mensagem de novo
+            body = render_once(body)
+            app = current_app._get_current_object()
+            futures = [self._get_executor().submit(call_in_app_context, app, self._deliver_lane,
+                                                   transport, from_addr, body, mail_options,
+                                                   rcpt_options, True, domain, lane_envelopes)
+                       for domain, lane_envelopes in lanes]
+            results = [future.result() for future in futures]
+        for lane in results:
+            for envelope, refused, error in lane:
+                report.record(envelope, refused, error)
+        return report
+
+    def _deliver_lane(self, transport, from_addr, body, mail_options, rcpt_options,
+                      own_session, domain, lane_envelopes):
+        return [(envelope,) + self._deliver(transport, from_addr, body, mail_options,
+                                            rcpt_options, own_session, domain, envelope)
+                for envelope in lane_envelopes]
+
+    def _deliver(self, transport, from_addr, body, mail_options, rcpt_options, own_session,
+                 domain, envelope):
+        """Send one envelope to the domain's exchangers; returns (refused, error).
+
+        With ``own_session`` (lanes on the executor) the counters of every
+        attempt are committed right away, as no request or outbox commit
+        follows on that thread.
+        """
+        try:
+            exchangers = self.exchangers(domain)
+        except MXLookupError as e:
+            return None, e
+        error = None
+        with self.limiter.slot(domain):
+            for host, port in exchangers:
+                try:
+                    return smtp_pool.sendmail(mx_transport(transport, host, port), from_addr,
+                                              envelope, body, mail_options, rcpt_options), None
+                except Exception as e:
+                    error = e
+                    if not try_next_mx(e):
+                        break
+                    current_app.logger.warning(f"MX {host}:{port} de {domain} indisponível: {str(e)}")
+                finally:
+                    if own_session:
+                        commit_counters()
+        return None, error
+
+    def stats(self):
+        return {'dns': self.resolver.stats() if self.resolver else {},
+                'active_domains': dict(self.limiter.active)}
+
+
+mta = DirectDelivery()
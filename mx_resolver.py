@@ -0,0 +1,260 @@
+"""
+MX lookups for direct delivery.
+
+``DNSResolver`` sends MX queries (RFC 1035) over UDP to the system
+nameservers, falling back to TCP for truncated answers, using only the
+standard library. ``StaticResolver`` answers from a fixed table and is what
+local stand-in MTAs are wired through. ``CachingResolver`` wraps either one
+and keeps answers for their TTL, failures included.
+
+Every resolver returns an ``MXAnswer``: ``hosts`` as (preference, host,
+port) sorted by preference, and the ``ttl`` in seconds. A domain without
+MX records falls back to the domain itself (implicit MX, RFC 5321 5.1);
+a missing domain or a null MX (RFC 7505) is a permanent ``MXLookupError``.
+"""
+
+import random
+import socket
+import smtplib
+import struct
+import threading
+import time
+from collections import namedtuple
+
+MXAnswer = namedtuple('MXAnswer', ['hosts', 'ttl'])
+# Falha guardada no cache; cada consulta levanta um MXLookupError novo
+MXFailure = namedtuple('MXFailure', ['domain', 'reason', 'transient', 'ttl'])
+
+TYPE_MX = 15
+TYPE_SOA = 6
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+
+
+class MXLookupError(smtplib.SMTPResponseException):
+    """MX resolution failed; carries an SMTP-style code (4xx transient, 5xx permanent)."""
+
+    def __init__(self, domain, message, transient=True, ttl=None):
+        smtplib.SMTPResponseException.__init__(
+            self, 451 if transient else 550,
+            ('%s 4.4.3 %s' if transient else '%s 5.1.2 %s') % (domain, message))
+        self.domain = domain
+        self.reason = message
+        self.transient = transient
+        self.ttl = ttl
+
+
+def split_host(value, default_port):
+    """'mx.example.com:2525' -> ('mx.example.com', 2525)."""
+    host, _, port = value.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return value, default_port
+
+
+def read_resolv_conf(path='/etc/resolv.conf'):
+    nameservers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    nameservers.append(parts[1])
+    except OSError:
+        pass
+    return nameservers or ['127.0.0.1']
+
+
+def build_query(domain, query_id):
+    # RD ligado: o servidor de nomes faz a resolução recursiva
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    name = b''.join(struct.pack('!B', len(label)) + label
+                    for label in domain.encode('idna').split(b'.') if label) + b'\0'
+    return header + name + struct.pack('!HH', TYPE_MX, CLASS_IN)
+
+
+def read_name(data, offset):
+    """Decode a possibly compressed name; returns (name, offset after it)."""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3FFF
+            jumps += 1
+            if jumps > 32:
+                raise ValueError('Ponteiros de compressão em loop')
+            continue
+        offset += 1
+        if not length:
+            break
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
+
+
+def parse_response(data, query_id):
+    """Return (rcode, truncated, mx records, answer ttl, negative ttl)."""
+    rid, flags, qdcount, ancount, nscount, _ = struct.unpack('!HHHHHH', data[:12])
+    if rid != query_id:
+        raise ValueError('Resposta DNS de outra consulta')
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = read_name(data, offset)
+        offset += 4
+    records = []
+    ttls = []
+    negative_ttl = None
+    for index in range(ancount + nscount):
+        _, offset = read_name(data, offset)
+        rtype, _, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        if index < ancount and rtype == TYPE_MX:
+            preference = struct.unpack('!H', data[offset:offset + 2])[0]
+            records.append((preference, read_name(data, offset + 2)[0]))
+            ttls.append(ttl)
+        elif index >= ancount and rtype == TYPE_SOA:
+            # TTL negativo: o menor entre o TTL do SOA e o campo minimum (RFC 2308)
+            negative_ttl = min(ttl, struct.unpack('!I', data[offset + length - 4:offset + length])[0])
+        offset += length
+    return flags & 0xF, bool(flags & 0x0200), records, min(ttls) if ttls else None, negative_ttl
+
+
+class DNSResolver(object):
+    """MX queries to the configured nameservers (``host`` or ``host:port``)."""
+
+    def __init__(self, nameservers=None, timeout=5.0, port=25, negative_ttl=300):
+        self.nameservers = [split_host(ns, 53) for ns in (nameservers or read_resolv_conf())]
+        self.timeout = timeout
+        self.port = port
+        self.negative_ttl = negative_ttl
+
+    def _query_udp(self, server, query):
+        with socket.socket(socket.AF_INET6 if ':' in server[0] else socket.AF_INET,
+                           socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.sendto(query, server)
+            return sock.recv(65535)
+
+    def _query_tcp(self, server, query):
+        with socket.create_connection(server, timeout=self.timeout) as sock:
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            data = b''
+            while len(data) < 2 or len(data) < 2 + struct.unpack('!H', data[:2])[0]:
+                chunk = sock.recv(65535)
+                if not chunk:
+                    raise OSError('Conexão DNS encerrada')
+                data += chunk
+            return data[2:]
+
+    def query(self, domain):
+        query_id = random.getrandbits(16)
+        try:
+            query = build_query(domain, query_id)
+        except (UnicodeError, struct.error) as e:
+            # Rótulo com mais de 63 caracteres, rótulo vazio etc.: nunca resolve
+            raise MXLookupError(domain, 'Invalid domain name: %s' % e, transient=False)
+        error = None
+        for server in self.nameservers:
+            try:
+                response = parse_response(self._query_udp(server, query), query_id)
+                if response[1]:
+                    # Resposta truncada: repete por TCP
+                    response = parse_response(self._query_tcp(server, query), query_id)
+                return response
+            except (OSError, ValueError, struct.error, IndexError) as e:
+                error = e
+        raise MXLookupError(domain, 'DNS lookup failed: %s' % error)
+
+    def resolve(self, domain):
+        rcode, _, records, ttl, negative_ttl = self.query(domain)
+        if rcode == RCODE_NXDOMAIN:
+            raise MXLookupError(domain, 'Domain not found', transient=False,
+                                ttl=negative_ttl or self.negative_ttl)
+        if rcode != 0:
+            raise MXLookupError(domain, 'DNS error (rcode %d)' % rcode)
+        if not records:
+            # Sem MX: o próprio domínio recebe as mensagens (MX implícito)
+            return MXAnswer([(0, domain, self.port)], negative_ttl or self.negative_ttl)
+        if len(records) == 1 and records[0][1] in ('', '.'):
+            raise MXLookupError(domain, 'Domain does not accept mail (null MX)', transient=False,
+                                ttl=ttl)
+        return MXAnswer(sorted((preference, host, self.port) for preference, host in records), ttl)
+
+
+class StaticResolver(object):
+    """Fixed MX table: ``{'example.com': ['127.0.0.1:2526', ...]}``, in preference order.
+
+    ``'*'`` matches any other domain.
+    """
+
+    def __init__(self, table, port=25, ttl=300):
+        self.table = {domain.lower(): hosts for domain, hosts in table.items()}
+        self.port = port
+        self.ttl = ttl
+
+    def resolve(self, domain):
+        hosts = self.table.get(domain, self.table.get('*'))
+        if not hosts:
+            raise MXLookupError(domain, 'Domain not found', transient=False)
+        return MXAnswer([(index,) + split_host(host, self.port) for index, host in enumerate(hosts)],
+                        self.ttl)
+
+
+class CachingResolver(object):
+    """Keeps answers and lookup failures for their TTL, within [min_ttl, max_ttl]."""
+
+    def __init__(self, resolver, min_ttl=30, max_ttl=3600, error_ttl=30):
+        self.resolver = resolver
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.error_ttl = error_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _clamp(self, ttl):
+        return max(self.min_ttl, min(self.max_ttl, ttl if ttl is not None else self.min_ttl))
+
+    def resolve(self, domain):
+        """Return the MX hosts as [(host, port)], equal preferences shuffled."""
+        domain = domain.lower().rstrip('.')
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(domain)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                answer = entry[1]
+            else:
+                answer = None
+                self.misses += 1
+        if answer is None:
+            try:
+                answer = self.resolver.resolve(domain)
+                expires = now + self._clamp(answer.ttl)
+            except MXLookupError as e:
+                # Só os dados: a exceção guardaria o traceback (e a mensagem do chamador)
+                answer = MXFailure(e.domain, e.reason, e.transient, e.ttl)
+                expires = now + (self._clamp(e.ttl) if not e.transient else self.error_ttl)
+            with self._lock:
+                self._cache[domain] = (expires, answer)
+                if len(self._cache) > 10000:
+                    for key in [k for k, v in self._cache.items() if v[0] <= now]:
+                        del self._cache[key]
+        if isinstance(answer, MXFailure):
+            raise MXLookupError(*answer)
+        # Mesma preferência: ordem aleatória para distribuir a carga (RFC 5321 5.1)
+        hosts = sorted(answer.hosts, key=lambda record: (record[0], random.random()))
+        return [(host, port) for _, host, port in hosts]
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+
+    def stats(self):
+        with self._lock:
+            return {'domains': len(self._cache), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,125 @@
+"""
+Keyset pagination and field projection for list endpoints.
+
+Pages are ordered by ``id`` or by ``(created_at, id)`` and continue from the
+last row of the previous page (``WHERE (created_at, id) > (...)``) instead
+of using OFFSET, so every page costs the same however deep the client goes.
+The position travels in an opaque ``next_cursor`` token. Only the columns
+asked for in ``fields=`` are selected, as plain rows (no ORM instances).
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from sqlalchemy import select, tuple_
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(sort, order, values):
+    payload = json.dumps({'s': sort, 'o': order, 'k': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return data['s'], data['o'], data['k']
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise PaginationError('Cursor inválido')
+
+
+def _serialize(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class KeysetPage(object):
+    """One page of ``model`` rows, parsed from the request arguments.
+
+    ``allowed_fields`` maps field names to columns; ``fields=`` must be a
+    subset of them. ``sort`` may be ``id`` or ``created_at`` and ``order``
+    ``asc`` or ``desc``; a cursor carries its own sort and order.
+    """
+
+    SORTS = ('id', 'created_at')
+
+    def __init__(self, model, allowed_fields, args, default_limit=100, max_limit=1000):
+        self.model = model
+        self.allowed_fields = allowed_fields
+
+        raw_fields = args.get('fields')
+        if raw_fields:
+            self.fields = [name.strip() for name in raw_fields.split(',') if name.strip()]
+            unknown = [name for name in self.fields if name not in allowed_fields]
+            if unknown or not self.fields:
+                raise PaginationError('Campos inválidos: %s (permitidos: %s)'
+                                      % (', '.join(unknown), ', '.join(allowed_fields)))
+        else:
+            self.fields = list(allowed_fields)
+
+        try:
+            self.limit = int(args.get('limit', default_limit))
+        except (TypeError, ValueError):
+            raise PaginationError('limit deve ser um número inteiro')
+        if self.limit < 1:
+            raise PaginationError('limit deve ser maior que zero')
+        # Limite do servidor: pedidos maiores são reduzidos, não recusados
+        self.limit = min(self.limit, max_limit)
+
+        self.after = None
+        cursor = args.get('cursor')
+        if cursor:
+            self.sort, self.order, self.after = decode_cursor(cursor)
+        else:
+            self.sort = args.get('sort', 'id')
+            self.order = args.get('order', 'asc')
+        if self.sort not in self.SORTS or self.order not in ('asc', 'desc'):
+            raise PaginationError('sort deve ser id ou created_at e order asc ou desc')
+        if self.after is not None and len(self.after) != len(self._keys()):
+            raise PaginationError('Cursor inválido')
+
+    def _keys(self):
+        if self.sort == 'created_at':
+            return [self.model.created_at, self.model.id]
+        return [self.model.id]
+
+    def _after_clause(self):
+        keys = self._keys()
+        values = list(self.after)
+        if self.sort == 'created_at':
+            try:
+                values[0] = datetime.fromisoformat(values[0])
+            except (TypeError, ValueError):
+                raise PaginationError('Cursor inválido')
+        # Comparação de tuplas, (created_at, id) > (x, y), usa o índice composto
+        key = tuple_(*keys) if len(keys) > 1 else keys[0]
+        value = tuple_(*values) if len(values) > 1 else values[0]
+        return key > value if self.order == 'asc' else key < value
+
+    def statement(self, *criteria):
+        """SELECT of the requested fields plus the sort keys, one row past the page."""
+        keys = self._keys()
+        columns = [self.allowed_fields[name].label(name) for name in self.fields]
+        columns += [key.label('_key%d' % i) for i, key in enumerate(keys)]
+        stmt = select(*columns).where(*criteria)
+        if self.after is not None:
+            stmt = stmt.where(self._after_clause())
+        ordering = [key.asc() if self.order == 'asc' else key.desc() for key in keys]
+        return stmt.order_by(*ordering).limit(self.limit + 1)
+
+    def render(self, session, *criteria):
+        """Run the query and return (items, next_cursor)."""
+        rows = session.execute(self.statement(*criteria)).all()
+        more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        items = [{name: _serialize(getattr(row, name)) for name in self.fields} for row in rows]
+        next_cursor = None
+        if more:
+            last = rows[-1]
+            values = [_serialize(getattr(last, '_key%d' % i)) for i in range(len(self._keys()))]
+            next_cursor = encode_cursor(self.sort, self.order, values)
+        return items, next_cursor
@@ -0,0 +1,135 @@
+"""
+In-process cache of projects keyed by api_key.
+
+Every public endpoint authenticates by api_key, so resolving it is on the
+hot path of each request. ``ProjectCache`` keeps immutable ``ProjectInfo``
+snapshots (never ORM instances, which would be expired or detached once the
+request's session ends) in a bounded LRU with a TTL. Unknown keys are cached
+too, for a shorter time, so a client hammering with a bad key does not hit
+the database on every request. Creating a project writes its snapshot
+through; updates and deletes drop the entry.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event, inspect
+from models import Project
+
+# Marca uma api_key inexistente no cache (entrada negativa)
+MISSING = object()
+
+
+class ProjectInfo(namedtuple('ProjectInfo', ['id', 'api_key', 'name', 'description',
+                                             'mail_username', 'mail_password'])):
+    """Read-only snapshot of the Project columns needed to serve a request."""
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, project):
+        return cls(id=project.id, api_key=project.api_key, name=project.name,
+                   description=project.description, mail_username=project.mail_username,
+                   mail_password=project.mail_password)
+
+    def __repr__(self):
+        # Nunca expor a senha em logs
+        return 'ProjectInfo(id=%r, name=%r)' % (self.id, self.name)
+
+
+class ProjectCache(object):
+    """Thread-safe LRU of api_key -> ProjectInfo with positive and negative TTLs."""
+
+    def __init__(self, app=None):
+        self.max_size = 1024
+        self.ttl = 60
+        self.negative_ttl = 10
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        # Incrementado a cada invalidação; descarta leituras feitas antes dela
+        self._generation = 0
+        self._counters = dict.fromkeys(('hits', 'negative_hits', 'misses', 'evictions',
+                                        'expirations', 'invalidations'), 0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.get('PROJECT_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('PROJECT_CACHE_TTL', self.ttl)
+        self.negative_ttl = app.config.get('PROJECT_CACHE_NEGATIVE_TTL', self.negative_ttl)
+        self.clear()
+        app.extensions['project_cache'] = self
+
+    def get(self, api_key):
+        """Return the ProjectInfo for an api_key, or None if it does not exist."""
+        if not api_key:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(api_key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._items.move_to_end(api_key)
+                    if value is MISSING:
+                        self._counters['negative_hits'] += 1
+                        return None
+                    self._counters['hits'] += 1
+                    return value
+                del self._items[api_key]
+                self._counters['expirations'] += 1
+            self._counters['misses'] += 1
+            generation = self._generation
+
+        project = Project.query.filter_by(api_key=api_key).first()
+        info = ProjectInfo.from_model(project) if project is not None else None
+        self._store(api_key, info, now, generation)
+        return info
+
+    def put(self, project):
+        """Write a project's current state through to the cache."""
+        self._store(project.api_key, ProjectInfo.from_model(project), time.monotonic())
+
+    def _store(self, api_key, info, now, generation=None):
+        ttl = self.ttl if info is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # Um projeto mudou enquanto consultávamos o banco
+                return
+            self._items[api_key] = (info if info is not None else MISSING, now + ttl)
+            self._items.move_to_end(api_key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._generation += 1
+            if self._items.pop(api_key, None) is not None:
+                self._counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, size=len(self._items), max_size=self.max_size,
+                         ttl=self.ttl, negative_ttl=self.negative_ttl)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['negative_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+project_cache = ProjectCache()
+
+
+@event.listens_for(Project, 'after_insert')
+@event.listens_for(Project, 'after_update')
+@event.listens_for(Project, 'after_delete')
+def _invalidate_cached_project(mapper, connection, target):
+    # Inclui a api_key antiga, se mudou, e entradas negativas de uma chave recém-criada
+    for api_key in [target.api_key] + list(inspect(target).attrs.api_key.history.deleted):
+        project_cache.invalidate(api_key)
@@ -0,0 +1,112 @@
+"""
+Registration as a single atomic upsert.
+
+``register_email`` creates or links the ``User``, the ``user_projects`` row
+and the ``VerificationStatus`` with three ``INSERT ... ON CONFLICT``
+statements in one transaction, instead of reading each row first and
+writing afterwards. Concurrent registrations of the same email converge on
+the same rows (guaranteed by the unique indexes) instead of racing to
+create duplicates.
+
+``register_emails`` does the same for a whole chunk of addresses at once,
+with the same three statements as multi-row inserts.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, User, VerificationStatus, user_projects
+import stats
+
+Registration = namedtuple('Registration', ['user_id', 'verification_id', 'verified'])
+
+# Dialetos com INSERT ... ON CONFLICT ... RETURNING
+DIALECT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+}
+
+
+def dialect_insert(table):
+    name = db.session.get_bind().dialect.name
+    try:
+        return DIALECT_INSERTS[name](table)
+    except KeyError:
+        raise NotImplementedError(f'Upsert não suportado para o banco {name}')
+
+
+def register_email(email, project_id):
+    """Create or link a user to a project and return its Registration.
+
+    Commits on success. An email already verified for the project is left
+    untouched and comes back with ``verified=True``.
+    """
+    users = User.__table__
+    statuses = VerificationStatus.__table__
+    try:
+        # "DO UPDATE" sem mudança real para que o RETURNING também devolva a linha existente
+        stmt = dialect_insert(users).values(email=email, verified=False,
+                                            created_at=datetime.utcnow())
+        user_id = db.session.execute(
+            stmt.on_conflict_do_update(index_elements=[users.c.email],
+                                       set_={'email': stmt.excluded.email})
+            .returning(users.c.id)
+        ).scalar_one()
+
+        linked = db.session.execute(
+            dialect_insert(user_projects).values(user_id=user_id, project_id=project_id)
+            .on_conflict_do_nothing()
+        ).rowcount
+        stats.bump(project_id, registered=linked)
+
+        stmt = dialect_insert(statuses).values(user_id=user_id, project_id=project_id,
+                                               verified=False)
+        verification_id, verified = db.session.execute(
+            stmt.on_conflict_do_update(index_elements=[statuses.c.user_id, statuses.c.project_id],
+                                       set_={'user_id': stmt.excluded.user_id})
+            .returning(statuses.c.id, statuses.c.verified)
+        ).one()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return Registration(user_id, verification_id, bool(verified))
+
+
+def register_emails(emails, project_id):
+    """Register a chunk of distinct emails with three multi-row upserts.
+
+    Returns ``{email: Registration}``. Does not commit: the caller commits
+    together with whatever else belongs to the chunk (the outbox rows).
+    """
+    users = User.__table__
+    statuses = VerificationStatus.__table__
+    now = datetime.utcnow()
+
+    stmt = dialect_insert(users).values([{'email': email, 'verified': False, 'created_at': now}
+                                         for email in emails])
+    user_ids = dict(db.session.execute(
+        stmt.on_conflict_do_update(index_elements=[users.c.email],
+                                   set_={'email': stmt.excluded.email})
+        .returning(users.c.email, users.c.id)
+    ).all())
+
+    # rowcount conta só os vínculos novos
+    linked = db.session.execute(
+        dialect_insert(user_projects).values([{'user_id': user_id, 'project_id': project_id}
+                                              for user_id in user_ids.values()])
+        .on_conflict_do_nothing()
+    ).rowcount
+    stats.bump(project_id, registered=linked)
+
+    stmt = dialect_insert(statuses).values([{'user_id': user_id, 'project_id': project_id,
+                                             'verified': False}
+                                            for user_id in user_ids.values()])
+    # Ordem do RETURNING não é garantida; associa pelo user_id
+    rows = db.session.execute(
+        stmt.on_conflict_do_update(index_elements=[statuses.c.user_id, statuses.c.project_id],
+                                   set_={'user_id': stmt.excluded.user_id})
+        .returning(statuses.c.user_id, statuses.c.id, statuses.c.verified)
+    ).all()
+    by_user = {user_id: (verification_id, bool(verified)) for user_id, verification_id, verified in rows}
+    return {email: Registration(user_id, *by_user[user_id]) for email, user_id in user_ids.items()}
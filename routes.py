@@ -1,8 +1,22 @@
-from flask import Blueprint, request, jsonify, render_template
+from flask import Blueprint, request, jsonify, render_template, Response, stream_with_context, current_app
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-from models import db, User, Project, VerificationStatus
-from utils import is_valid_email, send_verification_email, serializer, send_custom_email
+from models import db, User, Project, VerificationStatus, Outbox, MailTemplate
+from utils import is_valid_email, is_truthy, send_verification_email, serializer, send_custom_email
+from jobs import outbox_worker, serialize_message
+from smtp_pool import smtp_pool, is_transient_error
+from governor import governor
+from circuit import breakers
+from metrics import smtp_metrics
+from smtp_ingress import smtp_ingress
+from project_cache import project_cache
+from registration import register_email, register_emails
+from pagination import KeysetPage, PaginationError
+from export import FORMATS, SERIALIZERS, export_rows
+from attachments import spool_upload, discard_attachments, FileAttachment
+from mailmerge import has_newline, render as render_merge
 from datetime import datetime, timedelta
+from sqlalchemy import select, update, and_
+import stats
 import os
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -29,61 +43,143 @@ def register():
     if not is_valid_email(email):
         return jsonify({'error': 'Email inválido'}), 400
 
-    project = Project.query.filter_by(api_key=api_key).first()
+    project = project_cache.get(api_key)
     if not project:
         return jsonify({'error': 'Projeto não encontrado'}), 404
 
-    user = User.query.filter_by(email=email).first()
-    
-    if user:
-        verification = VerificationStatus.query.filter_by(
-            user_id=user.id,
-            project_id=project.id
-        ).first()
-        if verification and verification.verified:
-            return jsonify({'message': 'Este email já está verificado para este projeto'}), 400
-
-    if not user:
-        user = User(email=email)
-        user.projects.append(project)
-        db.session.add(user)
-    elif project not in user.projects:
-        user.projects.append(project)
-
-    verification = VerificationStatus.query.filter_by(
-        user_id=user.id, 
-        project_id=project.id
-    ).first()
+    # Usuário, vínculo com o projeto e status de verificação em uma única transação
+    try:
+        registration = register_email(email, project.id)
+    except Exception as e:
+        print(f"Erro ao registrar usuário: {str(e)}")
+        return jsonify({'error': f'Erro ao registrar usuário: {str(e)}'}), 500
 
-    if not verification:
-        verification = VerificationStatus(user_id=user.id, project_id=project.id)
-        db.session.add(verification)
+    if registration.verified:
+        return jsonify({'message': 'Este email já está verificado para este projeto'}), 400
+
+    token_data = {'email': email, 'api_key': api_key}
+    token = serializer.dumps(token_data, salt='email-verification')
 
     try:
+        send_verification_email(email, project.name, token, request.host_url, project=project)
+    except Exception as mail_error:
+        print(f"Erro ao enviar email: {str(mail_error)}")
+        return jsonify({'error': f'Erro ao enviar email: {str(mail_error)}'}), 500
+    finally:
+        # Grava os contadores de envio do projeto (stats.record_send)
         db.session.commit()
-        token_data = {'email': email, 'api_key': api_key}
-        token = serializer.dumps(token_data, salt='email-verification')
-        
-        try:
-            send_verification_email(email, project.name, token, request.host_url, project=project)
-        except Exception as mail_error:
-            print(f"Erro ao enviar email: {str(mail_error)}")
-            return jsonify({'error': f'Erro ao enviar email: {str(mail_error)}'}), 500
-        
-        return jsonify({
-            'message': 'Registro realizado com sucesso. Verifique seu email.',
-            'user': {
-                'id': user.id,
-                'email': user.email,
-                'project': project.name,
-                'verified': verification.verified
-            }
-        }), 201
 
-    except Exception as e:
-        db.session.rollback()
-        print(f"Erro ao registrar usuário: {str(e)}")
-        return jsonify({'error': f'Erro ao registrar usuário: {str(e)}'}), 500
+    return jsonify({
+        'message': 'Registro realizado com sucesso. Verifique seu email.',
+        'user': {
+            'id': registration.user_id,
+            'email': email,
+            'project': project.name,
+            'verified': registration.verified
+        }
+    }), 201
+
+def iter_batch_lines(stream, max_line_bytes):
+    """Yield (line_number, email) from a streamed list, one address per line.
+
+    A line may be a bare address, a JSON string or {"email": ...}; lines
+    that cannot be read are yielded with email None.
+    """
+    for line_number, raw in iter_ndjson_lines(stream, max_line_bytes):
+        if raw is None:
+            yield line_number, None
+            continue
+        line = raw.decode('utf-8', 'replace').strip()
+        if not line:
+            continue
+        if line[0] in '{"':
+            try:
+                item = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            line = item.get('email') if isinstance(item, dict) else item
+        yield line_number, line
+
+@app.route('/register/batch', methods=['POST'])
+def register_batch():
+    """Register many addresses and queue their verification emails"""
+    api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('emails'), list):
+            return jsonify({'error': 'emails deve ser uma lista'}), 400
+        api_key = data.get('api_key') or api_key
+        entries = enumerate(data['emails'], 1)
+    else:
+        entries = iter_batch_lines(request.stream, current_app.config['BULK_MAX_LINE_BYTES'])
+    if not api_key:
+        return jsonify({'error': 'api_key é obrigatória'}), 400
+
+    project = project_cache.get(api_key)
+    if not project:
+        return jsonify({'error': 'Projeto não encontrado'}), 404
+    if not project.mail_username:
+        return jsonify({'error': 'Projeto sem remetente (mail_username) configurado'}), 400
+
+    project_id = project.id
+    chunk_size = current_app.config['REGISTER_BATCH_CHUNK_SIZE']
+    host_url = request.host_url
+
+    def verification_message(email):
+        # O token só é criado na entrega (jobs.py): lotes grandes levam horas para sair
+        return {'kind': 'verification', 'email': email, 'host_url': host_url}
+
+    def generate():
+        counts = dict.fromkeys(('queued', 'already_verified', 'duplicate', 'rejected', 'failed'), 0)
+        seen = set()
+        pending = []
+
+        def outcome(line, email, status, **extra):
+            counts[status] += 1
+            return json.dumps(dict({'line': line, 'email': email, 'status': status}, **extra)) + '\n'
+
+        def flush():
+            emails = [email for _, email in pending]
+            try:
+                registrations = register_emails(emails, project_id)
+                to_send = [email for email in emails if not registrations[email].verified]
+                # Registro e emails de verificação entram no mesmo commit
+                job_ids = dict(zip(to_send, outbox_worker.enqueue_many(
+                    project_id, [verification_message(email) for email in to_send])))
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Erro ao registrar lote: {str(e)}")
+                results = ''.join(outcome(line, email, 'failed', error='Erro ao registrar usuário')
+                                  for line, email in pending)
+            else:
+                results = ''.join(
+                    outcome(line, email, 'queued', user_id=registrations[email].user_id,
+                            job_id=job_ids[email]) if email in job_ids else
+                    outcome(line, email, 'already_verified', user_id=registrations[email].user_id)
+                    for line, email in pending)
+            del pending[:]
+            return results
+
+        for line, email in entries:
+            if not isinstance(email, str) or not is_valid_email(email.strip()):
+                yield outcome(line, email if isinstance(email, str) else None, 'rejected',
+                              error='Email inválido')
+                continue
+            email = email.strip()
+            if email in seen:
+                yield outcome(line, email, 'duplicate')
+                continue
+            seen.add(email)
+            pending.append((line, email))
+            if len(pending) >= chunk_size:
+                yield flush()
+
+        if pending:
+            yield flush()
+        yield json.dumps({'summary': counts}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @app.route('/verify/<token>')
 def verify_email(token):
@@ -92,32 +188,40 @@ def verify_email(token):
         email = token_data['email']
         api_key = token_data['api_key']
 
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            return jsonify({'error': 'Usuário não encontrado'}), 404
-
-        project = Project.query.filter_by(api_key=api_key).first()
+        project = project_cache.get(api_key)
         if not project:
             return jsonify({'error': 'Projeto não encontrado'}), 404
 
-        verification = VerificationStatus.query.filter_by(
-            user_id=user.id,
-            project_id=project.id
+        # Usuário e status de verificação em uma única consulta
+        row = db.session.execute(
+            select(User.id, VerificationStatus.id, VerificationStatus.verified)
+            .outerjoin(VerificationStatus, and_(VerificationStatus.user_id == User.id,
+                                                VerificationStatus.project_id == project.id))
+            .where(User.email == email)
         ).first()
+        if row is None:
+            return jsonify({'error': 'Usuário não encontrado'}), 404
 
-        if not verification:
+        _, verification_id, verified = row
+        if verification_id is None:
             return jsonify({'error': 'Verificação não encontrada'}), 404
 
-        if verification.verified:
+        if verified:
             return jsonify({'message': 'Email já está verificado para este projeto'}), 200
 
-        verification.verified = True
-        verification.verified_at = datetime.utcnow()
+        # Só conta a verificação se esta requisição fez a mudança
+        changed = db.session.execute(
+            update(VerificationStatus)
+            .where(VerificationStatus.id == verification_id,
+                   VerificationStatus.verified == False)  # noqa: E712
+            .values(verified=True, verified_at=datetime.utcnow())
+        ).rowcount
+        stats.bump(project.id, verified=changed)
         db.session.commit()
 
         return jsonify({
             'message': 'Email verificado com sucesso',
-            'project': verification.project.name
+            'project': project.name
         }), 200
 
     except Exception as e:
@@ -132,37 +236,122 @@ def check_verification():
     if not email or not api_key:
         return jsonify({'error': 'Email e api_key são obrigatórios'}), 400
         
-    user = User.query.filter_by(email=email).first()
-    if not user:
-        return jsonify({'verified': False, 'message': 'Email não encontrado'}), 404
-        
-    project = Project.query.filter_by(api_key=api_key).first()
+    project = project_cache.get(api_key)
     if not project:
         return jsonify({'verified': False, 'message': 'Projeto não encontrado'}), 404
 
-    verification = VerificationStatus.query.filter_by(
-        user_id=user.id,
-        project_id=project.id
+    # Usuário e status de verificação em uma única consulta
+    row = db.session.execute(
+        select(User.id, VerificationStatus.id, VerificationStatus.verified,
+               VerificationStatus.verified_at)
+        .outerjoin(VerificationStatus, and_(VerificationStatus.user_id == User.id,
+                                            VerificationStatus.project_id == project.id))
+        .where(User.email == email)
     ).first()
-    
-    if not verification:
+    if row is None:
+        return jsonify({'verified': False, 'message': 'Email não encontrado'}), 404
+
+    _, verification_id, verified, verified_at = row
+    if verification_id is None:
         return jsonify({'verified': False, 'message': 'Verificação não encontrada'}), 404
-        
+
     return jsonify({
-        'verified': verification.verified,
-        'verified_at': verification.verified_at.isoformat() if verification.verified_at else None
+        'verified': bool(verified),
+        'verified_at': verified_at.isoformat() if verified_at else None
     })
 
+@app.route('/check-verification/batch', methods=['POST'])
+@jwt_required()
+def check_verification_batch():
+    """Verification status of many emails for one project, in one query"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('api_key') or not isinstance(data.get('emails'), list):
+        return jsonify({'error': 'api_key e emails (lista) são obrigatórios'}), 400
+
+    emails = data['emails']
+    max_emails = current_app.config['VERIFICATION_BATCH_MAX']
+    if len(emails) > max_emails:
+        return jsonify({'error': f'Máximo de {max_emails} emails por requisição'}), 400
+    if not all(isinstance(email, str) for email in emails):
+        return jsonify({'error': 'emails deve conter apenas strings'}), 400
+
+    project = project_cache.get(data['api_key'])
+    if not project:
+        return jsonify({'error': 'Projeto não encontrado'}), 404
+
+    # Emails sem usuário ou sem verificação neste projeto ficam como null
+    results = dict.fromkeys(emails)
+    if emails:
+        rows = db.session.execute(
+            select(User.email, VerificationStatus.verified, VerificationStatus.verified_at)
+            .join(VerificationStatus, and_(VerificationStatus.user_id == User.id,
+                                           VerificationStatus.project_id == project.id))
+            .where(User.email.in_(set(emails)))
+        )
+        for email, verified, verified_at in rows:
+            results[email] = {
+                'verified': bool(verified),
+                'verified_at': verified_at.isoformat() if verified_at else None
+            }
+
+    return jsonify({'results': results})
+
+USER_FIELDS = {
+    'id': User.id,
+    'email': User.email,
+    'verified': User.verified,
+    'created_at': User.created_at
+}
+
+PROJECT_FIELDS = {
+    'id': Project.id,
+    'name': Project.name,
+    'description': Project.description,
+    'api_key': Project.api_key,
+    'mail_username': Project.mail_username,
+    'created_at': Project.created_at
+}
+
+def keyset_page(model, fields):
+    """Build the page requested by ?cursor=&limit=&fields=&sort=&order="""
+    return KeysetPage(model, fields, request.args,
+                      default_limit=current_app.config['PAGE_SIZE_DEFAULT'],
+                      max_limit=current_app.config['PAGE_SIZE_MAX'])
+
 @app.route('/users')
 @jwt_required()
 def list_users():
-    users = User.query.all()
-    return jsonify([{
-        'id': user.id,
-        'email': user.email,
-        'verified': user.verified,
-        'created_at': user.created_at.isoformat()
-    } for user in users])
+    try:
+        users, next_cursor = keyset_page(User, USER_FIELDS).render(db.session)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'users': users, 'next_cursor': next_cursor})
+
+@app.route('/users/export')
+@jwt_required()
+def export_users():
+    """Stream every (user, project) row as NDJSON or CSV"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in FORMATS:
+        return jsonify({'error': 'format deve ser ndjson ou csv'}), 400
+
+    project_id = None
+    api_key = request.args.get('api_key')
+    if api_key:
+        project = project_cache.get(api_key)
+        if not project:
+            return jsonify({'error': 'Projeto não encontrado'}), 404
+        project_id = project.id
+
+    verified = request.args.get('verified')
+    if verified is not None:
+        verified = is_truthy(verified)
+
+    batches = export_rows(project_id, verified, current_app.config['EXPORT_BATCH_SIZE'])
+    response = Response(stream_with_context(SERIALIZERS[export_format](batches)),
+                        mimetype=FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=users.%s' % export_format
+    return response
 
 @app.route('/projects', methods=['POST'])
 def create_project():
@@ -185,6 +374,7 @@ def create_project():
     try:
         db.session.add(project)
         db.session.commit()
+        project_cache.put(project)
         
         return jsonify({
             'message': 'Projeto criado com sucesso',
@@ -207,7 +397,7 @@ def login():
         return jsonify({'error': 'API key do projeto é obrigatória'}), 400
 
     api_key = data['api_key']
-    project = Project.query.filter_by(api_key=api_key).first()
+    project = project_cache.get(api_key)
     
     if not project:
         return jsonify({'error': 'Projeto não encontrado'}), 404
@@ -253,17 +443,44 @@ def admin_login():
 @app.route('/projects', methods=['GET'])
 @jwt_required()
 def list_projects():
-    projects = Project.query.all()
-    return jsonify({
-        'projects': [{
-            'id': project.id,
-            'name': project.name,
-            'description': project.description,
-            'api_key': project.api_key,
-            'mail_username': project.mail_username,
-            'created_at': project.created_at.isoformat()
-        } for project in projects]
-    }), 200
+    try:
+        projects, next_cursor = keyset_page(Project, PROJECT_FIELDS).render(db.session)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'projects': projects, 'next_cursor': next_cursor}), 200
+
+def is_email_list(addresses):
+    return isinstance(addresses, list) and all(isinstance(email, str) and is_valid_email(email)
+                                               for email in addresses)
+
+def validate_message_fields(message):
+    """Check the optional cc, bcc and attachments of a message; returns an error or None"""
+    for field in ('cc', 'bcc'):
+        # Uma string viraria um conjunto de caracteres no envelope
+        if message.get(field) is not None and not is_email_list(message[field]):
+            return f'Lista de {field} inválida'
+    attachments = message.get('attachments')
+    if attachments is not None and (not isinstance(attachments, list) or not all(
+            isinstance(attachment, (list, tuple)) and len(attachment) == 3
+            and isinstance(attachment[0], str) and isinstance(attachment[1], str)
+            and '/' in attachment[1] and isinstance(attachment[2], (str, FileAttachment))
+            for attachment in attachments)):
+        return 'Anexos devem ser uma lista de [filename, content_type, base64]'
+    return None
+
+def validate_send_request(data):
+    """Validate the required fields of a custom email request"""
+    required_params = ['recipients', 'api_key', 'sender']
+    missing_params = [param for param in required_params if param not in data or not data[param]]
+    if missing_params:
+        return jsonify({'error': f'Parâmetros obrigatórios ausentes: {", ".join(missing_params)}'}), 400
+
+    if not is_email_list(data['recipients']):
+        return jsonify({'error': 'Lista de destinatários inválida'}), 400
+    error = validate_message_fields(data)
+    if error:
+        return jsonify({'error': error}), 400
+    return None
 
 @app.route('/send-custom-email', methods=['POST'])
 def send_custom_email_route():
@@ -300,11 +517,10 @@ def send_custom_email_route():
         for file_key in request.files:
             file = request.files[file_key]
             if file and file.filename:
-                # Lê o conteúdo do arquivo binário
-                file_content = file.read()
-                # Adiciona ao array de anexos como tupla (filename, content_type, data)
-                # Sem converter para base64, mantendo os dados binários originais
-                data['attachments'].append((file.filename, file.mimetype, file_content))
+                # Copia o arquivo para o spool em blocos, sem carregá-lo em memória;
+                # o conteúdo é codificado em base64 durante o envio
+                spooled = spool_upload(file, current_app.config['SPOOL_DIR'])
+                data['attachments'].append((file.filename, file.mimetype, spooled))
     else:
         # Mantém o comportamento original para JSON
         data = request.get_json()
@@ -313,41 +529,350 @@ def send_custom_email_route():
         # Garante que attachments existe
         data['attachments'] = data.get('attachments', [])
 
-    # Validação dos parâmetros obrigatórios
-    required_params = ['recipients', 'api_key', 'sender']
-    missing_params = [param for param in required_params if param not in data or not data[param]]
-    if missing_params:
-        return jsonify({'error': f'Parâmetros obrigatórios ausentes: {", ".join(missing_params)}'}), 400
-
-    if not isinstance(data['recipients'], list) or not all(is_valid_email(email) for email in data['recipients']):
-        return jsonify({'error': 'Lista de destinatários inválida'}), 400
+    error = validate_send_request(data)
+    if error:
+        discard_attachments(data.get('attachments'))
+        return error
 
-    project = Project.query.filter_by(api_key=data['api_key']).first()
+    project = project_cache.get(data['api_key'])
     if not project:
+        discard_attachments(data.get('attachments'))
         return jsonify({'error': 'Projeto não encontrado'}), 404
 
-    try:
-        send_custom_email(
-            recipients=data['recipients'],
-            subject=data.get('subject', 'Sem assunto'),
-            body=data.get('body', ''),
-            html_content=data.get('html_content'),
-            sender=data['sender'],
-            attachments=data.get('attachments', []),
-            cc=data.get('cc', []),
-            bcc=data.get('bcc', []),
-            reply_to=data.get('reply_to'),
-            project=project
-        )
+    message = {
+        'recipients': data['recipients'],
+        'subject': data.get('subject', 'Sem assunto'),
+        'body': data.get('body', ''),
+        'html_content': data.get('html_content'),
+        'sender': data['sender'],
+        'attachments': data.get('attachments', []),
+        'cc': data.get('cc', []),
+        'bcc': data.get('bcc', []),
+        'reply_to': data.get('reply_to'),
+    }
+
+    # Modo assíncrono: enfileira e responde imediatamente
+    if is_truthy(request.args.get('async')) or is_truthy(data.get('async')):
+        job = outbox_worker.enqueue(project.id, message)
+        return jsonify({
+            'message': 'Email enfileirado para envio',
+            'job_id': job.id,
+            'status_url': f'/api/jobs/{job.id}'
+        }), 202
 
+    try:
+        report = send_custom_email(project=project, **message)
+        # Grava os contadores de envio do projeto (stats.record_send)
+        db.session.commit()
+        details = {
+            'recipients': data['recipients'],
+            'subject': data.get('subject', 'Sem assunto'),
+            'attachments': [att[0] for att in data.get('attachments', [])],
+            'delivery': report.as_dict()
+        }
+
+        deferred = report.deferred
+        if deferred:
+            # Falha temporária para parte dos destinatários: só eles voltam para a outbox
+            job = outbox_worker.enqueue(project.id, dict(message, envelope=deferred),
+                                        error=report.summary())
+            return jsonify({
+                'message': 'Email enviado para parte dos destinatários; os demais foram '
+                           'enfileirados para nova tentativa',
+                'details': details,
+                'job_id': job.id,
+                'status_url': f'/api/jobs/{job.id}'
+            }), 202
+
+        discard_attachments(message['attachments'])
         return jsonify({
             'message': 'Email enviado com sucesso',
-            'details': {
-                'recipients': data['recipients'],
-                'subject': data.get('subject', 'Sem assunto'),
-                'attachments': [att[0] for att in data.get('attachments', [])]
-            }
+            'details': details
         }), 200
 
     except Exception as e:
-        return jsonify({'error': f'Erro ao enviar email: {str(e)}'}), 500
+        if not is_transient_error(e):
+            db.session.commit()
+            discard_attachments(message['attachments'])
+            return jsonify({'error': f'Erro ao enviar email: {str(e)}'}), 500
+
+        # Falha temporária do relay: a mensagem fica na outbox para nova tentativa
+        job = outbox_worker.enqueue(project.id, message, error=e)
+        return jsonify({
+            'message': 'Falha temporária no envio, email enfileirado para nova tentativa',
+            'error': str(e),
+            'job_id': job.id,
+            'status_url': f'/api/jobs/{job.id}'
+        }), 202
+
+@app.route('/jobs/<int:job_id>')
+def get_job(job_id):
+    api_key = request.args.get('api_key')
+    if not api_key:
+        return jsonify({'error': 'api_key é obrigatória'}), 400
+
+    project = project_cache.get(api_key)
+    job = db.session.get(Outbox, job_id)
+    if not project or not job or job.project_id != project.id:
+        return jsonify({'error': 'Job não encontrado'}), 404
+
+    return jsonify({
+        'id': job.id,
+        'status': job.state,
+        'attempts': job.attempts,
+        'next_attempt_at': job.next_attempt_at.isoformat() if job.state == 'queued' else None,
+        'error': job.last_error,
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat()
+    }), 200
+
+@app.route('/stats')
+@jwt_required()
+def stats_route():
+    """Dashboard counters, per project and in total"""
+    project_id = None
+    api_key = request.args.get('api_key')
+    if api_key:
+        project = project_cache.get(api_key)
+        if not project:
+            return jsonify({'error': 'Projeto não encontrado'}), 404
+        project_id = project.id
+    return jsonify(stats.snapshot(project_id))
+
+@app.route('/metrics/cache')
+@jwt_required()
+def cache_metrics_route():
+    """Hit/miss counters of the api_key -> project cache"""
+    return jsonify({'projects': project_cache.stats()}), 200
+
+@app.route('/metrics/smtp')
+@jwt_required()
+def smtp_metrics_route():
+    """Latency histograms per SMTP phase, plus pool and rate governor state"""
+    return jsonify({
+        'latency': smtp_metrics.snapshot(),
+        'pool': smtp_pool.stats(),
+        'rate_limits': governor.snapshot(),
+        'ingress': smtp_ingress.stats()
+    }), 200
+
+@app.route('/metrics/circuits')
+@jwt_required()
+def circuit_metrics_route():
+    """Circuit breaker state of every relay"""
+    return jsonify(breakers.snapshot()), 200
+
+BULK_MESSAGE_FIELDS = ('recipients', 'subject', 'body', 'html_content', 'sender',
+                       'attachments', 'cc', 'bcc', 'reply_to')
+
+def iter_ndjson_lines(stream, max_line_bytes):
+    """Yield (line_number, raw_line) from a stream without buffering it whole.
+
+    Lines longer than ``max_line_bytes`` are yielded as None and skipped.
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            # Descarta o restante da linha longa
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_bytes)
+            yield line_number, None
+            continue
+        yield line_number, line
+
+def build_bulk_message(item, defaults):
+    """Merge an NDJSON line with the current defaults and validate it"""
+    if not isinstance(item, dict):
+        return None, 'Linha deve ser um objeto JSON'
+
+    message = dict(defaults)
+    message.update({key: item[key] for key in BULK_MESSAGE_FIELDS if key in item})
+    if 'recipient' in item:
+        message['recipients'] = [item['recipient']]
+
+    recipients = message.get('recipients')
+    if not recipients:
+        return None, 'Parâmetro obrigatório ausente: recipients'
+    if not message.get('sender'):
+        return None, 'Parâmetro obrigatório ausente: sender'
+    if not is_email_list(recipients):
+        return None, 'Lista de destinatários inválida'
+    error = validate_message_fields(message)
+    if error:
+        return None, error
+
+    message.setdefault('subject', 'Sem assunto')
+    message.setdefault('body', '')
+    return message, None
+
+@app.route('/send-bulk', methods=['POST'])
+def send_bulk():
+    api_key = request.headers.get('X-API-Key') or request.args.get('api_key')
+    if not api_key:
+        return jsonify({'error': 'api_key é obrigatória'}), 400
+
+    project = project_cache.get(api_key)
+    if not project:
+        return jsonify({'error': 'Projeto não encontrado'}), 404
+
+    project_id = project.id
+    chunk_size = current_app.config['BULK_COMMIT_SIZE']
+    max_line_bytes = current_app.config['BULK_MAX_LINE_BYTES']
+    stream = request.stream
+
+    def generate():
+        defaults = {}
+        pending = []
+        counts = dict.fromkeys(('accepted', 'rejected', 'failed'), 0)
+
+        def flush():
+            try:
+                ids = outbox_worker.enqueue_many(project_id, [message for _, message in pending])
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Erro ao enfileirar lote: {str(e)}")
+                counts['failed'] += len(pending)
+                results = ''.join(json.dumps({'line': line, 'status': 'failed',
+                                              'error': 'Erro ao enfileirar mensagem'}) + '\n'
+                                  for line, _ in pending)
+            else:
+                counts['accepted'] += len(pending)
+                results = ''.join(json.dumps({'line': line, 'status': 'accepted', 'job_id': job_id}) + '\n'
+                                  for (line, _), job_id in zip(pending, ids))
+            del pending[:]
+            return results
+
+        for line_number, raw in iter_ndjson_lines(stream, max_line_bytes):
+            if raw is None:
+                counts['rejected'] += 1
+                yield json.dumps({'line': line_number, 'status': 'rejected',
+                                  'error': 'Linha excede o tamanho máximo'}) + '\n'
+                continue
+            if not raw.strip():
+                continue
+            try:
+                item = json.loads(raw)
+            except ValueError:
+                counts['rejected'] += 1
+                yield json.dumps({'line': line_number, 'status': 'rejected',
+                                  'error': 'JSON inválido'}) + '\n'
+                continue
+
+            # Linha {"defaults": {...}} define campos comuns às linhas seguintes
+            if isinstance(item, dict) and 'defaults' in item:
+                if isinstance(item['defaults'], dict):
+                    defaults = {key: value for key, value in item['defaults'].items()
+                                if key in BULK_MESSAGE_FIELDS}
+                continue
+
+            message, error = build_bulk_message(item, defaults)
+            if error:
+                counts['rejected'] += 1
+                yield json.dumps({'line': line_number, 'status': 'rejected', 'error': error}) + '\n'
+                continue
+
+            pending.append((line_number, message))
+            if len(pending) >= chunk_size:
+                yield flush()
+
+        if pending:
+            yield flush()
+        yield json.dumps({'summary': counts}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def merge_attachments(attachments):
+    """Validate [filename, content_type, base64] entries of a merge template."""
+    if not isinstance(attachments, list):
+        return None, 'Anexos devem ser uma lista de [filename, content_type, base64]'
+    result = []
+    for attachment in attachments:
+        if (not isinstance(attachment, list) or len(attachment) != 3
+                or not all(isinstance(part, str) for part in attachment)):
+            return None, 'Anexos devem ser uma lista de [filename, content_type, base64]'
+        filename, content_type, content = attachment
+        maintype, _, subtype = content_type.partition('/')
+        if not maintype or not subtype:
+            return None, f'Content-type inválido no anexo {filename}'
+        try:
+            # Decodificado de novo pelo worker em cada envio (jobs.load_template)
+            base64.b64decode(content)
+        except ValueError:
+            return None, f'Conteúdo do anexo {filename} não está em base64'
+        result.append(tuple(attachment))
+    return result, None
+
+@app.route('/send-merge', methods=['POST'])
+def send_merge_route():
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'Dados inválidos'}), 400
+
+    required_params = ['recipients', 'api_key', 'sender']
+    missing_params = [param for param in required_params if param not in data or not data[param]]
+    if missing_params:
+        return jsonify({'error': f'Parâmetros obrigatórios ausentes: {", ".join(missing_params)}'}), 400
+
+    if not isinstance(data['recipients'], list) or not is_valid_email(data['sender']):
+        return jsonify({'error': 'Dados inválidos'}), 400
+
+    subject, reply_to = data.get('subject', 'Sem assunto'), data.get('reply_to')
+    if (not isinstance(subject, str) or not isinstance(reply_to or '', str)
+            or has_newline(reply_to)):
+        return jsonify({'error': 'Dados inválidos'}), 400
+
+    project = project_cache.get(data['api_key'])
+    if not project:
+        return jsonify({'error': 'Projeto não encontrado'}), 404
+
+    # Cada destinatário: "email" ou {"email": ..., "vars": {...}}
+    recipients, rejected = [], []
+    for item in data['recipients']:
+        if isinstance(item, str):
+            item = {'email': item}
+        email = item.get('email') if isinstance(item, dict) else None
+        variables = item.get('vars') or {} if isinstance(item, dict) else None
+        if not isinstance(email, str) or not is_valid_email(email) or not isinstance(variables, dict):
+            rejected.append(email if isinstance(email, str) else item)
+            continue
+        # Variável com quebra de linha no Subject (ou no To) injetaria cabeçalhos
+        if has_newline(email) or has_newline(render_merge(subject, dict(variables, email=email))):
+            rejected.append(email)
+            continue
+        recipients.append({'email': email, 'vars': variables})
+
+    if not recipients:
+        return jsonify({'error': 'Lista de destinatários inválida', 'rejected': rejected}), 400
+
+    attachments, error = merge_attachments(data.get('attachments') or [])
+    if error:
+        return jsonify({'error': error}), 400
+
+    template = MailTemplate(project_id=project.id, payload=serialize_message({
+        'subject': subject,
+        'body': data.get('body', ''),
+        'html_content': data.get('html_content'),
+        'sender': data['sender'],
+        'reply_to': reply_to,
+        'attachments': attachments,
+    }))
+    db.session.add(template)
+    db.session.flush()
+
+    chunk_size = current_app.config['MERGE_CHUNK_SIZE']
+    job_ids = outbox_worker.enqueue_many(project.id, [
+        {'kind': 'merge', 'template_id': template.id, 'recipients': recipients[i:i + chunk_size]}
+        for i in range(0, len(recipients), chunk_size)
+    ])
+
+    return jsonify({
+        'message': 'Mala direta enfileirada para envio',
+        'template_id': template.id,
+        'recipients': len(recipients),
+        'rejected': rejected,
+        'job_ids': job_ids
+    }), 202
@@ -0,0 +1,289 @@
+"""
+SMTP transaction helpers on top of smtplib.
+
+``send_message`` mirrors ``smtplib.SMTP.sendmail`` but writes the message
+body to the socket chunk by chunk instead of requiring the whole message
+as one bytes object, and uses the ESMTP extensions the relay advertises:
+
+- PIPELINING (RFC 2920): MAIL, every RCPT and DATA go out in one write and
+  their replies are read together, one round trip instead of one per
+  command.
+- CHUNKING (RFC 3030): the body is sent as ``BDAT`` segments, with no
+  dot-stuffing and no terminator scan on the server; with PIPELINING the
+  segments are not acknowledged one by one.
+- 8BITMIME / SMTPUTF8 (RFC 6152, RFC 6531): an ``EightBitBody`` is rendered
+  with raw UTF-8 text parts instead of base64/quoted-printable, and UTF-8
+  addresses are accepted.
+
+Anything the relay does not advertise falls back to plain RFC 5321.
+"""
+
+import re
+import smtplib
+from metrics import SendTiming
+
+CRLF = b'\r\n'
+EOL = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+
+# Extensões que send_message sabe usar, em minúsculas como em esmtp_features
+EXTENSIONS = ('pipelining', 'chunking', '8bitmime', 'smtputf8')
+BDAT_CHUNK_SIZE = 128 * 1024
+# Segmentos BDAT enviados antes de parar para ler as respostas
+BDAT_WINDOW = 16
+
+
+class EightBitBody(object):
+    """Message content serialized once the relay's extensions are known.
+
+    ``render(eightbit)`` returns the message like any other ``msg`` (bytes
+    or byte chunks). It is called with ``eightbit=True`` only when the relay
+    advertises 8BITMIME, and the transaction then declares BODY=8BITMIME.
+    """
+
+    def __init__(self, render):
+        self.render = render
+
+
+class DotStuffer(object):
+    """Applies SMTP dot-stuffing (RFC 5321 4.5.2) across chunk boundaries."""
+
+    def __init__(self):
+        # O início da mensagem conta como início de linha
+        self.tail = CRLF
+
+    @property
+    def ends_with_crlf(self):
+        return self.tail == CRLF
+
+    def __call__(self, chunk):
+        if not chunk:
+            return chunk
+        if self.tail == CRLF and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+        elif self.tail.endswith(b'\r') and chunk.startswith(b'\n.'):
+            chunk = b'\n.' + chunk[1:]
+        chunk = chunk.replace(b'\r\n.', b'\r\n..')
+        self.tail = (self.tail + chunk)[-2:]
+        return chunk
+
+
+def iter_chunks(msg, eightbit=False):
+    """Normalize a message (bytes, str, callable, iterable or EightBitBody) to byte chunks."""
+    if isinstance(msg, EightBitBody):
+        msg = msg.render(eightbit)
+    if callable(msg):
+        msg = msg()
+    if isinstance(msg, str):
+        msg = msg.encode('ascii')
+    if isinstance(msg, bytes):
+        return [EOL.sub(CRLF, msg)]
+    return msg
+
+
+def negotiate(host, disabled=()):
+    """Return the supported extensions advertised in the last EHLO."""
+    if not host.does_esmtp:
+        return set()
+    return {name for name in EXTENSIONS if name not in disabled and host.has_extn(name)}
+
+
+def _write(host, data, timing):
+    if isinstance(data, str):
+        data = data.encode(host.command_encoding)
+    host.send(data)
+    timing.wire_bytes += len(data)
+
+
+def _read_replies(host, count, timing):
+    """Read the replies to ``count`` commands already written.
+
+    Waiting for the first one is a round trip; the others were pipelined
+    behind it.
+    """
+    timing.round_trips += 1
+    replies = []
+    for _ in range(count):
+        reply = host.getreply()
+        replies.append(reply)
+        if reply[0] == 421:
+            # O servidor está encerrando a conexão: não virão outras respostas
+            break
+    timing.rtt_saved += len(replies) - 1
+    return replies
+
+
+def _command(host, line, timing):
+    _write(host, line + '\r\n', timing)
+    return _read_replies(host, 1, timing)[0]
+
+
+def _address_command(verb, address, options):
+    return '%s:%s%s' % (verb, smtplib.quoteaddr(address),
+                        ''.join(' ' + option for option in options))
+
+
+def stream_data(host, chunks, timing):
+    """Stream ``chunks`` after a 354 reply to DATA; returns the final reply."""
+    stuff = DotStuffer()
+    sent = 0
+    pending = b''
+    for chunk in chunks:
+        if chunk:
+            if pending:
+                _write(host, pending, timing)
+            pending = stuff(chunk)
+            sent += len(pending)
+    # O terminador vai no mesmo write do último bloco: dois writes pequenos
+    # seguidos esperariam o ACK atrasado do servidor (Nagle)
+    _write(host, pending + (b'.' + CRLF if stuff.ends_with_crlf else CRLF + b'.' + CRLF), timing)
+    timing.data_bytes += sent
+    return _read_replies(host, 1, timing)[0]
+
+
+def _bdat_segments(chunks, chunk_size):
+    """Regroup byte chunks into (data, last) segments of about ``chunk_size`` bytes."""
+    buffer = []
+    size = 0
+    ready = None
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            # Segura um segmento pronto até saber se ele é o último
+            if ready is not None:
+                yield ready, False
+            ready = b''.join(buffer)
+            buffer, size = [], 0
+    if ready is not None and buffer:
+        yield ready, False
+        ready = None
+    yield (ready if ready is not None else b''.join(buffer)), True
+
+
+def stream_bdat(host, chunks, timing, pipelining=False, chunk_size=BDAT_CHUNK_SIZE):
+    """Send the body as BDAT segments; returns the reply to the last one.
+
+    Without PIPELINING every segment waits for its reply. With it, up to
+    ``BDAT_WINDOW`` segments are in flight before the replies are read.
+    The first failed reply is returned and nothing else is sent after it.
+    """
+    window = BDAT_WINDOW if pipelining else 1
+    outstanding = 0
+    reply = None
+    for data, last in _bdat_segments(chunks, chunk_size):
+        # Comando e segmento no mesmo write, pelo mesmo motivo do terminador em stream_data
+        _write(host, b'BDAT %d%s\r\n%s' % (len(data), b' LAST' if last else b'', data), timing)
+        timing.data_bytes += len(data)
+        outstanding += 1
+        if outstanding >= window or last:
+            replies = _read_replies(host, outstanding, timing)
+            outstanding = 0
+            for reply in replies:
+                if reply[0] != 250:
+                    return reply
+    return reply
+
+
+def _abort(host, code, data_reply, timing):
+    """Leave the session clean after a refused MAIL or RCPT."""
+    if code == 421:
+        host.close()
+        return
+    if data_reply is not None and data_reply[0] == 354:
+        # DATA foi aceito dentro do pipeline: encerra a mensagem vazia antes do RSET
+        _write(host, b'.' + CRLF, timing)
+        _read_replies(host, 1, timing)
+    host._rset()
+
+
+def send_message(host, from_addr, to_addrs, msg, mail_options=(), rcpt_options=(),
+                 timing=None, disabled_extensions=(), chunk_size=BDAT_CHUNK_SIZE):
+    """Run one mail transaction; same contract as smtplib's sendmail.
+
+    Returns a dict of refused recipients. Raises SMTPSenderRefused,
+    SMTPRecipientsRefused (all refused), SMTPDataError or, for UTF-8
+    addresses on a relay without SMTPUTF8, SMTPNotSupportedError.
+
+    When a ``SendTiming`` is given, the phases are timed (``envelope`` for a
+    pipelined MAIL/RCPT group, ``mail`` and ``rcpt`` otherwise, then
+    ``data``) and the bytes written, round trips and round trips saved by
+    pipelining are counted. ``disabled_extensions`` turns off extensions the
+    relay advertises but should not be used.
+    """
+    timing = timing if timing is not None else SendTiming()
+    host.ehlo_or_helo_if_needed()
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    extensions = negotiate(host, disabled_extensions)
+    timing.extensions = sorted(extensions)
+    pipelining = 'pipelining' in extensions
+    chunking = 'chunking' in extensions
+    eightbit = isinstance(msg, EightBitBody) and '8bitmime' in extensions
+
+    options = list(mail_options) if host.does_esmtp else []
+    names = {option.split('=', 1)[0].lower() for option in options}
+    if 'smtputf8' in names or not all(addr.isascii() for addr in [from_addr] + list(to_addrs)):
+        if 'smtputf8' not in extensions:
+            raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+        if 'smtputf8' not in names:
+            options.append('SMTPUTF8')
+        host.command_encoding = 'utf-8'
+    if eightbit and 'body' not in names:
+        options.append('BODY=8BITMIME')
+    rcpt_options = list(rcpt_options) if host.does_esmtp else []
+
+    commands = ['MAIL ' + _address_command('FROM', from_addr, options)]
+    commands += ['RCPT ' + _address_command('TO', addr, rcpt_options) for addr in to_addrs]
+    if pipelining:
+        # Com CHUNKING o corpo vai em BDAT depois das respostas; sem ele, DATA entra no grupo
+        if not chunking:
+            commands.append('DATA')
+        with timing.phase('envelope'):
+            _write(host, ''.join(command + '\r\n' for command in commands), timing)
+            replies = _read_replies(host, len(commands), timing)
+    else:
+        with timing.phase('mail'):
+            replies = [_command(host, commands[0], timing)]
+        if replies[0][0] == 250:
+            for command in commands[1:]:
+                with timing.phase('rcpt'):
+                    replies.append(_command(host, command, timing))
+                if replies[-1][0] == 421:
+                    break
+    data_reply = replies[len(to_addrs) + 1] if len(replies) > len(to_addrs) + 1 else None
+
+    code, resp = replies[0]
+    if code != 250:
+        _abort(host, code, data_reply, timing)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr, (code, resp) in zip(to_addrs, replies[1:]):
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+        if code == 421:
+            host.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        _abort(host, None, data_reply, timing)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    chunks = iter_chunks(msg, eightbit)
+    with timing.phase('data'):
+        if chunking:
+            code, resp = stream_bdat(host, chunks, timing, pipelining, chunk_size)
+        else:
+            if data_reply is None:
+                data_reply = _command(host, 'DATA', timing)
+            code, resp = data_reply
+            if code == 354:
+                code, resp = stream_data(host, chunks, timing)
+    if code != 250:
+        if code == 421:
+            host.close()
+        else:
+            host._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
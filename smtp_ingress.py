@@ -0,0 +1,445 @@
+"""
+SMTP submission ingress for applications that cannot call the HTTP API.
+
+``SMTPIngress`` runs an asyncio server on its own thread. One event loop
+serves every client, so an idle connection costs a socket and a suspended
+coroutine instead of a thread, and thousands of them fit in one process.
+
+Clients authenticate with AUTH PLAIN using the project's ``api_key`` as the
+username (the password is not checked: the api_key is the credential, as in
+the HTTP API). DATA is written to a spool file as it arrives, never held in
+memory, and the message is queued in the outbox. The outbox worker relays
+it unchanged through the project's transport, the same one
+``send_custom_email`` uses. Database work (api_key lookup, enqueue) runs on a
+small thread pool so it never blocks the event loop.
+
+    python smtp_ingress.py
+"""
+
+import asyncio
+import base64
+import binascii
+import logging
+import os
+import re
+import socket
+import ssl
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from attachments import FileAttachment
+from jobs import outbox_worker
+from project_cache import project_cache
+from utils import is_valid_email
+
+# Limite de uma linha (comando ou DATA); RFC 5321 pede 1000, clientes antigos passam disso
+MAX_LINE = 1024 * 1024
+SPOOL_FLUSH = 64 * 1024
+MAX_AUTH_FAILURES = 3
+
+ADDRESS = re.compile(r'^(FROM|TO):\s*<([^>]*)>\s*(.*)$', re.IGNORECASE)
+# Argumento do EHLO/HELO, copiado no Received: nome de host ou literal de endereço
+HELO_NAME = re.compile(r'^(?:[A-Za-z0-9_-]{1,63}(?:\.[A-Za-z0-9_-]{1,63})*\.?'
+                       r'|\[(?:IPv6:[0-9A-Fa-f:.]+|[0-9.]+)\])$')
+
+logger = logging.getLogger('smtp_ingress')
+
+
+class IngressSession(object):
+    """State and command handlers of one client connection."""
+
+    def __init__(self, ingress, reader, writer):
+        self.ingress = ingress
+        self.reader = reader
+        self.writer = writer
+        self.peer = (writer.get_extra_info('peername') or ('desconhecido',))[0]
+        self.helo = None
+        self.tls = False
+        self.project = None
+        self.auth_failures = 0
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.mail_options = []
+        self.rcpt_to = []
+
+    async def reply(self, *lines):
+        self.writer.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+        await self.writer.drain()
+
+    async def readline(self, timeout):
+        return await asyncio.wait_for(self.reader.readline(), timeout)
+
+    async def run(self):
+        ingress = self.ingress
+        await self.reply('220 %s ESMTP ready' % ingress.hostname)
+        while True:
+            try:
+                line = await self.readline(ingress.idle_timeout)
+            except asyncio.TimeoutError:
+                await self.reply('421 4.4.2 %s Idle timeout, closing connection' % ingress.hostname)
+                return
+            except ValueError:
+                # Linha acima de MAX_LINE: o buffer do reader fica inconsistente
+                await self.reply('500 5.5.2 Line too long')
+                return
+            if not line:
+                return
+            command, _, arg = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+            handler = getattr(self, 'smtp_' + command.upper(), None)
+            if handler is None:
+                await self.reply('500 5.5.2 Command not recognized')
+                continue
+            if await handler(arg.strip()) is False:
+                return
+
+    def extensions(self):
+        ingress = self.ingress
+        extensions = ['SIZE %d' % ingress.max_message_size, '8BITMIME', 'PIPELINING',
+                      'ENHANCEDSTATUSCODES']
+        if ingress.ssl_context is not None and not self.tls:
+            extensions.append('STARTTLS')
+        if self.tls or not ingress.require_tls:
+            extensions.append('AUTH PLAIN')
+        return extensions
+
+    async def smtp_EHLO(self, arg):
+        if not arg or len(arg) > 255 or not HELO_NAME.fullmatch(arg):
+            await self.reply('501 5.5.4 Syntax: EHLO hostname')
+            return
+        self.helo = arg
+        self.reset()
+        lines = [self.ingress.hostname] + self.extensions()
+        await self.reply(*['250-' + line for line in lines[:-1]] + ['250 ' + lines[-1]])
+
+    async def smtp_HELO(self, arg):
+        if not arg or len(arg) > 255 or not HELO_NAME.fullmatch(arg):
+            await self.reply('501 5.5.4 Syntax: HELO hostname')
+            return
+        self.helo = arg
+        self.reset()
+        await self.reply('250 %s' % self.ingress.hostname)
+
+    async def smtp_STARTTLS(self, arg):
+        if self.ingress.ssl_context is None or self.tls:
+            await self.reply('502 5.5.1 STARTTLS not available')
+            return
+        if self.reader._buffer:
+            # Comandos enviados junto com o STARTTLS seriam lidos como se tivessem
+            # vindo pelo TLS (CVE-2011-0411): a conexão é encerrada
+            self.ingress.count('starttls_pipelined')
+            await self.reply('503 5.5.1 Commands pipelined after STARTTLS')
+            return False
+        await self.reply('220 2.0.0 Ready to start TLS')
+        await self.writer.start_tls(self.ingress.ssl_context)
+        # RFC 3207: o cliente recomeça do EHLO
+        self.tls = True
+        self.helo = None
+        self.project = None
+        self.reset()
+        self.ingress.count('starttls')
+
+    async def smtp_AUTH(self, arg):
+        if self.project is not None:
+            await self.reply('503 5.5.1 Already authenticated')
+            return
+        if self.ingress.require_tls and not self.tls:
+            await self.reply('538 5.7.11 Encryption required for requested authentication mechanism')
+            return
+        mechanism, _, response = arg.partition(' ')
+        if mechanism.upper() != 'PLAIN':
+            await self.reply('504 5.5.4 Unrecognized authentication type')
+            return
+        if not response:
+            await self.reply('334 ')
+            response = (await self.readline(self.ingress.idle_timeout)).decode('ascii', 'replace').strip()
+            if response == '*':
+                await self.reply('501 5.0.0 Authentication cancelled')
+                return
+        try:
+            _, api_key, _ = base64.b64decode(response, validate=True).decode('utf-8').split('\0')
+        except (ValueError, binascii.Error):
+            await self.reply('501 5.5.2 Invalid AUTH PLAIN response')
+            return
+
+        project = await self.ingress.call(project_cache.get, api_key) if api_key else None
+        if project is None:
+            self.auth_failures += 1
+            self.ingress.count('auth_failures')
+            await self.reply('535 5.7.8 Authentication credentials invalid')
+            return self.auth_failures < MAX_AUTH_FAILURES
+        self.project = project
+        await self.reply('235 2.7.0 Authentication successful')
+
+    async def smtp_MAIL(self, arg):
+        if self.project is None:
+            await self.reply('530 5.7.0 Authentication required')
+            return
+        if self.mail_from is not None:
+            await self.reply('503 5.5.1 Nested MAIL command')
+            return
+        match = ADDRESS.match(arg)
+        if not match or match.group(1).upper() != 'FROM':
+            await self.reply('501 5.5.4 Syntax: MAIL FROM:<address>')
+            return
+        address, params = match.group(2), match.group(3).upper().split()
+        if not address or not is_valid_email(address):
+            await self.reply('553 5.1.7 Sender address required')
+            return
+        options = []
+        for param in params:
+            name, _, value = param.partition('=')
+            if name == 'SIZE' and value.isdigit() and int(value) > self.ingress.max_message_size:
+                await self.reply('552 5.3.4 Message size exceeds fixed limit')
+                return
+            if name == 'BODY':
+                if value not in ('7BIT', '8BITMIME'):
+                    await self.reply('501 5.5.4 Unsupported BODY type')
+                    return
+                options.append(param)
+            elif name == 'SMTPUTF8':
+                options.append(param)
+        self.mail_from = address
+        # Repassados no envio ao relay (RFC 6152: o corpo 8 bits continua declarado)
+        self.mail_options = options
+        await self.reply('250 2.1.0 OK')
+
+    async def smtp_RCPT(self, arg):
+        if self.mail_from is None:
+            await self.reply('503 5.5.1 Need MAIL command')
+            return
+        match = ADDRESS.match(arg)
+        if not match or match.group(1).upper() != 'TO':
+            await self.reply('501 5.5.4 Syntax: RCPT TO:<address>')
+            return
+        address = match.group(2)
+        if not is_valid_email(address):
+            await self.reply('553 5.1.3 Invalid recipient address')
+            return
+        if len(self.rcpt_to) >= self.ingress.max_recipients:
+            await self.reply('452 4.5.3 Too many recipients')
+            return
+        self.rcpt_to.append(address)
+        await self.reply('250 2.1.5 OK')
+
+    async def smtp_DATA(self, arg):
+        if not self.rcpt_to:
+            await self.reply('503 5.5.1 Need RCPT command')
+            return
+        await self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+        ingress = self.ingress
+        fd, path = tempfile.mkstemp(prefix='smtp-', dir=ingress.spool_dir)
+        spool = FileAttachment(path, 0)
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                size = target.write(self.received_header())
+                too_big = False
+                pending, buffered = [], 0
+                while True:
+                    line = await self.readline(ingress.data_timeout)
+                    if not line:
+                        raise ConnectionError('conexão encerrada durante o DATA')
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    if line.startswith(b'.'):
+                        line = line[1:]
+                    if not line.endswith(b'\r\n'):
+                        line = line.rstrip(b'\r\n') + b'\r\n'
+                    size += len(line)
+                    if size > ingress.max_message_size:
+                        # Continua lendo até o "." para responder no ponto certo
+                        too_big = True
+                        continue
+                    pending.append(line)
+                    buffered += len(line)
+                    if buffered >= SPOOL_FLUSH:
+                        target.write(b''.join(pending))
+                        pending, buffered = [], 0
+                target.write(b''.join(pending))
+            spool.size = size
+        except BaseException:
+            spool.discard()
+            raise
+
+        if too_big:
+            spool.discard()
+            self.reset()
+            await self.reply('552 5.3.4 Message size exceeds fixed limit')
+            return
+
+        message = {'kind': 'raw', 'sender': self.mail_from, 'recipients': self.rcpt_to,
+                   'mail_options': self.mail_options, 'spool': spool.path, 'size': spool.size}
+        try:
+            job_id = await ingress.call(ingress.enqueue, self.project.id, message)
+        except Exception as e:
+            spool.discard()
+            logger.error('Erro ao enfileirar mensagem de %s (projeto %s): %s',
+                         self.peer, self.project.id, e)
+            await self.reply('451 4.3.0 Temporary failure, try again later')
+        else:
+            ingress.count('messages')
+            ingress.count('message_bytes', spool.size)
+            await self.reply('250 2.0.0 OK: queued as %d' % job_id)
+        self.reset()
+
+    def received_header(self):
+        # RFC 3848: ESMTPA / ESMTPSA indicam sessão autenticada, com ou sem TLS
+        protocol = 'ESMTPSA' if self.tls else 'ESMTPA'
+        return ('Received: from %s ([%s])\r\n\tby %s with %s id %s;\r\n\t%s\r\n'
+                % (self.helo or 'unknown', self.peer, self.ingress.hostname, protocol,
+                   uuid.uuid4().hex[:16], formatdate(localtime=True))).encode('utf-8')
+
+    async def smtp_RSET(self, arg):
+        self.reset()
+        await self.reply('250 2.0.0 OK')
+
+    async def smtp_NOOP(self, arg):
+        await self.reply('250 2.0.0 OK')
+
+    async def smtp_VRFY(self, arg):
+        await self.reply('252 2.5.0 Cannot VRFY user')
+
+    async def smtp_QUIT(self, arg):
+        await self.reply('221 2.0.0 Bye')
+        return False
+
+
+class SMTPIngress(object):
+    """Asyncio SMTP submission server feeding the outbox."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.ssl_context = None
+        self.connections = 0
+        self._counters = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._executor = None
+        self._ready = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        config = app.config
+        self.host = config.get('SMTP_INGRESS_HOST', '127.0.0.1')
+        self.port = config.get('SMTP_INGRESS_PORT', 2525)
+        self.hostname = config.get('SMTP_INGRESS_HOSTNAME') or socket.getfqdn()
+        self.max_connections = config.get('SMTP_INGRESS_MAX_CONNECTIONS', 10000)
+        self.max_message_size = config.get('SMTP_INGRESS_MAX_MESSAGE_SIZE', 25 * 1024 * 1024)
+        self.max_recipients = config.get('SMTP_INGRESS_MAX_RECIPIENTS', 100)
+        self.idle_timeout = config.get('SMTP_INGRESS_IDLE_TIMEOUT', 300)
+        self.data_timeout = config.get('SMTP_INGRESS_DATA_TIMEOUT', 600)
+        self.workers = config.get('SMTP_INGRESS_WORKERS', 4)
+        self.spool_dir = config['SPOOL_DIR']
+        certfile = config.get('SMTP_INGRESS_TLS_CERT')
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, config.get('SMTP_INGRESS_TLS_KEY'))
+        # Com certificado, AUTH só depois do STARTTLS
+        self.require_tls = self.ssl_context is not None
+        app.extensions['smtp_ingress'] = self
+        if config.get('SMTP_INGRESS_ENABLED', False):
+            self.start()
+
+    def count(self, name, amount=1):
+        # Chamado só na thread do event loop
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def stats(self):
+        return dict(self._counters, connections=self.connections,
+                    running=self._thread is not None and self._thread.is_alive())
+
+    def enqueue(self, project_id, message):
+        return outbox_worker.enqueue_many(project_id, [message])[0]
+
+    async def call(self, fn, *args):
+        """Run blocking (database) work on the worker threads, inside an app context."""
+        def run():
+            with self.app.app_context():
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+
+    async def _handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.count('refused_connections')
+            writer.write(b'421 4.3.2 Too many connections, try again later\r\n')
+            writer.close()
+            return
+        self.connections += 1
+        self.count('accepted_connections')
+        session = IngressSession(self, reader, writer)
+        try:
+            await session.run()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        except Exception as e:
+            logger.error('Erro na sessão SMTP de %s: %s', session.peer, e)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _serve(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port,
+                                                  limit=MAX_LINE, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        logger.info('SMTP ingress ouvindo em %s:%d', self.host, self.port)
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def serve_forever(self):
+        """Run the server on the calling thread until stop()."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='smtp-ingress')
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._ready.set()
+
+    def start(self):
+        """Run the server on a background thread; returns once it is listening."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self.serve_forever, name='smtp-ingress',
+                                        daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._server is None:
+            raise RuntimeError('SMTP ingress não iniciou em %s:%s' % (self.host, self.port))
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        if self._thread is not None:
+            self._thread.join(5)
+        self._server = None
+        self._thread = None
+
+
+smtp_ingress = SMTPIngress()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    logging.basicConfig(level=logging.INFO)
+    application = create_app()
+    if application.config.get('OUTBOX_WORKER_ENABLED', True):
+        outbox_worker.start()
+    if smtp_ingress._thread is not None:
+        smtp_ingress._thread.join()
+    else:
+        smtp_ingress.serve_forever()
@@ -0,0 +1,346 @@
+"""
+Process-wide pool of authenticated SMTP sessions.
+
+Sessions are keyed by the transport's (server, port, use_tls, username) plus
+a digest of its credentials, so every project mailbox reuses its own
+authenticated connection instead of paying the connect/EHLO/STARTTLS/AUTH
+handshake on every message, and never one authenticated with another
+password. Direct delivery (mta.py) pools unauthenticated sessions per MX
+host the same way.
+"""
+
+import atexit
+import smtplib
+import socket
+import threading
+import time
+from smtp_client import send_message, BDAT_CHUNK_SIZE
+from governor import governor, RateLimited
+from metrics import SendTiming, smtp_metrics
+from transport import OPPORTUNISTIC_TLS
+from circuit import breakers, CircuitOpen
+import stats
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def smtp_error_reply(exc):
+    """Return the (code, message) SMTP reply carried by an exception."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = sorted(exc.recipients.values())
+        return replies[0] if replies else (None, b'')
+    return getattr(exc, 'smtp_code', None), getattr(exc, 'smtp_error', b'')
+
+
+def smtp_error_code(exc):
+    """Return the SMTP reply code carried by an exception, if any."""
+    return smtp_error_reply(exc)[0]
+
+
+def is_transient_error(exc):
+    """Whether a failed send is worth retrying later.
+
+    Network failures, pool exhaustion and 4xx replies are transient; 5xx
+    replies and malformed messages are permanent.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    code = smtp_error_code(exc)
+    if code is not None and code >= 0:
+        return 400 <= code < 500
+    return isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                            PoolTimeout, RateLimited, CircuitOpen, OSError))
+
+
+class PooledSession(object):
+    """An SMTP session owned by the pool."""
+
+    def __init__(self, key, host):
+        self.key = key
+        self.host = host
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages = 0
+        self.reused = False
+
+    def close(self):
+        try:
+            self.host.quit()
+        except Exception:
+            try:
+                self.host.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool(object):
+    """Keeps authenticated SMTP sessions alive between messages.
+
+    Each key holds at most ``max_size`` open sessions. Idle sessions are
+    health-checked with NOOP before reuse, reset with RSET after a failed
+    transaction and closed once they sit idle longer than ``idle_timeout``.
+    """
+
+    def __init__(self, app=None):
+        self.max_size = 4
+        self.idle_timeout = 60
+        self.healthcheck_interval = 5
+        self.checkout_timeout = 30
+        self.socket_timeout = 30
+        self.max_messages = None
+        self.disabled_extensions = ()
+        self.bdat_chunk_size = BDAT_CHUNK_SIZE
+        self.helo_hostname = None
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Condition()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.get('SMTP_POOL_SIZE', self.max_size)
+        self.idle_timeout = app.config.get('SMTP_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.healthcheck_interval = app.config.get('SMTP_POOL_HEALTHCHECK_INTERVAL',
+                                                   self.healthcheck_interval)
+        self.checkout_timeout = app.config.get('SMTP_POOL_CHECKOUT_TIMEOUT', self.checkout_timeout)
+        self.socket_timeout = app.config.get('SMTP_TIMEOUT', self.socket_timeout)
+        self.max_messages = app.config.get('MAIL_MAX_EMAILS')
+        self.disabled_extensions = tuple(app.config.get('SMTP_DISABLED_EXTENSIONS',
+                                                        self.disabled_extensions))
+        self.bdat_chunk_size = app.config.get('SMTP_BDAT_CHUNK_SIZE', self.bdat_chunk_size)
+        # Nome no EHLO; None usa o FQDN da máquina (os MX costumam conferi-lo)
+        self.helo_hostname = app.config.get('SMTP_HELO_HOSTNAME', self.helo_hostname)
+        app.extensions['smtp_pool'] = self
+
+    def _connect(self, transport, timing):
+        with timing.phase('dns'):
+            addresses = socket.getaddrinfo(transport.server, transport.port, 0, socket.SOCK_STREAM)
+        smtp_class = smtplib.SMTP_SSL if transport.use_ssl else smtplib.SMTP
+        host = smtp_class(local_hostname=self.helo_hostname, timeout=self.socket_timeout)
+        # Conecta ao endereço já resolvido, mas mantém o nome do servidor para TLS
+        host._host = transport.server
+        try:
+            with timing.phase('connect'):
+                for _, _, _, _, address in addresses:
+                    try:
+                        code, msg = host.connect(address[0], address[1])
+                        break
+                    except OSError as e:
+                        error = e
+                        host.close()
+                else:
+                    raise error
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, msg)
+            with timing.phase('ehlo'):
+                host.ehlo()
+            if transport.use_tls and (transport.use_tls != OPPORTUNISTIC_TLS
+                                      or host.has_extn('starttls')):
+                with timing.phase('starttls'):
+                    host.starttls()
+                with timing.phase('ehlo'):
+                    host.ehlo()
+            if transport.username and transport.password:
+                with timing.phase('auth'):
+                    host.login(transport.username, transport.password)
+        except Exception:
+            host.close()
+            raise
+        return host
+
+    def _is_healthy(self, session, timing):
+        try:
+            with timing.phase('noop'):
+                code, _ = session.host.noop()
+        except Exception:
+            return False
+        return code == 250
+
+    def _evict_expired(self, now):
+        """Remove expired idle sessions. Must be called with the lock held."""
+        expired = []
+        for key, sessions in self._idle.items():
+            keep = []
+            for session in sessions:
+                if now - session.last_used > self.idle_timeout:
+                    expired.append(session)
+                    self._open[key] -= 1
+                else:
+                    keep.append(session)
+            self._idle[key] = keep
+        if expired:
+            self._lock.notify_all()
+        return expired
+
+    def acquire(self, transport, timing=None):
+        """Check out a live session, opening a new one if none is idle."""
+        timing = timing if timing is not None else SendTiming()
+        key = transport.pool_key
+        waiting_since = time.perf_counter()
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                expired = self._evict_expired(now)
+                session = None
+                full = False
+                idle = self._idle.get(key)
+                if idle:
+                    session = idle.pop()
+                elif self._open.get(key, 0) < self.max_size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                else:
+                    remaining = deadline - now
+                    if remaining <= 0 and not expired:
+                        raise PoolTimeout('Nenhuma conexão SMTP disponível para %s:%s'
+                                          % (key[0], key[1]))
+                    if not expired:
+                        self._lock.wait(remaining)
+                    full = True
+            # Fora do lock, inclusive quando não havia vaga para a chave
+            for stale in expired:
+                stale.close()
+            if full:
+                continue
+            timing.add('pool_wait', time.perf_counter() - waiting_since)
+
+            if session is not None:
+                if (time.monotonic() - session.last_used < self.healthcheck_interval
+                        or self._is_healthy(session, timing)):
+                    session.reused = True
+                    timing.reused = True
+                    return session
+                self._discard(session)
+                waiting_since = time.perf_counter()
+                continue
+
+            try:
+                host = self._connect(transport, timing)
+            except Exception:
+                self._forget(key)
+                raise
+            timing.reused = False
+            return PooledSession(key, host)
+
+    def release(self, session, reset=True):
+        """Return a session to the pool, resetting it with RSET if asked.
+
+        A transaction that ended with 250 after the body already left the
+        server in its initial state, so the RSET can be skipped.
+        """
+        session.messages += 1
+        session.last_used = time.monotonic()
+        if self.max_messages and session.messages >= self.max_messages:
+            self._discard(session)
+            return
+        if reset:
+            try:
+                session.host.rset()
+            except Exception:
+                self._discard(session)
+                return
+        with self._lock:
+            self._idle.setdefault(session.key, []).append(session)
+            self._lock.notify()
+
+    def _forget(self, key):
+        with self._lock:
+            self._open[key] -= 1
+            self._lock.notify()
+
+    def _discard(self, session):
+        self._forget(session.key)
+        session.close()
+
+    def sendmail(self, transport, from_addr, to_addrs, msg,
+                 mail_options=(), rcpt_options=()):
+        """Send a message through a pooled session.
+
+        ``msg`` is either bytes or a callable returning an iterable of byte
+        chunks, which are streamed during DATA. A reused session that turns
+        out to be dropped by the server is discarded and the message is
+        retried once on a fresh connection.
+
+        Sends are paced by the rate governor, which also learns from
+        throttling replies, and go through the relay's circuit breaker,
+        which may reroute them to the failover relay or refuse them with
+        CircuitOpen while the relay is down. Each phase is timed and recorded in
+        ``smtp_metrics``; the project's counters are added up in memory and
+        written by the next commit (see stats.py).
+        """
+        timing = SendTiming()
+        recipients = 1 if isinstance(to_addrs, str) else len(to_addrs)
+        transport = breakers.route(transport)
+        try:
+            with timing.phase('governor'):
+                governor.acquire(transport)
+            refused = self._sendmail(transport, from_addr, to_addrs, msg,
+                                     mail_options, rcpt_options, timing)
+        except smtplib.SMTPException as e:
+            governor.report(transport, *smtp_error_reply(e))
+            smtp_metrics.record(transport, timing, recipients, e)
+            stats.record_send(transport, timing, e)
+            breakers.record(transport, timing, e)
+            raise
+        except Exception as e:
+            smtp_metrics.record(transport, timing, recipients, e)
+            stats.record_send(transport, timing, e)
+            breakers.record(transport, timing, e)
+            raise
+        governor.report(transport)
+        smtp_metrics.record(transport, timing, recipients)
+        stats.record_send(transport, timing)
+        breakers.record(transport, timing)
+        return refused
+
+    def _sendmail(self, transport, from_addr, to_addrs, msg, mail_options, rcpt_options, timing):
+        while True:
+            session = self.acquire(transport, timing)
+            try:
+                refused = send_message(session.host, from_addr, to_addrs, msg,
+                                       mail_options, rcpt_options, timing,
+                                       self.disabled_extensions, self.bdat_chunk_size)
+            except smtplib.SMTPServerDisconnected:
+                self._discard(session)
+                if session.reused:
+                    continue
+                raise
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError):
+                # O servidor respondeu, a sessão continua utilizável
+                self.release(session)
+                raise
+            except Exception:
+                self._discard(session)
+                raise
+            self.release(session, reset=False)
+            # Round trip do RSET que deixou de ser feito
+            timing.rtt_saved += 1
+            return refused
+
+    def close_all(self):
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            for session in sessions:
+                self._open[session.key] -= 1
+            self._idle = {}
+            self._lock.notify_all()
+        for session in sessions:
+            session.close()
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for key in set(self._open) | set(self._idle):
+                # Chaves que só diferem na senha são somadas
+                entry = result.setdefault('%s:%s:%s' % (key[0], key[1], key[3] or ''),
+                                          {'open': 0, 'idle': 0})
+                entry['open'] += self._open.get(key, 0)
+                entry['idle'] += len(self._idle.get(key, []))
+        return result
+
+
+smtp_pool = SMTPConnectionPool()
+atexit.register(smtp_pool.close_all)
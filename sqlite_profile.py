@@ -0,0 +1,97 @@
+"""
+SQLite connection profiles.
+
+The ``production`` profile puts the database in WAL mode (readers no longer
+block the writer), relaxes fsync to ``synchronous=NORMAL``, gives each
+connection a larger page cache and a memory map, waits on locks with
+``busy_timeout`` instead of failing with "database is locked", and enforces
+foreign keys. The pool is sized for the request threads plus the outbox
+senders. Select it with ``SQLITE_PROFILE``; ``default`` keeps SQLite's
+own settings.
+
+``init_app`` must run before ``db.init_app``, which builds the engine from
+``SQLALCHEMY_ENGINE_OPTIONS``.
+"""
+
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+PROFILES = {
+    'default': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    'production': {
+        # Ordem importa: journal_mode antes dos demais
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 10000,        # ms
+            'cache_size': -64000,         # negativo = KiB (~64 MB por conexão)
+            'mmap_size': 268435456,       # 256 MB
+            'temp_store': 'MEMORY',
+            'foreign_keys': 'ON',
+        },
+        'engine_options': {
+            'pool_size': 16,
+            'max_overflow': 16,
+            'pool_timeout': 30,
+        },
+    },
+}
+
+
+class SQLiteProfile(object):
+    """Applies a profile's pragmas to every new SQLite connection."""
+
+    def __init__(self, app=None):
+        self.name = 'default'
+        self.pragmas = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.name = app.config.get('SQLITE_PROFILE', 'default')
+        try:
+            profile = PROFILES[self.name]
+        except KeyError:
+            raise ValueError('SQLITE_PROFILE inválido: %r (use %s)'
+                             % (self.name, ', '.join(sorted(PROFILES))))
+        app.extensions['sqlite_profile'] = self
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() != 'sqlite':
+            self.pragmas = {}
+            return
+
+        self.pragmas = dict(profile['pragmas'], **app.config.get('SQLITE_PRAGMAS', {}))
+        options = dict(profile['engine_options'])
+        if url.database in (None, '', ':memory:'):
+            # Banco em memória usa um pool de conexão única
+            options = {}
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    def apply(self, dbapi_connection):
+        if not self.pragmas:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            cursor.close()
+
+    def settings(self, connection):
+        """Current value of each profile pragma on a SQLAlchemy connection."""
+        return {name: connection.exec_driver_sql('PRAGMA %s' % name).scalar()
+                for name in self.pragmas}
+
+
+sqlite_profile = SQLiteProfile()
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_profile(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        sqlite_profile.apply(dbapi_connection)
@@ -1,6 +1,8 @@
 // Variáveis globais
 let token = localStorage.getItem('token');
 let projectsData = [];
+let statsTimer = null;
+const STATS_POLL_INTERVAL = 30000; // ms
 
 document.addEventListener('DOMContentLoaded', function() {
     // Verificar se o usuário está autenticado
@@ -114,13 +116,17 @@ function switchTab(tabId) {
 function loadDashboardData() {
     loadProjects(true); // Carrega apenas alguns projetos recentes
     loadStats(); // Carrega estatísticas
+    
+    // Atualiza os contadores periodicamente (uma única vez por página)
+    if (!statsTimer) {
+        statsTimer = setInterval(loadStats, STATS_POLL_INTERVAL);
+    }
 }
 
 // Carregar estatísticas
 function loadStats() {
-    // Aqui você pode fazer uma chamada API para obter estatísticas
-    // Por enquanto, vamos apenas mostrar o número de projetos
-    fetch('/api/projects', {
+    // Contadores mantidos pelo servidor; uma única consulta barata
+    fetch('/api/stats', {
         headers: {
             'Authorization': `Bearer ${token}`
         }
@@ -134,10 +140,8 @@ function loadStats() {
     .then(data => {
         // Atualizar estatísticas no dashboard
         document.getElementById('total-projects').textContent = data.projects.length;
-        
-        // Aqui você pode adicionar mais estatísticas quando a API fornecer
-        document.getElementById('verified-emails').textContent = '0'; // Placeholder
-        document.getElementById('sent-emails').textContent = '0'; // Placeholder
+        document.getElementById('verified-emails').textContent = data.totals.verified;
+        document.getElementById('sent-emails').textContent = data.totals.emails_sent;
     })
     .catch(error => {
         console.error('Erro ao carregar estatísticas:', error);
@@ -238,21 +242,35 @@ function handleCreateProject(e) {
     });
 }
 
-// Função para carregar projetos
-function loadProjects(onlyRecent = false) {
-    fetch('/api/projects', {
+// Busca todas as páginas de uma listagem seguindo o next_cursor
+function fetchAllPages(url, key, errorMessage, items = [], cursor = null) {
+    const separator = url.includes('?') ? '&' : '?';
+    const pageUrl = cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url;
+    return fetch(pageUrl, {
         headers: {
             'Authorization': `Bearer ${token}`
         }
     })
     .then(response => {
         if (!response.ok) {
-            throw new Error('Falha ao carregar projetos');
+            throw new Error(errorMessage);
         }
         return response.json();
     })
     .then(data => {
-        projectsData = data.projects;
+        items.push(...data[key]);
+        if (data.next_cursor) {
+            return fetchAllPages(url, key, errorMessage, items, data.next_cursor);
+        }
+        return items;
+    });
+}
+
+// Função para carregar projetos
+function loadProjects(onlyRecent = false) {
+    fetchAllPages('/api/projects', 'projects', 'Falha ao carregar projetos')
+    .then(projects => {
+        projectsData = projects;
         
         if (onlyRecent) {
             // Para o dashboard, mostrar apenas os 3 projetos mais recentes
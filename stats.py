@@ -0,0 +1,164 @@
+"""
+Per-project counters for the dashboard.
+
+Each project has one ``ProjectStats`` row, created together with the
+project. ``bump`` adds to its counters with a single ``UPDATE ... SET n =
+n + ?`` in the caller's transaction, so a counter is committed (or rolled
+back) with the registration, verification or outbox row it describes.
+Reading the stats is one small query however many users and emails the
+project has.
+
+Send counters are the exception: an UPDATE right after each SMTP send would
+hold the SQLite write lock through the following sends of a merge chunk or
+envelope. ``record_send`` only adds them up in memory, and the next commit
+of any session writes the pending totals at once.
+"""
+
+import logging
+import threading
+from collections import Counter
+from flask import has_app_context
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.orm import Session
+from models import db, Project, ProjectStats, VerificationStatus, user_projects
+
+COUNTERS = ('registered', 'verified', 'emails_sent', 'emails_failed', 'bytes_sent')
+
+logger = logging.getLogger('stats')
+
+
+def bump(project_id, **deltas):
+    """Add ``deltas`` to the project's counters; does not commit."""
+    deltas = {name: value for name, value in deltas.items() if value}
+    if not deltas:
+        return
+    table = ProjectStats.__table__
+    # Sem autoflush: o contador não depende das mudanças pendentes do chamador,
+    # que vão juntas no commit
+    with db.session.no_autoflush:
+        updated = db.session.execute(
+            update(table).where(table.c.project_id == project_id)
+            .values({name: table.c[name] + value for name, value in deltas.items()})
+        ).rowcount
+        if not updated:
+            # Projeto criado antes da tabela de contadores e ainda não migrado:
+            # conta uma vez a partir das tabelas (já inclui a mudança desta transação)
+            values = recount(project_id)
+            values.update({name: value for name, value in deltas.items() if name not in values})
+            db.session.execute(insert(table).values(project_id=project_id, **values))
+
+
+def recount(project_id):
+    """Counters derivable from the tables, as scalar subqueries.
+
+    Only used to create the row of a project that predates the counters;
+    emails sent before that are not recorded anywhere and start at zero.
+    """
+    statuses = VerificationStatus.__table__
+    return {
+        'registered': select(func.count()).select_from(user_projects)
+                      .where(user_projects.c.project_id == project_id).scalar_subquery(),
+        'verified': select(func.count()).select_from(statuses)
+                    .where(statuses.c.project_id == project_id,
+                           statuses.c.verified == True).scalar_subquery(),  # noqa: E712
+    }
+
+
+class PendingCounters(object):
+    """Send counters not yet written, per project."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, project_id, **deltas):
+        with self._lock:
+            self._pending.setdefault(project_id, Counter()).update(deltas)
+
+    def take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        with self._lock:
+            for project_id, deltas in pending.items():
+                self._pending.setdefault(project_id, Counter()).update(deltas)
+
+    def peek(self):
+        with self._lock:
+            return {project_id: dict(deltas) for project_id, deltas in self._pending.items()}
+
+
+pending_sends = PendingCounters()
+
+
+def record_send(transport, timing, error=None):
+    """Count one message handed to the SMTP server (or failed) for its project.
+
+    Called by the SMTP pool after every send. Nothing touches the database
+    here: the counters are written by the next commit (see
+    ``_flush_pending_sends``), so no lock is held during the next send.
+    """
+    if transport.project_id is None:
+        return
+    if error is None:
+        pending_sends.add(transport.project_id, emails_sent=1, bytes_sent=timing.data_bytes)
+    else:
+        pending_sends.add(transport.project_id, emails_failed=1)
+
+
+@event.listens_for(Session, 'before_commit')
+def _flush_pending_sends(session):
+    if not has_app_context() or session is not db.session():
+        return
+    pending = pending_sends.take()
+    if not pending:
+        return
+    try:
+        for project_id, deltas in pending.items():
+            bump(project_id, **deltas)
+    except Exception as e:
+        pending_sends.restore(pending)
+        logger.warning('Falha ao atualizar contadores de envio: %s', e)
+        return
+    # Devolvidos se o commit falhar
+    session.info.setdefault('pending_sends', []).append(pending)
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_pending_sends(session):
+    session.info.pop('pending_sends', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _restore_pending_sends(session):
+    for pending in session.info.pop('pending_sends', []):
+        pending_sends.restore(pending)
+
+
+def snapshot(project_id=None):
+    """Counters per project plus their totals."""
+    stmt = (select(ProjectStats, Project.name)
+            .join(Project, Project.id == ProjectStats.project_id)
+            .order_by(ProjectStats.project_id))
+    if project_id is not None:
+        stmt = stmt.where(ProjectStats.project_id == project_id)
+    projects = []
+    totals = dict.fromkeys(COUNTERS, 0)
+    # Envios ainda não gravados pelo próximo commit
+    pending = pending_sends.peek()
+    for stats, name in db.session.execute(stmt):
+        entry = {'project_id': stats.project_id, 'name': name}
+        unsaved = pending.get(stats.project_id, {})
+        for counter in COUNTERS:
+            entry[counter] = getattr(stats, counter) + unsaved.get(counter, 0)
+            totals[counter] += entry[counter]
+        projects.append(entry)
+    return {'totals': totals, 'projects': projects}
+
+
+@event.listens_for(Project, 'after_insert')
+def _create_project_stats(mapper, connection, target):
+    # Mesma transação do INSERT do projeto
+    connection.execute(insert(ProjectStats.__table__).values(project_id=target.id))
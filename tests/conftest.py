@@ -0,0 +1,59 @@
+import os
+import pytest
+from config import Config
+from models import db, Project
+from transport import transports
+from benchmarks.smtp_sink import SMTPSink
+
+
+@pytest.fixture
+def sink():
+    sink = SMTPSink(keep_messages=True)
+    sink.start()
+    yield sink
+    sink.stop()
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build an app on a throwaway SQLite database; ``overrides`` go on the config."""
+    apps = []
+
+    def make(**overrides):
+        settings = dict(
+            SECRET_KEY='test', JWT_SECRET_KEY='test',
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(str(tmp_path), 'test.db'),
+            SPOOL_DIR=os.path.join(str(tmp_path), 'spool'),
+            OUTBOX_WORKER_ENABLED=False,
+            SMTP_INGRESS_ENABLED=False,
+        )
+        settings.update(overrides)
+        config = type('TestConfig', (Config,), settings)
+
+        from app import create_app
+        app = create_app(config)
+        transports.invalidate()
+        with app.app_context():
+            db.create_all()
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(MAIL_SUPPRESS_SEND=True)
+
+
+@pytest.fixture
+def project(app):
+    with app.app_context():
+        row = Project(name='Teste', mail_username='contato@example.com', mail_password='secret')
+        db.session.add(row)
+        db.session.commit()
+        return {'id': row.id, 'api_key': row.api_key, 'name': row.name}
@@ -0,0 +1,46 @@
+import smtplib
+import socket
+import unittest
+from circuit import CircuitBreaker, send_verdict
+
+
+class SendVerdictTest(unittest.TestCase):
+
+    def test_relay_replies_mean_relay_is_up(self):
+        for error in (smtplib.SMTPRecipientsRefused({'x@example.com': (550, b'5.1.1 no such user')}),
+                      smtplib.SMTPAuthenticationError(535, b'5.7.8 bad credentials'),
+                      smtplib.SMTPDataError(554, b'5.7.1 rejected'),
+                      smtplib.SMTPSenderRefused(553, b'5.7.1 not allowed', 'a@example.com')):
+            self.assertEqual(send_verdict(error), 'success', error)
+
+    def test_unhealthy_relay_is_failure(self):
+        for error in (smtplib.SMTPResponseException(421, b'4.3.2 try later'),
+                      smtplib.SMTPServerDisconnected('closed'),
+                      smtplib.SMTPConnectError(421, b'busy'),
+                      socket.timeout('timed out'),
+                      ConnectionRefusedError()):
+            self.assertEqual(send_verdict(error), 'failure', error)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_refusals_and_auth_errors_keep_breaker_closed(self):
+        breaker = CircuitBreaker('smtp.example.com:587', failure_threshold=5, min_calls=4)
+        errors = [smtplib.SMTPRecipientsRefused({'x@example.com': (550, b'5.1.1 no such user')}),
+                  smtplib.SMTPAuthenticationError(535, b'5.7.8 bad credentials')] * 10
+        for now, error in enumerate(errors):
+            self.assertTrue(breaker.allow(now))
+            breaker.record(now, send_verdict(error), 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.trips, 0)
+
+    def test_network_failures_open_breaker(self):
+        breaker = CircuitBreaker('smtp.example.com:587', failure_threshold=5)
+        for now in range(5):
+            breaker.record(now, send_verdict(smtplib.SMTPServerDisconnected('closed')), 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import base64
+import email
+import json
+from email import policy
+import pytest
+from flask_mail import BadHeaderError
+from jobs import load_template, serialize_message
+from mailmerge import MessageTemplate, send_merge
+from models import db, MailTemplate, Outbox, Project
+
+INJECTED = 'x\r\nBcc: evil@example.com\r\n\r\ninjected'
+
+
+def test_render_refuses_line_breaks_in_headers():
+    template = MessageTemplate('Oi {{ name }}', 'contato@example.com', body='Olá {{ name }}')
+    with pytest.raises(BadHeaderError):
+        template.render('ana@example.com', {'name': INJECTED})
+    with pytest.raises(BadHeaderError):
+        template.render('ana@example.com\n', {'name': 'Ana'})
+
+
+def test_send_merge_rejects_recipients_with_injected_headers(app, project):
+    response = app.test_client().post('/api/send-merge', json={
+        'api_key': project['api_key'],
+        'sender': 'contato@example.com',
+        'subject': 'Oi {{ name }}',
+        'body': 'Olá {{ name }}',
+        'recipients': [{'email': 'ana@example.com', 'vars': {'name': 'Ana'}},
+                       {'email': 'evil@example.com', 'vars': {'name': INJECTED}}],
+    })
+    assert response.status_code == 202
+    assert response.get_json()['rejected'] == ['evil@example.com']
+    with app.app_context():
+        payload = json.loads(Outbox.query.one().payload)
+        assert [r['email'] for r in payload['recipients']] == ['ana@example.com']
+        assert MailTemplate.query.count() == 1
+
+
+def test_send_merge_rejects_reply_to_with_line_breaks(app, project):
+    response = app.test_client().post('/api/send-merge', json={
+        'api_key': project['api_key'],
+        'sender': 'contato@example.com',
+        'reply_to': 'a@example.com\r\nBcc: evil@example.com',
+        'recipients': ['ana@example.com'],
+    })
+    assert response.status_code == 400
+
+
+def parse(data):
+    return email.message_from_bytes(data, policy=policy.default)
+
+
+def test_render_personalizes_headers_and_body():
+    template = MessageTemplate('Oi {{ name }}', 'contato@example.com', body='Olá {{ name }}, {{ faltando }}!',
+                               html_content='<p>{{ name }}</p>')
+    message = parse(template.render('ana@example.com', {'name': '<Ana>'}))
+    assert message['Subject'] == 'Oi <Ana>'
+    assert message['To'] == 'ana@example.com'
+    assert message['Reply-To'] == 'contato@example.com'
+    assert message.get_body(('plain',)).get_content().strip() == 'Olá <Ana>, !'
+    # Valores são escapados na parte HTML
+    assert '<p>&lt;Ana&gt;</p>' in message.get_body(('html',)).get_content()
+
+
+def test_static_body_is_encoded_once():
+    template = MessageTemplate('Oi {{ name }}', 'contato@example.com', body='Corpo fixo')
+    first = parse(template.render('ana@example.com', {'name': 'Ana'}))
+    second = parse(template.render('bia@example.com', {'name': 'Bia'}))
+    assert list(template._static_body) == [False]
+    assert first.get_content() == second.get_content()
+    assert (first['Subject'], second['Subject']) == ('Oi Ana', 'Oi Bia')
+    assert first['Message-ID'] != second['Message-ID']
+
+
+def test_render_attaches_shared_attachments():
+    template = MessageTemplate('Oi', 'contato@example.com', body='Segue',
+                               attachments=[('nota.txt', 'text/plain', b'conteudo'),
+                                            ('dados.bin', 'sem-barra', b'\x00\x01')])
+    message = parse(template.render('ana@example.com'))
+    assert message.get_content_type() == 'multipart/mixed'
+    attachments = list(message.iter_attachments())
+    assert [a.get_filename() for a in attachments] == ['nota.txt', 'dados.bin']
+    assert attachments[0].get_content() == 'conteudo'
+    assert attachments[1].get_content_type() == 'application/octet-stream'
+
+
+def test_load_template_decodes_stored_attachments(app, project):
+    with app.app_context():
+        row = MailTemplate(project_id=project['id'], payload=serialize_message({
+            'subject': 'Oi {{ name }}', 'sender': 'contato@example.com', 'body': 'Olá',
+            'attachments': [('nota.txt', 'text/plain', base64.b64encode(b'conteudo').decode())]}))
+        db.session.add(row)
+        db.session.commit()
+        template = load_template(row.id)
+    attachment, = parse(template.render('ana@example.com', {'name': 'Ana'})).iter_attachments()
+    assert attachment.get_content() == 'conteudo'
+
+
+def test_send_merge_sends_one_message_per_recipient(make_app, sink):
+    app = make_app(SMTP_CONFIGS={'default': {'server': '127.0.0.1', 'port': sink.port, 'use_tls': False}})
+    template = MessageTemplate('Oi {{ name }}', 'contato@example.com', body='Olá {{ name }}')
+    with app.app_context():
+        project = Project(name='Merge', mail_username='contato@example.com', mail_password='secret')
+        db.session.add(project)
+        db.session.commit()
+        failures = send_merge(template, [{'email': 'ana@example.com', 'vars': {'name': 'Ana'}},
+                                         {'email': 'bia@example.com', 'vars': {'name': INJECTED}},
+                                         {'email': 'cris@example.com', 'vars': {'name': 'Cris'}}],
+                              project=project)
+    assert list(failures) == ['bia@example.com']
+    assert isinstance(failures['bia@example.com'], BadHeaderError)
+    subjects = sorted(parse(data)['Subject'] for _, _, data in sink.messages)
+    assert subjects == ['Oi Ana', 'Oi Cris']
@@ -0,0 +1,159 @@
+import json
+import smtplib
+from datetime import datetime, timedelta
+import pytest
+import jobs
+from circuit import CircuitOpen
+from envelope import DeliveryReport
+from governor import RateLimited
+from jobs import outbox_worker
+from models import db, Outbox
+from utils import serializer
+
+MESSAGE = {'recipients': ['ana@example.com'], 'subject': 'Oi', 'body': 'Olá',
+           'sender': 'contato@example.com'}
+
+
+def enqueue(app, project, message=MESSAGE, **fields):
+    with app.app_context():
+        row = outbox_worker.enqueue(project['id'], message)
+        for name, value in fields.items():
+            setattr(row, name, value)
+        db.session.commit()
+        return row.id
+
+
+def deliver(app):
+    with app.app_context():
+        claimed = outbox_worker.claim_due(10)
+        for outbox_id, token in claimed:
+            outbox_worker.deliver(outbox_id, token)
+        return claimed
+
+
+def load(app, outbox_id):
+    with app.app_context():
+        row = db.session.get(Outbox, outbox_id)
+        db.session.expunge(row)
+        return row
+
+
+def failing_send(error):
+    def send(**message):
+        raise error
+    return send
+
+
+def test_claim_leases_due_rows_once(app, project):
+    due = enqueue(app, project)
+    enqueue(app, project, next_attempt_at=datetime.utcnow() + timedelta(hours=1))
+    with app.app_context():
+        claimed = outbox_worker.claim_due(10)
+        assert [outbox_id for outbox_id, _ in claimed] == [due]
+        assert outbox_worker.claim_due(10) == []
+    row = load(app, due)
+    assert row.state == 'sending'
+    assert row.next_attempt_at > datetime.utcnow()
+
+
+def test_expired_lease_is_claimed_again(app, project):
+    outbox_id = enqueue(app, project, state='sending', lease_token='morto',
+                        next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+    with app.app_context():
+        (claimed_id, token), = outbox_worker.claim_due(10)
+    assert claimed_id == outbox_id and token != 'morto'
+
+
+def test_delivered_row_is_sent(app, project):
+    outbox_id = enqueue(app, project)
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.attempts, row.lease_token) == ('sent', 1, None)
+
+
+def test_stale_lease_token_is_ignored(app, project):
+    outbox_id = enqueue(app, project)
+    with app.app_context():
+        outbox_worker.claim_due(10)
+        outbox_worker.deliver(outbox_id, 'outro')
+    assert load(app, outbox_id).state == 'sending'
+
+
+def test_transient_error_is_retried_with_backoff(app, project, monkeypatch):
+    monkeypatch.setattr(jobs, 'send_custom_email', failing_send(smtplib.SMTPServerDisconnected('caiu')))
+    outbox_id = enqueue(app, project)
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.attempts) == ('queued', 1)
+    assert row.next_attempt_at > datetime.utcnow() + timedelta(seconds=outbox_worker.backoff_base / 2 - 1)
+
+
+def test_transient_error_on_last_attempt_is_dead(app, project, monkeypatch):
+    monkeypatch.setattr(jobs, 'send_custom_email', failing_send(smtplib.SMTPServerDisconnected('caiu')))
+    outbox_id = enqueue(app, project, attempts=outbox_worker.max_attempts - 1)
+    deliver(app)
+    assert load(app, outbox_id).state == 'dead'
+
+
+def test_permanent_error_is_dead(app, project, monkeypatch):
+    refused = smtplib.SMTPRecipientsRefused({'ana@example.com': (550, b'5.1.1 no such user')})
+    monkeypatch.setattr(jobs, 'send_custom_email', failing_send(refused))
+    outbox_id = enqueue(app, project)
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.attempts) == ('dead', 1)
+    assert '5.1.1' in row.last_error
+
+
+@pytest.mark.parametrize('error, delay', [
+    (RateLimited('contato@example.com', 42), 42),
+    (CircuitOpen('smtp.example.com:587', 120), 120),
+])
+def test_postponed_send_keeps_its_attempts(app, project, monkeypatch, error, delay):
+    monkeypatch.setattr(jobs, 'send_custom_email', failing_send(error))
+    outbox_id = enqueue(app, project, attempts=outbox_worker.max_attempts - 1)
+    before = datetime.utcnow()
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.attempts) == ('queued', outbox_worker.max_attempts - 1)
+    assert before + timedelta(seconds=delay - 1) < row.next_attempt_at < before + timedelta(seconds=delay + 5)
+
+
+def test_corrupt_payload_is_dead(app, project):
+    outbox_id = enqueue(app, project, payload='{não é json')
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.lease_token) == ('dead', None)
+
+
+def test_verification_token_is_signed_at_delivery(app, project, monkeypatch):
+    sent = []
+    monkeypatch.setattr(jobs, 'send_verification_email',
+                        lambda email, name, token, host_url, project=None: sent.append(token))
+    outbox_id = enqueue(app, project, {'kind': 'verification', 'email': 'ana@example.com',
+                                       'host_url': 'http://localhost/'})
+    deliver(app)
+    assert load(app, outbox_id).state == 'sent'
+    token_data = serializer.loads(sent[0], salt='email-verification', max_age=60)
+    assert token_data == {'email': 'ana@example.com', 'api_key': project['api_key']}
+
+
+def test_backoff_is_capped_and_jittered(app):
+    for attempts in range(1, 20):
+        delay = outbox_worker.backoff(attempts)
+        expected = min(outbox_worker.backoff_max, outbox_worker.backoff_base * 2 ** (attempts - 1))
+        assert expected / 2 <= delay <= expected
+
+
+def test_recipients_held_by_the_governor_are_requeued_without_an_attempt(app, project, monkeypatch):
+    def send(**message):
+        report = DeliveryReport()
+        report.record(['ana@example.com'])
+        report.record(['bia@example.com'], error=RateLimited('contato@example.com', 30))
+        return report
+    monkeypatch.setattr(jobs, 'send_custom_email', send)
+    outbox_id = enqueue(app, project, dict(MESSAGE, recipients=['ana@example.com', 'bia@example.com']))
+    deliver(app)
+    row = load(app, outbox_id)
+    assert (row.state, row.attempts) == ('queued', 0)
+    assert json.loads(row.payload)['envelope'] == ['bia@example.com']
@@ -0,0 +1,61 @@
+import json
+import pytest
+from sqlalchemy.exc import OperationalError
+from jobs import outbox_worker
+from models import Outbox
+
+
+def send_custom_email(app, project, **fields):
+    payload = dict({'api_key': project['api_key'], 'sender': 'contato@example.com',
+                    'recipients': ['ana@example.com']}, **fields)
+    return app.test_client().post('/api/send-custom-email?async=1', json=payload)
+
+
+@pytest.mark.parametrize('fields', [
+    {'attachments': [['a', 'b']]},
+    {'attachments': [['a.txt', 'texto', 'b2k=']]},
+    {'attachments': 'a.txt'},
+    {'cc': 'r2@example.com'},
+    {'bcc': ['nao-e-email']},
+])
+def test_send_custom_email_rejects_malformed_fields(app, project, fields):
+    response = send_custom_email(app, project, **fields)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    with app.app_context():
+        assert Outbox.query.count() == 0
+
+
+def test_send_custom_email_queues_valid_fields(app, project):
+    response = send_custom_email(app, project, cc=['r2@example.com'],
+                                 attachments=[['a.txt', 'text/plain', 'b2k=']])
+    assert response.status_code == 202
+    with app.app_context():
+        assert Outbox.query.count() == 1
+
+
+def send_bulk(app, project, lines):
+    body = '\n'.join(json.dumps(line) for line in lines) + '\n'
+    response = app.test_client().post('/api/send-bulk?api_key=' + project['api_key'], data=body,
+                                      content_type='application/x-ndjson')
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_send_bulk_reports_each_line(app, project):
+    results = send_bulk(app, project, [
+        {'defaults': {'sender': 'contato@example.com', 'subject': 'Oi'}},
+        {'recipient': 'ana@example.com'},
+        {'recipient': 'bia@example.com', 'cc': 'r2@example.com'},
+    ])
+    assert [r.get('status') for r in results[:-1]] == ['rejected', 'accepted']
+    assert results[-1]['summary'] == {'accepted': 1, 'rejected': 1, 'failed': 0}
+
+
+def test_send_bulk_reports_enqueue_failures_and_finishes(app, project, monkeypatch):
+    def locked(project_id, messages):
+        raise OperationalError('INSERT', {}, Exception('database is locked'))
+    monkeypatch.setattr(outbox_worker, 'enqueue_many', locked)
+    results = send_bulk(app, project, [{'sender': 'contato@example.com', 'recipient': 'ana@example.com'},
+                                       {'sender': 'contato@example.com', 'recipient': 'bia@example.com'}])
+    assert [r['status'] for r in results[:-1]] == ['failed', 'failed']
+    assert results[-1]['summary'] == {'accepted': 0, 'rejected': 0, 'failed': 2}
@@ -0,0 +1,176 @@
+import base64
+import json
+import smtplib
+import socket
+import ssl
+import pytest
+from benchmarks.smtp_sink import make_self_signed_cert
+from jobs import outbox_worker
+from models import db, Outbox, Project
+from smtp_ingress import smtp_ingress
+
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    return make_self_signed_cert(str(tmp_path_factory.mktemp('cert')))
+
+
+@pytest.fixture
+def ingress(make_app, certificate):
+    certfile, keyfile = certificate
+    app = make_app(SMTP_INGRESS_PORT=0, SMTP_INGRESS_HOSTNAME='ingress.test',
+                   SMTP_INGRESS_TLS_CERT=certfile, SMTP_INGRESS_TLS_KEY=keyfile)
+    smtp_ingress.start()
+    yield app
+    smtp_ingress.stop()
+
+
+def read_reply(reader):
+    lines = []
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        lines.append(line.decode())
+        if line[3:4] != b'-':
+            break
+    return ''.join(lines)
+
+
+def test_commands_pipelined_after_starttls_are_refused(ingress):
+    with socket.create_connection(('127.0.0.1', smtp_ingress.port), timeout=5) as sock:
+        reader = sock.makefile('rb')
+        assert read_reply(reader).startswith('220')
+        sock.sendall(b'EHLO client.test\r\n')
+        assert 'STARTTLS' in read_reply(reader)
+        # Texto puro enviado junto com o STARTTLS não pode ser lido como vindo pelo TLS
+        sock.sendall(b'STARTTLS\r\nNOOP injected\r\n')
+        assert read_reply(reader).startswith('503')
+        assert reader.readline() == b''
+    assert smtp_ingress.stats()['starttls_pipelined'] == 1
+
+
+@pytest.fixture
+def relay_ingress(make_app, sink):
+    relay = {'server': '127.0.0.1', 'port': sink.port, 'use_tls': False}
+    app = make_app(SMTP_INGRESS_PORT=0, SMTP_INGRESS_HOSTNAME='ingress.test',
+                   SMTP_CONFIGS={'default': relay})
+    smtp_ingress.start()
+    yield app
+    smtp_ingress.stop()
+
+
+def create_project(app):
+    with app.app_context():
+        row = Project(name='Ingress', mail_username='contato@example.com', mail_password='secret')
+        db.session.add(row)
+        db.session.commit()
+        return row.api_key
+
+
+def deliver_queued(app):
+    with app.app_context():
+        for outbox_id, token in outbox_worker.claim_due(10):
+            outbox_worker.deliver(outbox_id, token)
+
+
+def test_8bitmime_is_declared_on_the_relay_hop(relay_ingress, sink):
+    api_key = create_project(relay_ingress)
+    with smtplib.SMTP('127.0.0.1', smtp_ingress.port, timeout=5) as client:
+        client.login(api_key, 'x')
+        client.sendmail('contato@example.com', ['ana@example.com'],
+                        'Subject: Olá\r\n\r\nAção\r\n'.encode('utf-8'), mail_options=['BODY=8BITMIME'])
+    with relay_ingress.app_context():
+        assert json.loads(Outbox.query.one().payload)['mail_options'] == ['BODY=8BITMIME']
+    deliver_queued(relay_ingress)
+    (mail_from, _, data), = sink.messages
+    assert 'BODY=8BITMIME' in mail_from
+    assert 'Ação'.encode('utf-8') in data
+
+
+@pytest.mark.parametrize('command', [b'EHLO x)\tby forged.example', b'HELO a b', b'EHLO evil;'])
+def test_malformed_helo_names_are_refused(ingress, command):
+    with socket.create_connection(('127.0.0.1', smtp_ingress.port), timeout=5) as sock:
+        reader = sock.makefile('rb')
+        read_reply(reader)
+        sock.sendall(command + b'\r\n')
+        assert read_reply(reader).startswith('501')
+        sock.sendall(b'EHLO [127.0.0.1]\r\n')
+        assert read_reply(reader).startswith('250')
+
+
+def auth_plain(api_key, password='x'):
+    return base64.b64encode(('\0%s\0%s' % (api_key, password)).encode()).decode()
+
+
+def client_context():
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def test_auth_requires_tls_then_message_is_spooled_and_queued(ingress):
+    api_key = create_project(ingress)
+    with smtplib.SMTP('127.0.0.1', smtp_ingress.port, timeout=5) as client:
+        client.ehlo('client.test')
+        assert not client.has_extn('auth')
+        assert client.docmd('AUTH', 'PLAIN ' + auth_plain(api_key))[0] == 538
+        client.starttls(context=client_context())
+        client.ehlo('client.test')
+        assert client.has_extn('auth')
+        client.login(api_key, 'x')
+        client.sendmail('contato@example.com', ['ana@example.com', 'bia@example.com'],
+                        b'Subject: Oi\r\n\r\n.linha com ponto\r\nfim\r\n')
+    with ingress.app_context():
+        message = json.loads(Outbox.query.one().payload)
+    assert message['kind'] == 'raw'
+    assert message['recipients'] == ['ana@example.com', 'bia@example.com']
+    with open(message['spool'], 'rb') as spool:
+        data = spool.read()
+    assert data.startswith(b'Received: from client.test ([127.0.0.1])\r\n\tby ingress.test with ESMTPSA')
+    # Dot-stuffing desfeito no spool
+    assert data.endswith(b'Subject: Oi\r\n\r\n.linha com ponto\r\nfim\r\n')
+    assert len(data) == message['size']
+
+
+def test_invalid_api_keys_close_the_connection(relay_ingress):
+    with smtplib.SMTP('127.0.0.1', smtp_ingress.port, timeout=5) as client:
+        client.ehlo('client.test')
+        for attempt in range(3):
+            assert client.docmd('AUTH', 'PLAIN ' + auth_plain('nao-existe'))[0] == 535
+        with pytest.raises(smtplib.SMTPServerDisconnected):
+            client.noop()
+
+
+def test_commands_out_of_order_are_refused(relay_ingress):
+    api_key = create_project(relay_ingress)
+    with smtplib.SMTP('127.0.0.1', smtp_ingress.port, timeout=5) as client:
+        client.ehlo('client.test')
+        assert client.mail('contato@example.com')[0] == 530
+        client.login(api_key, 'x')
+        assert client.docmd('DATA')[0] == 503
+        assert client.rcpt('ana@example.com')[0] == 503
+        assert client.mail('contato@example.com')[0] == 250
+        assert client.mail('contato@example.com')[0] == 503
+        assert client.rcpt('nao-e-email')[0] == 553
+
+
+def test_oversized_message_is_refused_after_data(make_app, sink):
+    app = make_app(SMTP_INGRESS_PORT=0, SMTP_INGRESS_MAX_MESSAGE_SIZE=1024,
+                   SMTP_CONFIGS={'default': {'server': '127.0.0.1', 'port': sink.port}})
+    smtp_ingress.start()
+    try:
+        api_key = create_project(app)
+        with smtplib.SMTP('127.0.0.1', smtp_ingress.port, timeout=5) as client:
+            client.login(api_key, 'x')
+            # Sem SIZE no MAIL: o limite só é percebido durante o DATA
+            client.mail('contato@example.com')
+            client.rcpt('ana@example.com')
+            assert client.data(b'x' * 4096 + b'\r\n')[0] == 552
+            # A sessão continua utilizável depois da recusa
+            assert client.noop()[0] == 250
+        with app.app_context():
+            assert Outbox.query.count() == 0
+    finally:
+        smtp_ingress.stop()
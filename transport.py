@@ -0,0 +1,158 @@
+"""
+Per-project SMTP transports.
+
+A transport is the immutable combination of the relay resolved from
+``SMTP_CONFIGS`` and the credentials used on it. Transports are built once
+per (project, provider), cached, and dropped when the project changes, so
+sends never have to touch the shared ``current_app.config``.
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+from collections import namedtuple
+from sqlalchemy import event
+from models import Project
+
+# use_tls das sessões com MX: STARTTLS só quando o servidor anuncia
+OPPORTUNISTIC_TLS = 'opportunistic'
+
+# Chave do processo para o digest das credenciais nas chaves do pool
+_CREDENTIAL_KEY = os.urandom(32)
+
+
+def credential_digest(username, password):
+    """Opaque per-process fingerprint of a username/password pair."""
+    if username is None:
+        return None
+    credential = ('%s\0%s' % (username, password or '')).encode('utf-8')
+    return hmac.new(_CREDENTIAL_KEY, credential, hashlib.sha256).hexdigest()
+
+
+class Transport(namedtuple('Transport', ['provider', 'server', 'port', 'use_tls',
+                                         'use_ssl', 'username', 'password', 'project_id',
+                                         'max_recipients', 'direct'],
+                           defaults=(None, None, False))):
+    """Resolved SMTP settings plus credentials for one project mailbox.
+
+    ``direct`` senders have no relay (``server`` is None): their messages
+    go to the recipients' MX hosts (see mta.py).
+    """
+    __slots__ = ()
+
+    @property
+    def pool_key(self):
+        # A senha entra na chave: quem repete o username de outro projeto com
+        # outra senha não recebe as sessões já autenticadas dele
+        return (self.server, self.port, self.use_tls, self.username,
+                credential_digest(self.username, self.password))
+
+    def __repr__(self):
+        # Nunca expor a senha em logs
+        return 'Transport(%s, %s:%s, username=%r)' % (self.provider, self.server,
+                                                      self.port, self.username)
+
+
+def resolve_provider(sender_email, smtp_configs):
+    """Return the SMTP_CONFIGS key used for a sender address."""
+    domain = (sender_email or '').split('@')[-1].lower()
+    return domain if domain in smtp_configs else 'default'
+
+
+class TransportRegistry(object):
+    """Thread-safe cache of transports keyed by (project id, provider)."""
+
+    def __init__(self, app=None):
+        self.smtp_configs = {}
+        self.default_username = None
+        self.default_password = None
+        self.max_recipients = 100
+        self._cache = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.smtp_configs = app.config['SMTP_CONFIGS']
+        self.default_username = app.config.get('MAIL_USERNAME')
+        self.default_password = app.config.get('MAIL_PASSWORD')
+        self.max_recipients = app.config.get('SMTP_MAX_RECIPIENTS', self.max_recipients)
+        app.extensions['transports'] = self
+
+    def credentials(self, project, provider=None):
+        smtp_config = self.smtp_configs.get(provider) or {}
+        if smtp_config.get('username'):
+            # Relay com credenciais próprias (ex.: relay de contingência compartilhado)
+            return smtp_config['username'], smtp_config.get('password')
+        if project is not None and project.mail_username and project.mail_password:
+            return project.mail_username, project.mail_password
+        # Sem credenciais do projeto, usa as credenciais padrão da aplicação
+        return self.default_username, self.default_password
+
+    def build(self, project, provider):
+        return self._build(provider, *self.credentials(project, provider),
+                           project_id=project.id if project is not None else None)
+
+    def _build(self, provider, username, password, project_id):
+        smtp_config = self.smtp_configs[provider]
+        return Transport(provider=provider,
+                         server=smtp_config.get('server'),
+                         port=smtp_config.get('port'),
+                         use_tls=bool(smtp_config.get('use_tls')),
+                         use_ssl=bool(smtp_config.get('use_ssl')),
+                         username=username,
+                         password=password,
+                         project_id=project_id,
+                         # RCPT por transação aceitos pelo relay
+                         max_recipients=smtp_config.get('max_recipients', self.max_recipients),
+                         direct=bool(smtp_config.get('direct')))
+
+    def failover(self, transport):
+        """The transport of the secondary relay (``failover`` in SMTP_CONFIGS), if any.
+
+        It keeps the project's credentials unless the secondary entry has
+        its own ``username``/``password``.
+        """
+        name = self.smtp_configs.get(transport.provider, {}).get('failover')
+        if (not name or name == transport.provider or name not in self.smtp_configs
+                or self.smtp_configs[name].get('direct')):
+            return None
+        username, password = transport.username, transport.password
+        if self.smtp_configs[name].get('username'):
+            username, password = self.credentials(None, name)
+        return self._build(name, username, password, transport.project_id)
+
+    def get(self, project, sender):
+        """Return the cached transport for a project sending as ``sender``."""
+        provider = resolve_provider(sender, self.smtp_configs)
+        key = (project.id if project is not None else None, provider)
+        transport = self._cache.get(key)
+        # Confere as credenciais para não usar um transporte obsoleto caso o
+        # projeto tenha sido alterado por outro processo
+        if transport is not None and (transport.username,
+                                      transport.password) == self.credentials(project, provider):
+            return transport
+
+        transport = self.build(project, provider)
+        with self._lock:
+            self._cache[key] = transport
+        return transport
+
+    def invalidate(self, project_id=None):
+        """Drop cached transports for one project (or all of them)."""
+        with self._lock:
+            if project_id is None:
+                self._cache.clear()
+            else:
+                for key in [k for k in self._cache if k[0] == project_id]:
+                    del self._cache[key]
+
+
+transports = TransportRegistry()
+
+
+@event.listens_for(Project, 'after_update')
+@event.listens_for(Project, 'after_delete')
+def _invalidate_project_transports(mapper, connection, target):
+    transports.invalidate(target.id)
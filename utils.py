@@ -1,8 +1,14 @@
 import re
-from flask_mail import Mail, Message
+import time
+from flask_mail import Mail, Message, BadHeaderError, email_dispatched, sanitize_address, sanitize_addresses
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app
 import base64
+from transport import transports, resolve_provider
+from envelope import plan_envelopes, DeliveryReport
+from mta import sender_for
+from attachments import StreamingMessage, iter_blocks
+from smtp_client import EightBitBody
 
 mail = Mail()
 serializer = URLSafeTimedSerializer('chave_temporaria') 
@@ -11,64 +17,100 @@ def is_valid_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return bool(re.match(pattern, email))
 
+def is_truthy(value):
+    """Interpret query string / form flags such as ?async=1"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
 def get_smtp_config(sender_email):
     """Get SMTP configuration based on sender's email domain"""
-    print(f"Sender email: {sender_email}")
-    domain = sender_email.split('@')[-1]
     configs = current_app.config['SMTP_CONFIGS']
-    
-    # Use Gmail only for gmail.com emails
-    if domain == 'gmail.com':
-        print("Using Gmail SMTP")
-        print(configs['gmail.com'])
-        return configs['gmail.com']
-    
-    print("Using Zoho SMTP")
-    print(configs['default'])
-    return configs['default']
+    return configs[resolve_provider(sender_email, configs)]
 
-def send_verification_email(email, project_name, token, host_url, project=None):
-    print(email)
+def deliver_message(msg, transport, envelope=None):
+    """Send a Message through pooled SMTP sessions and return its DeliveryReport.
+
+    To, Cc and Bcc are de-duplicated and split into envelopes sized for the
+    relay (see envelope.py), or handed to the recipients' MX hosts when the
+    sender is in direct mode (see mta.py). Raises only when no recipient accepted the
+    message; partial failures are in the report. ``envelope`` restricts the
+    RCPT list (e.g. to the recipients of a retry) without changing headers.
+    """
+    assert msg.send_to, 'No recipients have been added'
+    assert msg.sender, 'Sender is required'
+    if msg.has_bad_headers():
+        raise BadHeaderError
+    if msg.date is None:
+        msg.date = time.time()
+
+    # Ordem preservada: To, depois Cc, depois Bcc
+    addresses = list(sanitize_addresses(envelope or list(msg.recipients) + list(msg.cc or [])
+                                        + list(msg.bcc or [])))
+    if current_app.extensions['mail'].suppress:
+        report = DeliveryReport()
+        for chunk in plan_envelopes(addresses):
+            report.record(chunk)
+    else:
+        # Serializada em blocos durante o envio, com texto em 8 bits se o relay aceitar
+        body = EightBitBody(msg.iter_bytes) if isinstance(msg, StreamingMessage) else msg.as_bytes()
+        report = sender_for(transport).send(transport,
+                                            sanitize_address(msg.sender),
+                                            addresses,
+                                            body,
+                                            msg.mail_options,
+                                            msg.rcpt_options)
+        report.raise_if_nothing_sent()
+    email_dispatched.send(msg, app=current_app._get_current_object())
+    return report
+
+def send_raw_message(sender, recipients, message, project=None, mail_options=()):
+    """Relay an already formatted message (bytes or FileAttachment) unchanged
+
+    ``mail_options`` are the client's MAIL parameters (BODY=8BITMIME, SMTPUTF8).
+    """
+    # Transporte SMTP (servidor + credenciais) do projeto para este remetente
+    transport = transports.get(project, sender)
+    report = sender_for(transport).send(transport,
+                                        sanitize_address(sender),
+                                        list(sanitize_addresses(recipients)),
+                                        lambda: iter_blocks(message),
+                                        mail_options or ())
+    report.raise_if_nothing_sent()
+    return report
+
+VERIFICATION_SUBJECT = 'Confirme seu Email'
+
+def verification_content(project_name, token, host_url):
+    """Return the (text, html) bodies of the verification email"""
     verification_url = host_url.rstrip('/') + f'/api/verify/{token}'
-    
-    sender = project.mail_username if project and project.mail_username else ''
-    assert sender, 'Sender is required'
-    
-    # Get SMTP configuration based on sender's email domain
-    smtp_config = get_smtp_config(sender)
-    
-    # Update Flask-Mail configuration
-    current_app.config['MAIL_SERVER'] = smtp_config['server']
-    current_app.config['MAIL_PORT'] = smtp_config['port']
-    current_app.config['MAIL_USE_TLS'] = smtp_config['use_tls']
-    
-    msg = Message('Confirme seu Email',
-                 sender=sender,
-                 recipients=[email])
-    msg.html = f'''
+    html = f'''
     <h1>Confirme seu Email</h1>
     <p>Para confirmar seu email para {project_name}, clique no link abaixo:</p>
     <p><a href="{verification_url}">Clique aqui para verificar seu email</a></p>
     <p>Se você não solicitou este email, ignore esta mensagem.</p>
     '''
-    msg.body = f'''Para confirmar seu email para {project_name}, clique no link abaixo:
+    body = f'''Para confirmar seu email para {project_name}, clique no link abaixo:
     {verification_url}
 
     Se você não solicitou este email, ignore esta mensagem.'''
+    return body, html
+
+def send_verification_email(email, project_name, token, host_url, project=None):
+    print(email)
+    sender = project.mail_username if project and project.mail_username else ''
+    assert sender, 'Sender is required'
+    
+    # Transporte SMTP (servidor + credenciais) do projeto para este remetente
+    transport = transports.get(project, sender)
+    
+    msg = StreamingMessage(VERIFICATION_SUBJECT,
+                 sender=sender,
+                 recipients=[email])
+    msg.body, msg.html = verification_content(project_name, token, host_url)
     
     try:
-        if project and project.mail_username and project.mail_password:
-            # Configurar o Flask-Mail com as credenciais do projeto
-            current_app.config['MAIL_USERNAME'] = project.mail_username
-            current_app.config['MAIL_PASSWORD'] = project.mail_password
-            
-            
-            # Criar uma nova instância do Mail com as configurações atualizadas
-            project_mail = Mail(current_app)
-            project_mail.send(msg)
-        else:
-            mail.send(msg)
-            
+        deliver_message(msg, transport)
     except Exception as e:
         print(f"Erro ao enviar email: {str(e)}")
         raise
@@ -77,17 +119,16 @@ def send_custom_email(recipients, subject, body,
                       html_content=None, sender=None,
                       attachments=None, cc=None, bcc=None, reply_to=None,
                       date=None, charset=None, extra_headers=None,
-                      mail_options=None, rcpt_options=None, project=None):
-    """Send a custom email with domain-specific SMTP configuration"""
-    # Get SMTP configuration based on sender's email domain
-    smtp_config = get_smtp_config(sender)
-    
-    # Update Flask-Mail configuration
-    current_app.config['MAIL_SERVER'] = smtp_config['server']
-    current_app.config['MAIL_PORT'] = smtp_config['port']
-    current_app.config['MAIL_USE_TLS'] = smtp_config['use_tls']
+                      mail_options=None, rcpt_options=None, project=None, envelope=None):
+    """Send a custom email with domain-specific SMTP configuration.
+
+    Returns the DeliveryReport; ``envelope`` limits delivery to some of the
+    recipients (retries of a partially delivered message).
+    """
+    # Transporte SMTP (servidor + credenciais) do projeto para este remetente
+    transport = transports.get(project, sender)
     
-    msg = Message(subject,
+    msg = StreamingMessage(subject,
                  sender=sender,
                  recipients=recipients,
                  body=body,
@@ -119,24 +160,15 @@ def send_custom_email(recipients, subject, body,
     msg.reply_to = sender
 
     try:
-        if project and project.mail_username and project.mail_password:
-            # Configurar o Flask-Mail com as credenciais do projeto
-            current_app.config['MAIL_USERNAME'] = project.mail_username
-            current_app.config['MAIL_PASSWORD'] = project.mail_password
-            
-            # Criar uma nova instância do Mail com as configurações atualizadas
-            project_mail = Mail(current_app)
-            project_mail.send(msg)
-        else:
-            mail.send(msg)
-            
+        report = deliver_message(msg, transport, envelope)
+
         # Adiciona cabeçalho de cancelamento de inscrição
         unsub_domain = (sender or '').split('@')[-1]
         if unsub_domain:
             msg.extra_headers = {**(msg.extra_headers or {}), 
                               'List-Unsubscribe': f'<mailto:unsubscribe@{unsub_domain}>'}
             
-        return True
+        return report
         
     except Exception as e:
         current_app.logger.error(f"Erro ao enviar email: {str(e)}")